@@ -0,0 +1,297 @@
+"""
+Batch inference over large tables of scenarios, e.g. spreadsheets of tens of thousands of planning scenarios.
+
+Scenarios are read one row at a time from a csv, or a netica case file (.cas), whose columns are node names: each cell is the
+state of that node in the row's scenario, and an empty, "*" or "?" cell leaves the node at its base setting (the findings in the
+.neta file, plus any --config). Other columns (e.g. an id) are copied through to the output. Every row runs against a single
+loaded net, re-entering only the findings that changed since the previous row (as in sweep.py), and the results are written as each row finishes,
+so memory stays constant however many rows there are. `--shard K/N` runs the rows that start in the K-th of N equal byte ranges of
+the file, so a large table can be split into shards run by separate processes or machines, each reading only its own part
+of the file (this needs one row per line, i.e. no line breaks inside quoted csv fields). `--rows START:STOP` runs a range of rows instead,
+but has to read through every row before START.
+
+The NumCases column of a case file is the number of cases a row stands for. It is copied to the output like any other column,
+and weights the rows in the summary of the outputs over the whole batch.
+
+Usage:
+    python batch.py neta/limpopo.neta scenarios.csv --output results/batch.csv [--shard 0/8 | --rows 0:10000] [--config configs/limpopo.json] [--beliefs]
+"""
+
+from __future__ import annotations
+from netica import NeticaManager, NeticaGraph, NeticaNode, CasePosition
+from stats import get_bin_edges, histogram_stats
+from limpopo_common import output_nodes as limpopo_output_nodes
+from sweep import Scenario
+from typing import Generator, Iterable
+import argparse
+import csv
+import json
+import os
+import re
+import numpy as np
+
+
+# cell values that leave a node unset
+MISSING = {'', '*', '?'}
+
+# columns of a netica case file that describe the case rather than a node
+CASE_COLUMNS = {'IDnum', 'NumCases'}
+WEIGHT_COLUMN = 'NumCases'
+
+
+class CaseFile:
+    """
+    reads the rows of a csv or netica case file as {column: value}, with missing values as None
+
+    Rows are numbered from 0, not counting the header, and only rows in [start, stop) are read. Given `shard` (index, count),
+    only the rows starting in that part of the file's bytes are read, and rows are identified by their byte offset in the file instead.
+    Like netica's case position, `position` is CasePosition.FIRST_CASE before the first row is read, then the number (or offset)
+    of the last row read, then CasePosition.NO_MORE_CASES
+    """
+    def __init__(self, path:str, *, start:int=0, stop:int|None=None, shard:tuple[int, int]|None=None):
+        self.path = path
+        self.start = start
+        self.stop = stop
+        self.shard = shard
+        self.position: int|CasePosition = CasePosition.FIRST_CASE
+        self.is_case_file = path.lower().endswith('.cas')
+        with open(path, newline='') as f:
+            self.columns = next(self.split_lines(f), [])
+
+    @property
+    def row_label(self) -> str:
+        """what rows are identified by in the output"""
+        return 'Offset' if self.shard is not None else 'Row'
+
+    def parse_line(self, line:str) -> list[str]|None:
+        """the values of a single line, or None if it holds no row (a blank line, or a case file comment)"""
+        if not self.is_case_file:
+            return next(csv.reader([line]), None)
+        # case files are whitespace (or comma) separated, with // comments
+        line = line.split('//', 1)[0].strip()
+        return re.split(r'[\s,]+', line) if line else None
+
+    def shard_lines(self) -> Generator[tuple[int, list[str]], None, None]:
+        """(byte offset, values) of the rows that start in this shard's byte range of the file"""
+        index, count = self.shard
+        with open(self.path, 'rb') as f:
+            # the byte ranges split what comes after the header
+            while (line := f.readline()) and self.parse_line(line.decode('utf-8')) is None: ...
+            header_end = f.tell()
+            size = f.seek(0, os.SEEK_END)
+            begin = header_end + (size - header_end) * index // count
+            end = header_end + (size - header_end) * (index + 1) // count
+
+            # a row belongs to the shard its first byte is in, so skip the rest of a row that started before `begin`
+            f.seek(begin - 1 if begin > header_end else begin)
+            if begin > header_end:
+                f.readline()
+            offset = f.tell()
+            while offset < end and (line := f.readline()):
+                values = self.parse_line(line.decode('utf-8'))
+                if values is not None:
+                    yield offset, values
+                offset = f.tell()
+
+    def split_lines(self, f) -> Generator[list[str], None, None]:
+        if not self.is_case_file:
+            yield from csv.reader(f)
+            return
+        for line in f:
+            values = self.parse_line(line)
+            if values is not None:
+                yield values
+
+    def numbered_lines(self) -> Generator[tuple[int, list[str]], None, None]:
+        """(row number, values) of the rows in [start, stop)"""
+        with open(self.path, newline='') as f:
+            lines = self.split_lines(f)
+            next(lines, None)
+            for row_number, values in enumerate(lines):
+                if self.stop is not None and row_number >= self.stop:
+                    break
+                if row_number >= self.start:
+                    yield row_number, values
+
+    def __iter__(self) -> Generator[tuple[int, dict[str, str|None]], None, None]:
+        self.position = CasePosition.FIRST_CASE
+        for row_id, values in self.shard_lines() if self.shard is not None else self.numbered_lines():
+            if len(values) != len(self.columns):
+                raise ValueError(f"{self.path}: {self.row_label.lower()} {row_id} has {len(values)} values, but the header has {len(self.columns)} columns")
+            self.position = row_id
+            yield row_id, {column: None if value.strip() in MISSING else value.strip() for column, value in zip(self.columns, values)}
+        self.position = CasePosition.NO_MORE_CASES
+
+
+def parse_rows_range(text:str) -> tuple[int, int|None]:
+    """parse "START:STOP", "START:" or ":STOP" into (start, stop)"""
+    start, sep, stop = text.partition(':')
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected a row range START:STOP, not `{text}`")
+    return int(start or 0), (int(stop) if stop else None)
+
+
+def parse_shard(text:str) -> tuple[int, int]:
+    """parse "K/N" into (K, N), for the K-th (0 based) of N shards"""
+    index, sep, count = text.partition('/')
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        index = count = -1
+    if not sep or count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"expected a shard K/N with 0 <= K < N, not `{text}`")
+    return index, count
+
+
+def case_weight(row:dict[str, str|None]) -> float:
+    """the number of cases a row stands for: its NumCases value, or 1"""
+    value = row.get(WEIGHT_COLUMN)
+    if value is None:
+        return 1.0
+    try:
+        weight = float(value)
+    except ValueError:
+        weight = -1.0
+    if not np.isfinite(weight) or weight < 0:
+        raise ValueError(f"{WEIGHT_COLUMN} must be a non-negative number, not `{value}`")
+    return weight
+
+
+class StateParser:
+    """converts the text of a cell into a state of its node: a state name, or else a state index"""
+    def __init__(self, net:NeticaGraph):
+        self.net = net
+        self.states: dict[tuple[str, str], int] = {}
+
+    def __call__(self, node:str, text:str) -> int:
+        key = (node, text)
+        state = self.states.get(key)
+        if state is None:
+            state_names = self.net.node_state_names[node]
+            if state_names is not None and text in state_names:
+                state = state_names[text]
+            elif text.lstrip('-').isdigit():
+                state = self.net.get_node_state(node, int(text))
+            else:
+                raise ValueError(f"`{text}` is not a state of node {node}")
+            self.states[key] = state
+        return state
+
+
+def case_scenarios(net:NeticaGraph, cases:Iterable[tuple[int, dict[str, str|None]]], node_columns:list[str]) -> Generator[tuple[int, dict, Scenario], None, None]:
+    """
+    turn case rows into scenarios {node: state}, yielding (row number, row, scenario)
+
+    A node left empty in a row gets the finding it had before the batch started, so each scenario sets every node column
+    """
+    base = {node: net.findings.get(net.get_node_index(node)) for node in node_columns}
+    parse_state = StateParser(net)
+    for row_number, row in cases:
+        try:
+            scenario = {node: base[node] if row[node] is None else parse_state(node, row[node]) for node in node_columns}
+        except ValueError as e:
+            raise ValueError(f"row {row_number}: {e}") from None
+        yield row_number, row, scenario
+
+
+def write_batch_csv(path:str, results:Iterable[tuple[tuple[int, dict], np.ndarray]], columns:list[str], output_names:list[str], *,
+                    edges:np.ndarray|None=None, state_names:list[list[str]]|None=None, row_label:str='Row', flush_every:int=100) -> int:
+    """
+    stream batch results to a csv of the row number (or whatever `row_label` names) and `columns` of each row, followed by either the mean and
+    std of each output node (given `edges`), or the belief in each state of each output node (given `state_names`). Returns the number of rows written
+    """
+    header = [row_label, *columns]
+    for i, name in enumerate(output_names):
+        if edges is not None:
+            header.extend((f'{name} (Mean)', f'{name} (Standard Deviation)'))
+        else:
+            header.extend(f'{name}={state}' for state in state_names[i])
+
+    count = 0
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for (row_number, row), beliefs in results:
+            out = [row_number, *('' if row[column] is None else row[column] for column in columns)]
+            if edges is not None:
+                stats = histogram_stats(beliefs, edges)
+                for mean, std in zip(stats['mean'], stats['std']):
+                    out.extend((mean, std))
+            else:
+                for i, names in enumerate(state_names):
+                    out.extend(beliefs[i, :len(names)].tolist())
+            writer.writerow(out)
+
+            count += 1
+            if count % flush_every == 0:
+                f.flush()
+    return count
+
+
+def run_batch(net:NeticaGraph, cases:CaseFile, output_path:str, output_nodes:list[int|str|NeticaNode], *, beliefs:bool=False) -> tuple[int, float, np.ndarray]:
+    """
+    run every row of `cases` against `net`, streaming the results to `output_path`.
+    Returns (the number of rows run, the number of cases they stand for, and the beliefs [n_outputs, max_states] of the output nodes
+    over all of those cases, i.e. each row's beliefs weighted by its NumCases)
+    """
+    node_columns = [column for column in cases.columns if column in net.node_names and column not in CASE_COLUMNS]
+    if not node_columns:
+        raise ValueError(f"none of the columns of {cases.path} are nodes of the network")
+    output_names = [net.get_node_name(node) for node in output_nodes]
+    total_weight = 0.0
+    total_beliefs = np.zeros((len(output_names), int(max((net.get_num_node_states(node) for node in output_names), default=0))))
+
+    # enter_findings skips the nodes whose state is unchanged since the previous row
+    def results():
+        nonlocal total_weight, total_beliefs
+        for row_id, row, scenario in case_scenarios(net, cases, node_columns):
+            try:
+                weight = case_weight(row)
+            except ValueError as e:
+                raise ValueError(f"{cases.row_label.lower()} {row_id}: {e}") from None
+            net.enter_findings(scenario)
+            row_beliefs = net.get_beliefs(output_names)
+            total_weight += weight
+            total_beliefs += weight * row_beliefs
+            yield (row_id, row), row_beliefs
+
+    if beliefs:
+        state_names = [[name or str(j) for j, name in enumerate(net.meta.get_state_names(net.get_node_index(node)))] for node in output_names]
+        count = write_batch_csv(output_path, results(), cases.columns, output_names, state_names=state_names, row_label=cases.row_label)
+    else:
+        count = write_batch_csv(output_path, results(), cases.columns, output_names, edges=get_bin_edges(net, output_names), row_label=cases.row_label)
+    return count, total_weight, total_beliefs / total_weight if total_weight > 0 else total_beliefs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run every row of a csv or netica case file of scenarios against a network, streaming the output beliefs to a csv')
+    parser.add_argument('neta', help='path to the .neta file')
+    parser.add_argument('cases', help='csv or .cas file with one scenario per row, and a column per node')
+    parser.add_argument('--output', required=True, help='path of the output csv')
+    shard = parser.add_mutually_exclusive_group()
+    shard.add_argument('--shard', type=parse_shard, help='only run the rows starting in the K-th of N equal byte ranges of the file, e.g. 0/8, to split a large file between processes. Rows are identified by their byte offset in the output')
+    shard.add_argument('--rows', type=parse_rows_range, default=(0, None), help='only run rows START:STOP (0 based, not counting the header)')
+    parser.add_argument('--config', help='json file of base findings entered before the batch, in the same format as the scenario configs')
+    parser.add_argument('--nodes', nargs='+', default=list(limpopo_output_nodes), help='output nodes (default: the Limpopo output nodes)')
+    parser.add_argument('--beliefs', action='store_true', help='write the belief in every state of the output nodes, instead of their mean and standard deviation')
+    args = parser.parse_args()
+
+    start, stop = args.rows
+    cases = CaseFile(args.cases, start=start, stop=stop, shard=args.shard)
+
+    with NeticaManager() as netica:
+        net = netica.new_graph(args.neta, pooled=False)
+        if args.config:
+            with open(args.config) as f:
+                net.enter_findings({key: value for key, value in json.load(f).items() if value is not None})
+
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        count, weight, total_beliefs = run_batch(net, cases, args.output, args.nodes, beliefs=args.beliefs)
+        stats = histogram_stats(total_beliefs, get_bin_edges(net, args.nodes))
+    print(f'ran {count} rows ({weight:g} cases) of {args.cases} against {args.neta}, saved to {args.output}')
+    if count:
+        print('over all cases: ' + ', '.join(f'{node} {mean:.3f} ± {std:.3f}' for node, mean, std in zip(args.nodes, stats['mean'], stats['std'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+"""
+Stand-in for the NeticaPy bindings, for benchmarking netica.py and the scenario scripts without Netica (see benchmarks/run.py).
+
+Every .neta file loads as a synthetic network, seeded by the file's contents, made of:
+- the input and output nodes that the Limpopo and Mara scenario scripts use, so that they run unchanged
+- FAKE_NETICA_HIDDEN hidden nodes (default 16) with FAKE_NETICA_STATES states (default 4) between the inputs and outputs,
+  each with up to FAKE_NETICA_PARENTS parents (default 3)
+If FAKE_NETICA_STRUCTURE_SEED is set, the links are seeded by it instead, so that every file has the same structure and
+only the CPTs differ (as with the per-site networks, see structure.py).
+Beliefs come from propagating forward through the network in topological order, so findings only influence their descendants,
+and the numbers mean nothing. But like netica, a propagation runs once after the findings change, and its cost grows with the
+size of the network, so the wrapper's overhead and its number of propagations are measured faithfully.
+
+Every API call is counted in `calls` (propagations as "(propagate)"). If FAKE_NETICA_CALLS is set, the counts are written to that path as json when the process exits.
+"""
+
+from __future__ import annotations
+from collections import Counter
+import atexit
+import copy
+import json
+import os
+import zlib
+import numpy as np
+
+
+calls: Counter[str] = Counter()
+
+FOUR_STATES = [b'Zero', b'Low', b'Med', b'High']
+DISCHARGE_NODES = ['DISCHARGE_YR', 'DISCHARGE_LF', 'DISCHARGE_HF', 'DISCHARGE_FD']
+INPUT_NODES = [
+    # limpopo
+    'WQ_ECOSYSTEM', 'NO_BARRIERS', 'DOM_WAT_GRO', 'WQ_TREATMENT', 'LANDUSE_SSUP', 'WAT_DIS_HUM', 'WQ_PEOPLE', 'WQ_LIVESTOCK',
+    # mara
+    'TOXICITY_BHN', 'SED_BHN', 'PATHOGENS_BHN', 'DILUTION_MITIGATION', 'TREATMENT_DRINKING', 'QUANTITY', 'DEMAND_BHN',
+    'TREATMENT_WASTEWATER', 'AQUATIC_BIO_CUES', 'INUNDATION', 'RIVER_GEOMORPH', 'TOX_ECO', 'INVASIVE_SPECIES', 'SED_ECO',
+    'IMPORTANCE_ECO', 'DILUTION_SALTS_CP', 'SALTS_CP', 'CROP_DEMAND', 'QUALITY_LIVESTOCK', 'ANIMALS_TRAMPLING', 'DEMAND_LIVESTOCK',
+    'VEG_BANK', 'VEG_COVER_WETLAND', 'SED_WETLAND', 'PLANT_COMMUNITY', 'IMPORTANCE_WETLAND', 'SAFETY_TOURISTS', 'DEMAND_ECOTOURISM',
+]
+OUTPUT_NODES = [
+    # limpopo
+    'SUB_VEG_END', 'SUB_FISH_END', 'LIV_VEG_END', 'DOM_WAT_END', 'FLO_ATT_END', 'RIV_ASS_END', 'WAT_DIS_END', 'RES_RES_END',
+    'FISH_ECO_END', 'VEG_ECO_END', 'INV_ECO_END', 'REC_SPIR_END', 'TOURISM_END',
+    # mara
+    'BASIC_HUMAN_NEEDS', 'ECOLOGICAL_INTEGRITY', 'ECOTOURISM_INDUSTRY', 'IRRIGATED_CROP_PRODUCTION', 'LIVESTOCK_HERDING_CAPACITY', 'WETLAND_CONSERVATION',
+]
+
+UNDEF_STATE = -3
+CONTINUOUS_TYPE, DISCRETE_TYPE = 1, 2
+NATURE_NODE = 1
+
+
+def size_setting(name:str, default:int) -> int:
+    return int(os.environ.get(name, default))
+
+
+class NewNode:
+    def __init__(self, net:'FakeNet', idx:int, name:str, states:list[bytes], node_type:int, levels:list[float]|None, parents:list[int]):
+        self.net = net
+        self.idx = idx
+        self.name = name.encode('utf-8')
+        self.states = states
+        self.type = node_type
+        self.levels = levels
+        self.parents = parents
+        self.finding = UNDEF_STATE
+        self.cpt: np.ndarray|None = None
+
+
+class FakeNet:
+    def __init__(self, seed:int):
+        rng = np.random.default_rng(seed)
+        structure_seed = os.environ.get('FAKE_NETICA_STRUCTURE_SEED')
+        structure_rng = np.random.default_rng(int(structure_seed)) if structure_seed else rng
+        self.nodes: list[NewNode] = []
+        self.auto_update = 1
+        self.beliefs: list[np.ndarray]|None = None
+        self.elim_order: list[int]|None = None
+
+        hidden = size_setting('FAKE_NETICA_HIDDEN', 16)
+        hidden_states = size_setting('FAKE_NETICA_STATES', 4)
+        max_parents = size_setting('FAKE_NETICA_PARENTS', 3)
+
+        for name in DISCHARGE_NODES:
+            self.add(name, [b''] * 29, CONTINUOUS_TYPE, np.linspace(0, 290, 30).tolist(), [])
+        for name in INPUT_NODES:
+            self.add(name, FOUR_STATES, DISCRETE_TYPE, None, [])
+        roots = len(self.nodes)
+        for i in range(hidden):
+            parents = structure_rng.choice(len(self.nodes), size=min(max_parents, len(self.nodes)), replace=False)
+            self.add(f'HIDDEN_{i}', [f'S{j}'.encode() for j in range(hidden_states)], DISCRETE_TYPE, None, sorted(parents.tolist()))
+        for name in OUTPUT_NODES:
+            # draw the parents of the outputs from the hidden layer when there is one
+            pool = np.arange(roots, len(self.nodes)) if hidden else np.arange(roots)
+            parents = structure_rng.choice(pool, size=min(max_parents, len(pool)), replace=False)
+            self.add(name, FOUR_STATES, DISCRETE_TYPE, [0.0, 25.0, 50.0, 75.0, 100.0], sorted(parents.tolist()))
+
+        for node in self.nodes:
+            shape = [len(self.nodes[p].states) for p in node.parents] + [len(node.states)]
+            node.cpt = rng.dirichlet(np.ones(shape[-1]), size=int(np.prod(shape[:-1]))).reshape(shape)
+
+    def add(self, name:str, states:list[bytes], node_type:int, levels:list[float]|None, parents:list[int]):
+        self.nodes.append(NewNode(self, len(self.nodes), name, states, node_type, levels, parents))
+
+    def propagate(self) -> list[np.ndarray]:
+        if self.beliefs is None:
+            calls['(propagate)'] += 1
+            beliefs = []
+            for node in self.nodes:
+                if node.finding >= 0:
+                    b = np.zeros(len(node.states))
+                    b[node.finding] = 1.0
+                else:
+                    b = node.cpt
+                    for p in reversed(node.parents):
+                        b = np.tensordot(beliefs[p], b, axes=([0], [b.ndim - 2]))
+                beliefs.append(b)
+            self.beliefs = beliefs
+        return self.beliefs
+
+    def set_finding(self, node:NewNode, state:int):
+        node.finding = state
+        self.beliefs = None
+
+    def default_order(self) -> list[int]:
+        """the order the fake eliminates nodes in when none is set: last node first"""
+        return list(reversed(range(len(self.nodes))))
+
+    def junction_tree_size(self) -> float:
+        """total clique table entries of the junction tree from eliminating the moral graph in `elim_order`"""
+        neighbors = {node.idx: set() for node in self.nodes}
+        for node in self.nodes:
+            family = [*node.parents, node.idx]
+            for a in family:
+                neighbors[a].update(f for f in family if f != a)
+        size = 0.0
+        for v in self.elim_order or self.default_order():
+            size += float(np.prod([len(self.nodes[u].states) for u in neighbors[v] | {v}], dtype=np.float64))
+            for u in neighbors[v]:
+                neighbors[u].update(w for w in neighbors[v] if w != u)
+                neighbors[u].discard(v)
+            del neighbors[v]
+        return size
+
+
+class Netica:
+    """the subset of the NeticaPy API used by this repo"""
+    def __getattribute__(self, name:str):
+        if not name.startswith('_'):
+            calls[name] += 1
+        return object.__getattribute__(self, name)
+
+    # environment
+    def NewNeticaEnviron_ns(self, license, env, locn): return object()
+    def InitNetica2_bn(self, env, mesg:bytearray) -> int: return 0
+    def CloseNetica_bn(self, env, mesg:bytearray) -> int:
+        mesg.extend(b'Fake Netica closed')
+        return 0
+    def NewFileStream_ns(self, path:bytes, env, access) -> str: return path.decode('utf-8')
+
+    # nets
+    def ReadNet_bn(self, stream:str, options) -> FakeNet:
+        with open(stream, 'rb') as f:
+            return FakeNet(zlib.crc32(f.read()))
+    def CopyNet_bn(self, net:FakeNet, new_name:bytes, env, options) -> FakeNet: return copy.deepcopy(net)
+    def GetNetName_bn(self, net:FakeNet) -> bytes: return b'fake'
+    def CompileNet_bn(self, net:FakeNet): net.compiled = True
+    def UncompileNet_bn(self, net:FakeNet): net.compiled = False
+    def DeleteNet_bn(self, net:FakeNet): net.nodes = []
+    def SizeCompiledNet_bn(self, net:FakeNet, method) -> float: return float(sum(node.cpt.size for node in net.nodes) + net.junction_tree_size()) * 8
+    def SetNetAutoUpdate_bn(self, net:FakeNet, auto_update:int) -> int:
+        old, net.auto_update = net.auto_update, auto_update
+        return old
+    def SetNetElimOrder_bn(self, net:FakeNet, nodes:list[NewNode]|None): net.elim_order = None if nodes is None else [node.idx for node in nodes]
+    def GetNetElimOrder_bn(self, net:FakeNet) -> list[NewNode]: return [net.nodes[i] for i in net.elim_order or net.default_order()]
+    def GetNetNodes_bn(self, net:FakeNet) -> list[NewNode]: return list(net.nodes)
+
+    # node lists
+    def NewNodeList2_bn(self, length:int, net:FakeNet) -> list: return []
+    def AddNodeToList_bn(self, node:NewNode, nodes:list, index:int): nodes.append(node)
+    def DeleteNodeList_bn(self, nodes:list): pass
+    def LengthNodeList_bn(self, nodes:list) -> int: return len(nodes)
+    def NthNode_bn(self, nodes:list, index:int) -> NewNode: return nodes[index]
+
+    # nodes
+    def GetNodeName_bn(self, node:NewNode) -> bytes: return node.name
+    def GetNodeType_bn(self, node:NewNode) -> int: return node.type
+    def GetNodeKind_bn(self, node:NewNode) -> int: return NATURE_NODE
+    def GetNodeNumberStates_bn(self, node:NewNode) -> int: return len(node.states)
+    def GetNodeStateName_bn(self, node:NewNode, state:int) -> bytes: return node.states[state]
+    def GetNodeLevels_bn(self, node:NewNode) -> list[float]|None: return node.levels
+    def GetNodeParents_bn(self, node:NewNode) -> list[NewNode]: return [node.net.nodes[p] for p in node.parents]
+    def GetNodeProbs_bn(self, node:NewNode, parent_states:list[int]) -> list[float]: return node.cpt[tuple(parent_states)].tolist()
+    def SetNodeProbs_bn(self, node:NewNode, parent_states:list[int], probs:list[float]):
+        node.cpt[tuple(parent_states)] = probs
+        node.net.beliefs = None
+
+    # findings and beliefs
+    def GetNodeFinding_bn(self, node:NewNode) -> int: return node.finding
+    def EnterFinding_bn(self, node:NewNode, state:int):
+        if node.finding >= 0:
+            raise RuntimeError(f'{node.name.decode()} already has a finding')
+        node.net.set_finding(node, state)
+    def RetractNodeFindings_bn(self, node:NewNode): node.net.set_finding(node, UNDEF_STATE)
+    def RetractNetFindings_bn(self, net:FakeNet):
+        for node in net.nodes:
+            node.finding = UNDEF_STATE
+        net.beliefs = None
+    def GetNodeBeliefs_bn(self, node:NewNode) -> list[float]: return node.net.propagate()[node.idx].tolist()
+
+    # convenience functions of NeticaPy, taking node and state names
+    def _find(self, net:FakeNet, name) -> NewNode:
+        name = name if isinstance(name, bytes) else str(name).encode('utf-8')
+        return next(node for node in net.nodes if node.name == name)
+    def EnterFinding(self, name, state, net:FakeNet):
+        node = self._find(net, name)
+        state = state if isinstance(state, bytes) else str(state).encode('utf-8')
+        self.EnterFinding_bn(node, node.states.index(state))
+    def GetNodeBelief(self, name, state, net:FakeNet) -> float:
+        node = self._find(net, name)
+        state = state if isinstance(state, bytes) else str(state).encode('utf-8')
+        return float(net.propagate()[node.idx][node.states.index(state)])
+
+    # sensitivity to findings
+    def NewSensvToFinding_bn(self, query:NewNode, nodes:list[NewNode], what:int) -> tuple: return (query, what)
+    def DeleteSensvToFinding_bn(self, sensv:tuple): pass
+    def MutualInfo_bn(self, sensv:tuple, node:NewNode) -> float:
+        prior, conditionals, query_prior = self._sensitivity(sensv[0], node)
+        mutual_info = 0.0
+        for p, cond in zip(prior, conditionals):
+            mask = (cond > 0) & (query_prior > 0)
+            mutual_info += p * float(np.sum(cond[mask] * np.log2(cond[mask] / query_prior[mask])))
+        return mutual_info
+    def VarianceOfReal_bn(self, sensv:tuple, node:NewNode) -> float:
+        query = sensv[0]
+        levels = np.asarray(query.levels, dtype=np.float64)
+        values = (levels[1:] + levels[:-1]) / 2 if len(levels) == len(query.states) + 1 else levels
+        variance = lambda b: float(np.sum(b * values**2) - np.sum(b * values)**2)
+        prior, conditionals, query_prior = self._sensitivity(query, node)
+        return variance(query_prior) - sum(p * variance(cond) for p, cond in zip(prior, conditionals))
+    def _sensitivity(self, query:NewNode, node:NewNode):
+        net = query.net
+        prior, query_prior = net.propagate()[node.idx], net.propagate()[query.idx]
+        old, conditionals = node.finding, []
+        for state in range(len(node.states)):
+            net.set_finding(node, state)
+            conditionals.append(net.propagate()[query.idx])
+        net.set_finding(node, old)
+        return prior, conditionals, query_prior
+
+    # random cases
+    def NewRandomGenerator_ns(self, seed:bytes, env, options) -> np.random.Generator: return np.random.default_rng(int(seed))
+    def DeleteRandomGen_ns(self, rand): pass
+    def GenerateRandomCase_bn(self, nodes:list[NewNode], method:int, timeout:float, rand:np.random.Generator) -> int:
+        for node in nodes:
+            if node.finding < 0:
+                b = node.net.propagate()[node.idx]
+                node.net.set_finding(node, int(rand.choice(len(b), p=b / b.sum())))
+        return 0
+
+
+def save_calls():
+    path = os.environ.get('FAKE_NETICA_CALLS')
+    if path:
+        with open(path, 'w') as f:
+            json.dump(dict(calls), f)
+
+atexit.register(save_calls)
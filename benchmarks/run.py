@@ -0,0 +1,294 @@
+"""
+Benchmarks of the netica wrapper (netica.py), the discharge workbook parsing, and end to end runs of the scenario scripts.
+
+Runs against the real NeticaPy when it is installed, or else the stand-in in benchmarks/fake_netica, which builds synthetic networks
+of a configurable size and counts every API call. With the stand-in, each benchmark also reports the number of API calls (and propagations)
+it makes per operation, which doesn't depend on the machine, so changes to the wrapper can be compared exactly.
+Results are saved as json, and can be compared against a saved baseline.
+
+Every benchmark uses its own empty cache directory (PROBFLO_CACHE_DIR), and the end to end runs write their results to a temporary
+directory, so the repo's caches and results/ are left alone.
+
+Usage:
+    python benchmarks/run.py [--backend auto|fake|netica] [--size small|large] [--repeat 5] [--script-repeat 1] [--only get_stats limpopo.py ...]
+                             [--save [benchmarks/baselines/fake-small.json]] [--compare benchmarks/baselines/fake-small.json]
+"""
+
+from __future__ import annotations
+from dataclasses import dataclass, field, asdict
+from typing import Callable
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+from os.path import join
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_DIR = join(REPO_DIR, 'benchmarks', 'fake_netica')
+BASELINE_DIR = join(REPO_DIR, 'benchmarks', 'baselines')
+
+# sizes of the stand-in's synthetic networks (see fake_netica/NeticaPy.py)
+SIZES = {
+    'small': {'FAKE_NETICA_HIDDEN': 16, 'FAKE_NETICA_STATES': 4, 'FAKE_NETICA_PARENTS': 3},
+    'large': {'FAKE_NETICA_HIDDEN': 256, 'FAKE_NETICA_STATES': 6, 'FAKE_NETICA_PARENTS': 4},
+}
+
+NETA_PATH = join(REPO_DIR, 'neta', 'limpopo.neta')
+CONFIG_PATH = join(REPO_DIR, 'configs', 'limpopo.json')
+
+
+@dataclass
+class Result:
+    name: str
+    ops: int                                       # operations per run, e.g. findings entered
+    seconds: list[float] = field(default_factory=list)  # wall time of each run
+    calls: dict[str, float]|None = None            # API calls per operation, when running against the stand-in
+    error: str|None = None
+
+    @property
+    def median(self) -> float:
+        return float(np.median(self.seconds)) if self.seconds else float('nan')
+
+    def summary(self) -> dict:
+        out = asdict(self)
+        out['median_seconds'] = self.median
+        out['min_seconds'] = min(self.seconds, default=float('nan'))
+        out['microseconds_per_op'] = self.median / self.ops * 1e6 if self.seconds else float('nan')
+        return out
+
+
+class Bench:
+    """setup and timing helpers shared by the benchmarks"""
+    def __init__(self, backend:str, repeat:int, script_repeat:int):
+        self.backend = backend
+        self.repeat = repeat
+        self.script_repeat = script_repeat
+        self.cache_root = tempfile.mkdtemp(prefix='probflo-bench-')
+
+    def fresh_cache(self):
+        """empty the cache directory that netica.CACHE_DIR points at"""
+        shutil.rmtree(os.environ['PROBFLO_CACHE_DIR'], ignore_errors=True)
+        os.makedirs(os.environ['PROBFLO_CACHE_DIR'])
+
+    def calls(self) -> dict[str, int]|None:
+        if self.backend != 'fake':
+            return None
+        import NeticaPy
+        return dict(NeticaPy.calls)
+
+    def time(self, name:str, ops:int, run:Callable[[], None], setup:Callable[[], None]|None=None) -> Result:
+        """time `run` (which performs `ops` operations) `repeat` times, calling `setup` untimed before each run"""
+        result = Result(name, ops)
+        try:
+            for i in range(self.repeat):
+                if setup is not None:
+                    setup()
+                before = self.calls()
+                start = time.perf_counter()
+                run()
+                result.seconds.append(time.perf_counter() - start)
+                if before is not None and i == 0:
+                    after = self.calls()
+                    result.calls = {key: (after[key] - before.get(key, 0)) / ops for key in sorted(after) if after[key] != before.get(key, 0)}
+        except Exception as e:
+            result.error = f'{type(e).__name__}: {e}'
+        return result
+
+    def script(self, name:str, args:list[str]) -> Result:
+        """time end to end runs of a scenario script, each in a scratch directory with an empty cache"""
+        result = Result(name, 1)
+        workdir = tempfile.mkdtemp(prefix='run-', dir=self.cache_root)
+        for entry in ('neta', 'configs', 'shapes'):
+            os.symlink(join(REPO_DIR, entry), join(workdir, entry))
+        os.makedirs(join(workdir, 'results'))
+
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(([FAKE_DIR] if self.backend == 'fake' else []) + [REPO_DIR, env.get('PYTHONPATH', '')])
+        calls_path = join(workdir, 'calls.json')
+        env['FAKE_NETICA_CALLS'] = calls_path
+        for i in range(self.script_repeat):
+            env['PROBFLO_CACHE_DIR'] = join(workdir, f'cache-{i}')
+            start = time.perf_counter()
+            proc = subprocess.run([sys.executable, join(REPO_DIR, name), *args], cwd=workdir, env=env, capture_output=True, text=True)
+            elapsed = time.perf_counter() - start
+            if proc.returncode != 0:
+                lines = (proc.stderr or proc.stdout).strip().splitlines()
+                result.error = lines[-1] if lines else f'exit code {proc.returncode}'
+                break
+            result.seconds.append(elapsed)
+            if i == 0 and os.path.exists(calls_path):
+                with open(calls_path) as f:
+                    result.calls = dict(sorted(json.load(f).items()))
+        return result
+
+
+def random_findings(net, nodes:list[str], n:int, rng:np.random.Generator) -> list[dict[str, int]]:
+    """n single findings, each for a random node in a random state (so about one in 4 leaves the node's state unchanged)"""
+    picks = rng.integers(len(nodes), size=n).tolist()
+    return [{nodes[i]: int(rng.integers(net.get_num_node_states(nodes[i])))} for i in picks]
+
+
+def run_benchmarks(bench:Bench, only:set[str]|None) -> list[Result]:
+    from netica import NeticaManager
+    from stats import get_node_stats
+    from limpopo_common import output_nodes
+
+    with open(CONFIG_PATH) as f:
+        inputs = list(json.load(f))
+    outputs = list(output_nodes)
+    results = []
+    def wanted(name:str) -> bool:
+        return only is None or name in only
+
+    manager = NeticaManager()
+
+    if wanted('graph_construction_cold'):
+        # read, introspect, choose an elimination order for, and compile a net that has never been seen
+        results.append(bench.time('graph_construction_cold', 1, lambda: manager.load_graph(NETA_PATH).close(), setup=bench.fresh_cache))
+    if wanted('graph_construction'):
+        # the same net again, with its metadata and elimination order cached
+        bench.fresh_cache()
+        manager.load_graph(NETA_PATH).close()
+        results.append(bench.time('graph_construction', 1, lambda: manager.load_graph(NETA_PATH).close()))
+
+    bench.fresh_cache()
+    net = manager.load_graph(NETA_PATH)
+    rng = np.random.default_rng(0)
+    findings = random_findings(net, inputs, 500, rng)
+
+    if wanted('enter_finding'):
+        # one finding at a time, replacing the node's previous finding
+        def enter():
+            for finding in findings:
+                net.enter_findings(finding)
+        results.append(bench.time('enter_finding', len(findings), enter, setup=net.retract_all))
+
+    if wanted('get_stats'):
+        # change one finding, then the mean/std of every output node, which needs a propagation
+        def stats():
+            for finding in findings:
+                net.enter_findings(finding)
+                get_node_stats(net, outputs)
+        results.append(bench.time('get_stats', len(findings), stats, setup=net.retract_all))
+
+    if wanted('get_stats_unchanged'):
+        # the same, without changing any findings in between, so only the wrapper's own overhead is measured
+        get_node_stats(net, outputs)
+        results.append(bench.time('get_stats_unchanged', 100, lambda: [get_node_stats(net, outputs) for _ in range(100)]))
+
+    net.close()
+    manager.close()
+
+    if wanted('discharge_parse') or wanted('discharge_load'):
+        from discharge_lookup import DischargeTable, DISCHARGE_WORKBOOK
+        workbook = join(REPO_DIR, DISCHARGE_WORKBOOK)
+        if wanted('discharge_parse'):
+            results.append(bench.time('discharge_parse', 1, lambda: DischargeTable.from_workbook(workbook)))
+        if wanted('discharge_load'):
+            bench.fresh_cache()
+            DischargeTable.load(workbook)
+            results.append(bench.time('discharge_load', 1, lambda: DischargeTable.load(workbook)))
+
+    for name, args in (('limpopo.py', []), ('limpopo_27_subbasin.py', ['--no-cache']), ('mara.py', [])):
+        if wanted(name):
+            results.append(bench.script(name, args))
+
+    return results
+
+
+def compare(results:list[dict], baseline:dict, max_slowdown:float) -> list[str]:
+    """print each benchmark's median time and api calls against the baseline, and return the names of those slower than `max_slowdown`"""
+    base = {r['name']: r for r in baseline['results']}
+    regressions = []
+    print(f"\n{'benchmark':<26} {'baseline':>12} {'now':>12} {'ratio':>7}  calls/op (baseline -> now)")
+    for r in results:
+        b = base.get(r['name'])
+        if b is None or r['error'] or b['error']:
+            continue
+        ratio = r['median_seconds'] / b['median_seconds'] if b['median_seconds'] > 0 else float('nan')
+        calls = ''
+        if r['calls'] is not None and b['calls'] is not None:
+            calls = f"{sum(b['calls'].values()):.1f} -> {sum(r['calls'].values()):.1f}"
+        flag = ' SLOWER' if ratio > max_slowdown else ''
+        print(f"{r['name']:<26} {b['median_seconds']*1e3:>10.2f}ms {r['median_seconds']*1e3:>10.2f}ms {ratio:>7.2f}  {calls}{flag}")
+        if flag:
+            regressions.append(r['name'])
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the netica wrapper and the scenario scripts, against netica or a stand-in for it')
+    parser.add_argument('--backend', choices=['auto', 'fake', 'netica'], default='auto', help='auto uses netica if NeticaPy is installed, and otherwise the stand-in')
+    parser.add_argument('--size', choices=list(SIZES), default='small', help="size of the stand-in's networks (default: small)")
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each benchmark, the median is reported (default: 5)')
+    parser.add_argument('--script-repeat', type=int, default=1, help='runs of each end to end script (default: 1)')
+    parser.add_argument('--only', nargs='+', help='names of the benchmarks to run')
+    parser.add_argument('--save', nargs='?', const='', help='save the results as json (default path: benchmarks/baselines/<backend>-<size>.json)')
+    parser.add_argument('--compare', help='baseline json to compare against')
+    parser.add_argument('--max-slowdown', type=float, default=1.25, help='with --compare, exit with an error if a benchmark is slower than this ratio (default: 1.25)')
+    args = parser.parse_args()
+
+    backend = args.backend
+    if backend == 'auto':
+        backend = 'netica' if importlib.util.find_spec('NeticaPy') is not None else 'fake'
+    if backend == 'fake':
+        sys.path.insert(0, FAKE_DIR)
+        os.environ.update({key: str(value) for key, value in SIZES[args.size].items()})
+    sys.path.insert(1, REPO_DIR)
+
+    bench = Bench(backend, args.repeat, args.script_repeat)
+    os.environ['PROBFLO_CACHE_DIR'] = join(bench.cache_root, 'cache')
+    os.chdir(REPO_DIR)
+    try:
+        results = [r.summary() for r in run_benchmarks(bench, set(args.only) if args.only else None)]
+    finally:
+        shutil.rmtree(bench.cache_root, ignore_errors=True)
+
+    print(f"{'benchmark':<26} {'median':>12} {'per op':>12} {'calls/op':>9}")
+    for r in results:
+        if r['error']:
+            print(f"{r['name']:<26} failed: {r['error']}")
+            continue
+        calls = f"{sum(r['calls'].values()):.1f}" if r['calls'] is not None else '-'
+        print(f"{r['name']:<26} {r['median_seconds']*1e3:>10.2f}ms {r['microseconds_per_op']:>10.1f}us {calls:>9}")
+
+    report = {
+        'backend': backend,
+        'size': SIZES[args.size] if backend == 'fake' else None,
+        'repeat': args.repeat,
+        'script_repeat': args.script_repeat,
+        'python': platform.python_version(),
+        'machine': platform.platform(),
+        'processor': platform.processor(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+
+    if args.save is not None:
+        path = args.save or join(BASELINE_DIR, f"{backend}-{args.size if backend == 'fake' else 'netica'}.json")
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'saved results to {path}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if (baseline['backend'], baseline['size']) != (report['backend'], report['size']):
+            print(f"WARNING: the baseline was run with the {baseline['backend']} backend (size {baseline['size']}), not {backend} (size {report['size']})")
+        regressions = compare(results, baseline, args.max_slowdown)
+        if regressions:
+            raise SystemExit(f"{len(regressions)} benchmarks are more than {args.max_slowdown}x slower than the baseline: {', '.join(regressions)}")
+
+
+if __name__ == '__main__':
+    main()
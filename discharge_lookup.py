@@ -1,116 +1,142 @@
 
 
+from __future__ import annotations
 import openpyxl
+import os
+import numpy as np
 import pandas as pd
+from dataclasses import dataclass
 from functools import cache
-from netica import NeticaGraph
+from netica import NeticaGraph, CACHE_DIR, file_hash
+from matching import match_names
 
 
 
-@cache
-def max_contiguous_alignment_score(A:str, B:str) -> int:
-    """
-    Determine the maximum amount of overlap between two strings
-    
-    Used to determine what site the blocks map to in the discharge ranges spreadsheet
-    """
-    if len(A) > len(B):
-        A, B = B, A
-    get_score = lambda A,B: sum(1 for a,b in zip(A, B) if a == b)
-    scores = [get_score(A, B[shift:]) for shift in range(len(B) - len(A) + 1)]
-    return max(scores)
-
 @cache
 def get_varname_map(varnames:tuple[str,...], sites:tuple[str,...], strip=True) -> dict[str, str]:
     """
     map from site name to the variable name used by the discharge ranges spreadsheet
     """
+    matches = match_names(list(varnames), list(sites), strip=strip)
+
     var_name_map = {}
-    for var in varnames:
-        #compare the variable name to each site
-        if strip:
-            scores = [max_contiguous_alignment_score(site.strip(), var.strip()) for site in sites]
-        else:
-            scores = [max_contiguous_alignment_score(site, var) for site in sites]
-
-        #determine which site matched best
-        i, score = max(enumerate(scores), key=lambda x: x[1])
+    for var, i, match_percent in zip(varnames, matches.best.tolist(), matches.match_percent.tolist()):
         best_site = sites[i]
 
-        match_percent = score / len(best_site.strip() if strip else best_site)
-
         assert match_percent > 0.8, f"No good match for '{var}' in possible sites: {sites}"
 
         if match_percent < 1:
             print(f"Warning: '{var}' is only a {match_percent:.0%} match for site '{best_site}'")
+        if var in matches.ambiguous:
+            print(f"Warning: '{var}' matches sites {matches.ambiguous[var]} equally well, using '{best_site}'")
 
         # print(f"'{var}' -> '{best_site}'")
         var_name_map[best_site] = var
 
+    for site, claimants in matches.conflicts.items():
+        print(f"Warning: site '{site}' is the best match for each of {claimants}, using '{var_name_map[site]}'")
+
     return var_name_map
 
 
 
-@cache
-def get_discharge_scenario_data():
+# the discharge scenario workbook, and the worksheet with the per-site discharge ranks
+DISCHARGE_WORKBOOK = "neta/limpopo_27_subbasin/2023-04-03_Discharge_ranges_for_WM.xlsx"
+DISCHARGE_SHEET = "MEDIAN RANKS " #TODO: sheet name has a space at the end...
 
-    # load the official list of site names
-    file_map_df = pd.read_csv('neta/limpopo_27_subbasin/risk_region_mapping.csv')
-    sites: list[str] = file_map_df['Site'].tolist()
 
+@dataclass
+class DischargeTable:
+    """
+    the discharge ranks from the workbook, as a dense table
 
-    # Load the discharge scenario workbook and select the worksheet
-    file_path = "neta/limpopo_27_subbasin/2023-04-03_Discharge_ranges_for_WM.xlsx"
-    workbook = openpyxl.load_workbook(file_path, data_only=True)
-    sheet = workbook["MEDIAN RANKS "] #TODO: sheet name has a space at the end...
+    values[i, j, k] is the rank of variables[k] under scenarios[j] for the site titled subbasins[i]
+    """
+    subbasins: np.ndarray  # [n_subbasins] str, block titles as they appear in the workbook
+    scenarios: np.ndarray  # [n_scenarios] str
+    variables: np.ndarray  # [n_variables] str
+    values: np.ndarray     # [n_subbasins, n_scenarios, n_variables] int
+
+    FIELDS = ('subbasins', 'scenarios', 'variables', 'values')
+    VERSION = 1
+
+    @classmethod
+    def from_workbook(cls, path:str=DISCHARGE_WORKBOOK, sheet_name:str=DISCHARGE_SHEET) -> "DischargeTable":
+        """
+        parse the worksheet in a single read-only pass over its rows
+
+        Row 1 holds the site titles, merged across each block of columns, row 2 the variable names, and the following rows
+        one scenario each, named in column A. Blocks of 4 variables start at column B and are separated by an empty column
+        """
+        workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            rows = [list(row) for row in workbook[sheet_name].iter_rows(values_only=True)]
+        finally:
+            workbook.close()
+
+        titles, header, scenario_rows = rows[0], rows[1], [row for row in rows[2:] if row and row[0] is not None]
+
+        # read-only mode only gives the value of a merged cell in its top left cell, so carry titles across their block
+        for col in range(1, len(titles)):
+            if titles[col] is None and header[col] is not None:
+                titles[col] = titles[col - 1]
+
+        starts = [col for col in range(1, len(header)) if header[col] is not None and (col == 1 or header[col - 1] is None)]
+        variables = header[starts[0]:starts[0] + 4]
+        for col in starts:
+            assert header[col:col + 4] == variables, f"Unexpected variables {header[col:col + 4]} in block starting at column {col + 1}"
+
+        values = np.array([[row[col:col + 4] for row in scenario_rows] for col in starts], dtype=np.int64)
+        return cls(
+            subbasins=np.array([titles[col] for col in starts], dtype=str),
+            scenarios=np.array([row[0] for row in scenario_rows], dtype=str),
+            variables=np.array(variables, dtype=str),
+            values=values,
+        )
+
+    @classmethod
+    def sidecar_path(cls, path:str) -> str:
+        return os.path.join(CACHE_DIR, 'discharge', f'{file_hash(path)}.v{cls.VERSION}.npz')
+
+    @classmethod
+    def load(cls, path:str=DISCHARGE_WORKBOOK) -> "DischargeTable":
+        """load the table from its sidecar cache, parsing (and caching) the workbook if it has changed or hasn't been seen before"""
+        sidecar = cls.sidecar_path(path)
+        try:
+            with np.load(sidecar, allow_pickle=False) as data:
+                return cls(**{name: data[name] for name in cls.FIELDS})
+        except (OSError, KeyError, ValueError):
+            pass
+
+        print('Collecting Discharge Scenario Data...')
+        table = cls.from_workbook(path)
+        try:
+            os.makedirs(os.path.dirname(sidecar), exist_ok=True)
+            tmp_path = f'{sidecar}.{os.getpid()}.tmp.npz'
+            np.savez(tmp_path, **{name: getattr(table, name) for name in cls.FIELDS})
+            os.replace(tmp_path, sidecar)
+        except OSError as e:
+            print(f"WARNING: could not cache discharge data to {sidecar}: {e}")
+        return table
 
-    # Define the row indices for each scenario
-    NATURAL_ROW = 3
-    PRESENT_ROW = 4
-    E_FLOW_ROW = 5
-    FUTURE_ROW = 6
-    # scenarios = ['NATURAL', 'PRESENT', 'E-FLOW', 'FUTURE']
-    variables = ['DISCHARGE_YR', 'DISCHARGE_LF', 'DISCHARGE_HF', 'DISCHARGE_FD']
 
-    # Define starting column index (B is column index 2)
-    starting_column = 2
+@cache
+def get_discharge_scenario_data():
 
-    # Define the column ranges for the data blocks
-    data_blocks = [(starting_column, starting_column + 3), (starting_column + 5, starting_column + 8), (starting_column + 10, starting_column + 13)]
-    last_column = starting_column + 133 #last column based on how much data is expected in the sheet
+    # load the official list of site names
+    file_map_df = pd.read_csv('neta/limpopo_27_subbasin/risk_region_mapping.csv')
+    sites: list[str] = file_map_df['Site'].tolist()
 
-    print('Collecting Discharge Scenario Data...')
+    table = DischargeTable.load()
+    subbasins = table.subbasins.tolist()
+    variables = table.variables.tolist()
 
-    # Initialize the variables
-    subbasins = []
+    # scenario -> subbasin -> variable -> rank
     discharge_values = {
-        "NATURAL": {},
-        "PRESENT": {},
-        "E-FLOW": {},
-        "FUTURE": {},
+        scenario: {subbasin: dict(zip(variables, table.values[i, j].tolist())) for i, subbasin in enumerate(subbasins)}
+        for j, scenario in enumerate(table.scenarios.tolist())
     }
 
-    # Loop through the columns and extract the titles and values
-    for col_start in range(starting_column, last_column, 5):
-        col_end = col_start + 3
-        data_blocks.append((col_start, col_end))
-
-        # Extract the titles (merged cells)
-        target_cell_address = sheet.cell(row=1, column=col_start).coordinate
-        for merged_cell_range in sheet.merged_cells.ranges:
-            if target_cell_address in merged_cell_range:
-                top_left_cell_address = merged_cell_range.coord.split(':')[0]
-                subbasin = sheet[top_left_cell_address].value
-                subbasins.append(subbasin)
-                break
-
-        # Extract the values for each scenario's row
-        discharge_values['NATURAL'][subbasin] = dict(zip(variables, tuple(sheet.cell(row=NATURAL_ROW, column=col).value for col in range(col_start, col_end + 1))))
-        discharge_values['PRESENT'][subbasin] = dict(zip(variables, tuple(sheet.cell(row=PRESENT_ROW, column=col).value for col in range(col_start, col_end + 1))))
-        discharge_values['E-FLOW'][subbasin]  = dict(zip(variables, tuple(sheet.cell(row=E_FLOW_ROW, column=col).value for col in range(col_start, col_end + 1))))
-        discharge_values['FUTURE'][subbasin]  = dict(zip(variables, tuple(sheet.cell(row=FUTURE_ROW, column=col).value for col in range(col_start, col_end + 1))))
-
-
     # Create a map from site name to the variable name used by the discharge ranges spreadsheet
     varname_map = get_varname_map(tuple(subbasins), tuple(sites), strip=False)
 
@@ -120,14 +146,20 @@ def get_discharge_scenario_data():
 
 
 
-def update_net_discharge_scenario(site:str, net:NeticaGraph, scenario:str):
+def get_discharge_findings(site:str, scenario:str) -> dict[str, int]:
     '''
-    Update all net variables for the given discharge scenario at the particular site specified
+    Get the discharge node findings for the given discharge scenario at the particular site specified
     '''
     varname_map, discharge_values = get_discharge_scenario_data()
 
     assert site in varname_map, f"Site '{site}' not found in varname_map"
     assert scenario in discharge_values, f"Value '{scenario}' not a valid discharge scenario. Expected one of {', '.join(discharge_values.keys())}"
 
-    for node, value in discharge_values[scenario][varname_map[site]].items():
-        net.enter_finding(node, value, retract=True, verbose=True)
+    return dict(discharge_values[scenario][varname_map[site]])
+
+
+def update_net_discharge_scenario(site:str, net:NeticaGraph, scenario:str):
+    '''
+    Update all net variables for the given discharge scenario at the particular site specified
+    '''
+    net.enter_findings(get_discharge_findings(site, scenario), verbose=True)
@@ -0,0 +1,278 @@
+"""
+Choosing the elimination order a network is compiled with.
+
+Netica builds its junction tree by eliminating the nodes of the moral graph one at a time, and the order determines the size
+of the cliques, and so the memory and propagation time of the compiled net. The min-fill, min-weight and min-neighbors heuristics,
+plus randomized restarts of each, are tried on the moral graph, and the order with the smallest total clique table size is kept.
+The first time a network is compiled, it is compiled with both netica's own order and the searched one, and whichever gives
+the smaller junction tree (by SizeCompiledNet_bn) is kept.
+The choice is cached per .neta file hash, so the search and the comparison only run the first time a network is seen (or a
+larger search is asked for).
+
+Usage:
+    python elimination.py neta/limpopo_27_subbasin/*.neta [--restarts 20] [--compare-default]
+"""
+
+from __future__ import annotations
+from netica import NeticaManager, NetMetadata, CACHE_DIR, N, file_hash, set_elimination_order
+from dataclasses import dataclass, asdict
+from typing import Callable
+import argparse
+import heapq
+import json
+import os
+import numpy as np
+
+
+Cost = Callable[[int, set[int], dict[int, set[int]], np.ndarray], tuple]
+
+
+def min_fill(v:int, nbrs:set[int], neighbors:dict[int, set[int]], cards:np.ndarray) -> tuple:
+    """number of edges added by eliminating v, breaking ties by the size of the resulting clique"""
+    return fill_in(nbrs, neighbors), clique_size(v, nbrs, cards)
+
+def min_weight(v:int, nbrs:set[int], neighbors:dict[int, set[int]], cards:np.ndarray) -> tuple:
+    """size of the clique created by eliminating v, breaking ties by fill-in"""
+    return clique_size(v, nbrs, cards), fill_in(nbrs, neighbors)
+
+def min_neighbors(v:int, nbrs:set[int], neighbors:dict[int, set[int]], cards:np.ndarray) -> tuple:
+    """number of neighbors of v, breaking ties by the size of the resulting clique"""
+    return len(nbrs), clique_size(v, nbrs, cards)
+
+HEURISTICS: dict[str, Cost] = {'min_fill': min_fill, 'min_weight': min_weight, 'min_neighbors': min_neighbors}
+
+# randomized restarts per heuristic of the search run the first time a network is seen (about a second for the larger networks)
+DEFAULT_RESTARTS = 20
+
+# costs that only depend on a node's own neighbors, so that eliminating a node only changes the costs of its neighbors.
+# Other costs (those using fill-in, even as a tie break) also depend on the edges between the neighbors, so the neighbors of the
+# neighbors are updated too
+LOCAL_COSTS = {min_neighbors}
+
+
+def fill_in(nbrs:set[int], neighbors:dict[int, set[int]]) -> int:
+    nbrs = list(nbrs)
+    return sum(1 for a in range(len(nbrs)) for b in range(a + 1, len(nbrs)) if nbrs[b] not in neighbors[nbrs[a]])
+
+def clique_size(v:int, nbrs:set[int], cards:np.ndarray) -> float:
+    return float(np.prod([cards[u] for u in nbrs], dtype=np.float64) * cards[v])
+
+
+def moral_graph(meta:NetMetadata) -> dict[int, set[int]]:
+    """undirected moral graph of a network: each node is connected to its parents, children and co-parents"""
+    neighbors = {i: set() for i in range(len(meta))}
+    for i in range(len(meta)):
+        family = [*meta.get_parents(i).tolist(), i]
+        for a in family:
+            neighbors[a].update(f for f in family if f != a)
+    return neighbors
+
+
+def node_cards(meta:NetMetadata) -> np.ndarray:
+    """number of states of each node, counting continuous (0 state) nodes as 1"""
+    return np.maximum(meta.num_states.astype(np.float64), 1)
+
+
+def greedy_order(neighbors:dict[int, set[int]], cards:np.ndarray, cost:Cost, rng:np.random.Generator|None=None, *, candidates:int=3) -> list[int]:
+    """
+    eliminate nodes one at a time, each time choosing the node with the lowest `cost`
+
+    With `rng`, the node is instead picked at random from the `candidates` lowest cost nodes, for randomized restarts.
+    Costs are kept in a heap, and after each elimination only the costs of the nodes it can affect are recomputed
+    """
+    neighbors = {v: set(nbrs) for v, nbrs in neighbors.items()}
+    # heap of (cost, node, version). Updating a cost pushes a new entry, and entries with an older version than versions[node] are skipped
+    versions = dict.fromkeys(neighbors, 0)
+    heap = [(cost(v, nbrs, neighbors, cards), v, 0) for v, nbrs in neighbors.items()]
+    heapq.heapify(heap)
+
+    order = []
+    while neighbors:
+        lowest = []
+        while heap and len(lowest) < (1 if rng is None else candidates):
+            entry = heapq.heappop(heap)
+            if entry[1] in neighbors and entry[2] == versions[entry[1]]:
+                lowest.append(entry)
+        pick = 0 if rng is None else int(rng.integers(len(lowest)))
+        for entry in lowest[:pick] + lowest[pick + 1:]:
+            heapq.heappush(heap, entry)
+        v = lowest[pick][1]
+
+        nbrs = neighbors.pop(v)
+        for u in nbrs:
+            neighbors[u].update(w for w in nbrs if w != u)
+            neighbors[u].discard(v)
+        order.append(v)
+
+        affected = set(nbrs)
+        if cost not in LOCAL_COSTS:
+            for u in nbrs:
+                affected.update(neighbors[u])
+        for u in affected:
+            versions[u] += 1
+            heapq.heappush(heap, (cost(u, neighbors[u], neighbors, cards), u, versions[u]))
+    return order
+
+
+def order_cliques(neighbors:dict[int, set[int]], order:list[int]) -> list[frozenset[int]]:
+    """the maximal cliques of the junction tree produced by eliminating the nodes in `order`"""
+    neighbors = {v: set(nbrs) for v, nbrs in neighbors.items()}
+    cliques: list[frozenset[int]] = []
+    for v in order:
+        clique = frozenset(neighbors[v] | {v})
+        # v is gone after this step, so only an earlier clique can contain this one
+        if not any(clique <= c for c in cliques):
+            cliques.append(clique)
+        for u in neighbors[v]:
+            neighbors[u].update(w for w in neighbors[v] if w != u)
+            neighbors[u].discard(v)
+        del neighbors[v]
+    return cliques
+
+
+@dataclass
+class EliminationOrder:
+    order: list[str]        # node names, in the order they are eliminated
+    heuristic: str          # the heuristic that produced the order
+    total_size: float       # sum of the clique table sizes (number of entries) of the junction tree
+    max_clique_size: float  # size of the largest clique table
+    num_cliques: int
+    restarts: int = 0       # randomized restarts per heuristic of the search that found it (0 for a single min-fill pass)
+    default_bytes: float|None = None   # compiled size with netica's own order, or None if the two haven't been compared yet
+    compiled_bytes: float|None = None  # compiled size with this order
+
+    VERSION = 2
+
+    @classmethod
+    def evaluate(cls, meta:NetMetadata, order:list[int], heuristic:str) -> "EliminationOrder":
+        cliques = order_cliques(moral_graph(meta), order)
+        cards = node_cards(meta)
+        sizes = [float(np.prod(cards[list(c)], dtype=np.float64)) for c in cliques]
+        return cls(
+            order=[str(meta.node_names[v]) for v in order],
+            heuristic=heuristic,
+            total_size=float(sum(sizes)),
+            max_clique_size=max(sizes, default=0.0),
+            num_cliques=len(cliques),
+        )
+
+    @classmethod
+    def optimize(cls, meta:NetMetadata, *, restarts:int=0, seed:int=0) -> "EliminationOrder":
+        """
+        the min-fill order, or with `restarts`, the order with the smallest total clique size of each heuristic plus `restarts`
+        randomized runs of each
+        """
+        neighbors = moral_graph(meta)
+        cards = node_cards(meta)
+        rng = np.random.default_rng(seed)
+
+        best = None
+        heuristics = HEURISTICS if restarts > 0 else {'min_fill': min_fill}
+        for name, cost in heuristics.items():
+            runs = [(name, greedy_order(neighbors, cards, cost))]
+            runs.extend((f'{name} (randomized)', greedy_order(neighbors, cards, cost, rng)) for _ in range(restarts))
+            for heuristic, order in runs:
+                candidate = cls.evaluate(meta, order, heuristic)
+                if best is None or candidate.total_size < best.total_size:
+                    best = candidate
+        best.restarts = restarts
+        return best
+
+    @classmethod
+    def cache_path(cls, neta_path:str) -> str:
+        return os.path.join(CACHE_DIR, 'elimination', f'{file_hash(neta_path)}.v{cls.VERSION}.json')
+
+    @classmethod
+    def load_cached(cls, neta_path:str) -> "EliminationOrder|None":
+        try:
+            with open(cls.cache_path(neta_path)) as f:
+                return cls(**json.load(f))
+        except (OSError, TypeError, ValueError):
+            return None
+
+    def save_cached(self, neta_path:str):
+        path = self.cache_path(neta_path)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(asdict(self), f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"WARNING: could not save elimination order to {path}: {e}")
+
+
+def get_elimination_order(neta_path:str, meta:NetMetadata, *, restarts:int=DEFAULT_RESTARTS) -> EliminationOrder:
+    """
+    the elimination order for a .neta file, searched for and cached the first time the file is seen, or when the cached order
+    came from a smaller search than `restarts` asks for
+    """
+    cached = EliminationOrder.load_cached(neta_path)
+    if cached is not None and cached.restarts >= restarts and sorted(cached.order) == sorted(meta.node_names.tolist()):
+        return cached
+    best = EliminationOrder.optimize(meta, restarts=restarts)
+    best.save_cached(neta_path)
+    return best
+
+
+def compile_with_order(net, nodes:list, meta:NetMetadata, neta_path:str, elimination:EliminationOrder) -> EliminationOrder:
+    """
+    compile `net` (read from `neta_path`, with `nodes` in the order of `meta`) with `elimination`, or the first time, with whichever of
+    `elimination` and netica's own order gives the smaller junction tree. Returns the order the net was compiled with, which is cached
+    """
+    if elimination.default_bytes is not None:
+        set_elimination_order(net, [nodes[meta.name_index[name]] for name in elimination.order])
+        N.CompileNet_bn(net)
+        return elimination
+
+    N.CompileNet_bn(net)
+    default_bytes = N.SizeCompiledNet_bn(net, 0)
+    default_nodes = N.GetNetElimOrder_bn(net)
+    default_order = [meta.name_index[N.GetNodeName_bn(N.NthNode_bn(default_nodes, i)).decode('utf-8')] for i in range(N.LengthNodeList_bn(default_nodes))]
+
+    N.UncompileNet_bn(net)
+    set_elimination_order(net, [nodes[meta.name_index[name]] for name in elimination.order])
+    N.CompileNet_bn(net)
+    elimination.default_bytes = default_bytes
+    elimination.compiled_bytes = N.SizeCompiledNet_bn(net, 0)
+
+    if elimination.compiled_bytes >= default_bytes and sorted(default_order) == list(range(len(meta))):
+        # netica's own order is at least as good, so compile with it again, and keep it as this file's order
+        N.UncompileNet_bn(net)
+        set_elimination_order(net, [nodes[i] for i in default_order])
+        N.CompileNet_bn(net)
+        netica_order = EliminationOrder.evaluate(meta, default_order, 'netica')
+        netica_order.restarts, netica_order.default_bytes, netica_order.compiled_bytes = elimination.restarts, default_bytes, default_bytes
+        elimination = netica_order
+
+    elimination.save_cached(neta_path)
+    return elimination
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report the junction tree size and compile time of networks compiled with an optimized elimination order')
+    parser.add_argument('neta', nargs='+', help='paths to .neta files')
+    parser.add_argument('--restarts', type=int, default=DEFAULT_RESTARTS, help=f'randomized restarts per heuristic (default: {DEFAULT_RESTARTS})')
+    parser.add_argument('--compare-default', action='store_true', help="also compile each net with netica's default order")
+    args = parser.parse_args()
+
+    managers = {'optimized': NeticaManager(elimination_restarts=args.restarts)}
+    if args.compare_default:
+        managers['default'] = NeticaManager(optimize_elimination=False)
+
+    for path in args.neta:
+        for label, manager in managers.items():
+            graph = manager.load_graph(path)
+            report = graph.compile_report
+            line = f"{path} [{label}]: {report['compiled_bytes'] / 1e6:.2f} MB junction tree, compiled in {report['compile_seconds'] * 1e3:.1f} ms"
+            if report.get('order_seconds') is not None:
+                line += f" (plus {report['order_seconds'] * 1e3:.1f} ms to find the order)"
+            if report.get('heuristic') is not None:
+                line += f", {report['heuristic']} order with {report['num_cliques']} cliques, {report['total_size']:.0f} table entries (largest {report['max_clique_size']:.0f})"
+                line += f", {report['default_bytes'] / 1e6:.2f} MB with netica's own order"
+            print(line)
+            graph.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Loading of the gridded shape csvs (see `shapes/`), and mapping of per-site results onto their grid cells.
+
+The shape csvs carry hundreds of HydroATLAS columns, but the scenarios only need a few. `load_grid` reads just those columns with
+fixed dtypes, and caches them in a binary .npz that is rebuilt whenever the source csv changes.
+"""
+
+from __future__ import annotations
+from netica import CACHE_DIR
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+
+from os.path import join
+
+
+# columns needed to place results on the grid
+GRID_COLUMNS = {'latitude': np.float64, 'longitude': np.float64}
+
+
+def load_grid(path:str, columns:dict[str, type]) -> dict[str, np.ndarray]:
+    """
+    load the given columns (name -> dtype, use `str` for text) of a grid csv as numpy arrays
+
+    The columns are cached in CACHE_DIR/grids, keyed by the csv path and requested columns, and invalidated by the csv's size and modification time
+    """
+    stat = os.stat(path)
+    source = {'path': os.path.realpath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    spec = json.dumps({name: np.dtype(dtype).str for name, dtype in columns.items()}, sort_keys=True)
+    key = hashlib.sha256(f"{source['path']}\n{spec}".encode()).hexdigest()[:16]
+    cache_path = join(CACHE_DIR, 'grids', f'{os.path.splitext(os.path.basename(path))[0]}-{key}.npz')
+
+    try:
+        with np.load(cache_path, allow_pickle=False) as data:
+            if json.loads(str(data['__source__'])) == source:
+                return {name: data[name] for name in columns}
+    except (OSError, KeyError, ValueError):
+        pass
+
+    df = pd.read_csv(path, usecols=list(columns), dtype={name: (object if dtype is str else dtype) for name, dtype in columns.items()})
+    grid = {name: (df[name].fillna('').to_numpy(dtype=str) if dtype is str else df[name].to_numpy()) for name, dtype in columns.items()}
+
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, __source__=np.array(json.dumps(source)), **grid)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"WARNING: could not cache grid columns to {cache_path}: {e}")
+
+    return grid
+
+
+def site_index(cell_sites:np.ndarray, sites:list[str]) -> np.ndarray:
+    """for each grid cell, the index into `sites` of the site it belongs to, or -1 if its site is not listed"""
+    return pd.Index(sites).get_indexer(cell_sites)
+
+
+def grid_frame(grid:dict[str, np.ndarray], site_column:str, results:pd.DataFrame, *, sites:list[str]|None=None, rows:np.ndarray|None=None, year:int, country:str, catchment:str) -> pd.DataFrame:
+    """
+    one row per grid cell: [Year, latitude, longitude, Country, Catchment, RR, *results.columns]
+
+    If `sites` is given, `results` has one row per site, and each cell gets the row of the site named by its `site_column`.
+    Cells whose site has no results are dropped. If `rows` is given, it is the row of `results` for each cell (-1 drops the cell).
+    Otherwise `results` has a single row, which is given to every cell. RR is the cell's `site_column` value.
+    """
+    if rows is not None:
+        rows = np.asarray(rows, dtype=np.int64)
+    elif sites is None:
+        rows = np.zeros(len(grid[site_column]), dtype=np.int64)
+    else:
+        rows = site_index(grid[site_column], sites)
+    keep = np.flatnonzero(rows >= 0)
+    rows = rows[keep]
+
+    df = pd.DataFrame({
+        'Year': np.full(len(keep), year),
+        'latitude': grid['latitude'][keep],
+        'longitude': grid['longitude'][keep],
+        'Country': np.full(len(keep), country, dtype=object),
+        'Catchment': np.full(len(keep), catchment, dtype=object),
+        'RR': grid[site_column][keep].astype(object),
+    })
+    values = results.to_numpy()[rows]
+    return pd.concat([df, pd.DataFrame(values, columns=results.columns).astype(results.dtypes.to_dict())], axis=1)
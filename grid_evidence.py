@@ -0,0 +1,145 @@
+"""
+Per grid cell results, with findings taken from the attributes of each cell of a shape csv (e.g. the HydroATLAS discharge columns).
+
+Rules map cell attributes to node findings. Cells that end up with the same findings share a single inference: the distinct
+evidence vectors are found with np.unique, each runs once against the net (ordered so that few findings change between runs),
+and the results are scattered back to the cells. The cost is the number of distinct combinations, not the number of cells.
+
+A rules file looks like:
+{
+    "findings": {"WQ_ECOSYSTEM": "High", "DOM_WAT_GRO": "Zero"},
+    "rules": {
+        "DISCHARGE_LF": {"column": "dis_m3_pmn", "divide_by": "dis_m3_pyr", "scale": 100},
+        "LANDUSE_SSUP": {"column": "crp_pc_use", "edges": [0, 10, 50, 100], "states": ["Low", "Med", "High"]},
+        "WQ_PEOPLE": {"column": "some_text_column", "map": {"urban": "High", "rural": "Low"}}
+    }
+}
+"findings" are entered for every cell, in the same format as the scenario configs, and rules override them cell by cell.
+A numeric rule's value (the column, optionally divided by another column, times `scale`) is placed in the node's own bins,
+clipped to their range, unless `edges` and `states` are given, in which case values outside the edges leave the node at its
+base finding. A `map` rule looks up the cell's text, and text missing from the map likewise leaves the node at its base finding.
+
+Usage:
+    python grid_evidence.py configs/limpopo_grid.json [--neta neta/limpopo.neta] [--shape shapes/limpopo_0.1degree.csv] [--output results/limpopo_grid.csv]
+"""
+
+from __future__ import annotations
+from netica import NeticaManager, NeticaGraph, NeticaNode
+from stats import get_bin_edges, histogram_stats
+from grid import load_grid, grid_frame, GRID_COLUMNS
+from sweep import min_change_order
+from limpopo_common import output_nodes as limpopo_output_nodes
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+
+
+# code for a node that a rule leaves at its base finding (matches the -1 `discretize` gives NaN values)
+UNSET = -1
+
+
+def rule_columns(rules:dict[str, dict]) -> dict[str, type]:
+    """the grid columns (name -> dtype) that the rules read"""
+    columns = {}
+    for rule in rules.values():
+        columns[rule['column']] = str if 'map' in rule else np.float64
+        if 'divide_by' in rule:
+            columns[rule['divide_by']] = np.float64
+    return columns
+
+
+def evaluate_rule(net:NeticaGraph, node:str, rule:dict, grid:dict[str, np.ndarray]) -> np.ndarray:
+    """the state of `node` in each cell of the grid under `rule`, or UNSET"""
+    if 'map' in rule:
+        mapping = {text: net.get_node_state(node, state) for text, state in rule['map'].items()}
+        codes, inverse = np.unique(grid[rule['column']], return_inverse=True)
+        return np.array([mapping.get(text, UNSET) for text in codes.tolist()], dtype=np.int64)[inverse.reshape(-1)]
+
+    values = grid[rule['column']].astype(np.float64)
+    if 'divide_by' in rule:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = values / grid[rule['divide_by']]
+    values = values * rule.get('scale', 1.0)
+    # e.g. a ratio with a zero denominator, which would otherwise be clipped into the node's first or last bin
+    values[~np.isfinite(values)] = np.nan
+
+    if 'edges' in rule:
+        edges = np.asarray(rule['edges'], dtype=np.float64)
+        if len(rule['states']) != len(edges) - 1:
+            raise ValueError(f"rule for {node} has {len(edges)} edges, so needs {len(edges) - 1} states, not {len(rule['states'])}")
+        states = np.array([net.get_node_state(node, state) for state in rule['states']] + [UNSET], dtype=np.int64)
+        bins = np.searchsorted(edges, values, side='right') - 1
+        # the last edge closes the last bin
+        bins[values == edges[-1]] = len(edges) - 2
+        bins[(bins < 0) | (bins >= len(edges) - 1) | np.isnan(values)] = -1
+        return states[bins]
+
+    return net.discretize(node, values)
+
+
+def cell_evidence(net:NeticaGraph, rules:dict[str, dict], grid:dict[str, np.ndarray]) -> np.ndarray:
+    """the states [cells, rules] of the rule nodes in each cell, or UNSET"""
+    num_cells = len(next(iter(grid.values())))
+    codes = np.empty((num_cells, len(rules)), dtype=np.int64)
+    for j, (node, rule) in enumerate(rules.items()):
+        codes[:, j] = evaluate_rule(net, node, rule, grid)
+    return codes
+
+
+def run_unique(net:NeticaGraph, nodes:list[str], codes:np.ndarray, output_nodes:list[int|str|NeticaNode]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    run each distinct row of `codes` [cells, nodes] once. Returns the beliefs [n_unique, n_outputs, max_states] of each distinct row,
+    and the index [cells] of each cell's row in them
+    """
+    unique, inverse = np.unique(codes, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    base = [net.findings.get(net.get_node_index(node)) for node in nodes]
+
+    # allocated up front, so that a grid without cells gives an empty array
+    beliefs = np.zeros((len(unique), len(output_nodes), max((net.get_num_node_states(node) for node in output_nodes), default=0)))
+    for i in min_change_order(unique).tolist():
+        net.enter_findings({node: base[j] if state == UNSET else state for j, (node, state) in enumerate(zip(nodes, unique[i].tolist()))})
+        beliefs[i] = net.get_beliefs(output_nodes)
+    return beliefs, inverse
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a network once per distinct combination of grid cell findings, and map the results to every cell')
+    parser.add_argument('rules', help='json file of findings and per cell rules')
+    parser.add_argument('--neta', default='neta/limpopo.neta', help='path to the .neta file (default: neta/limpopo.neta)')
+    parser.add_argument('--shape', default='shapes/limpopo_0.1degree.csv', help='grid csv with the cell attributes (default: shapes/limpopo_0.1degree.csv)')
+    parser.add_argument('--output', default='results/limpopo_grid.csv', help='path of the output csv (default: results/limpopo_grid.csv)')
+    args = parser.parse_args()
+
+    with open(args.rules) as f:
+        spec = json.load(f)
+    rules = spec.get('rules', {})
+
+    grid = load_grid(args.shape, {**GRID_COLUMNS, 'RR': str, **rule_columns(rules)})
+
+    with NeticaManager() as netica:
+        net = netica.new_graph(args.neta, pooled=False)
+        net.enter_findings({key: value for key, value in spec.get('findings', {}).items() if value is not None})
+
+        codes = cell_evidence(net, rules, grid)
+        output_names = list(limpopo_output_nodes)
+        beliefs, rows = run_unique(net, list(rules), codes, output_names)
+        stats = histogram_stats(beliefs, get_bin_edges(net, output_names))
+    print(f'{len(rows)} cells share {len(beliefs)} distinct sets of findings')
+
+    columns = []
+    for output_name in limpopo_output_nodes.values():
+        columns.append(f'{output_name} (Mean)')
+        columns.append(f'{output_name} (Standard Deviation)')
+    results = pd.DataFrame(np.stack([stats['mean'], stats['std']], axis=-1).reshape(len(beliefs), len(columns)), columns=columns)
+
+    df = grid_frame(grid, 'RR', results, rows=rows, year=2022, country='South Africa', catchment='Limpopo')
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    print(f'saving to {args.output}')
+    df.to_csv(args.output, index=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""
+Persistent, content addressed cache of inference results.
+
+Entries are keyed by the sha256 of the .neta file, the canonical form of the complete set of findings
+(see `NetMetadata.evidence_key`), and the node name. Values are the node's belief vector.
+A run that hits the cache for every output node never needs to read or compile the network.
+"""
+
+from __future__ import annotations
+from netica import NeticaManager, NetMetadata, CACHE_DIR, file_hash, pad_beliefs
+from typing import Callable
+import os
+import sqlite3
+import time
+import numpy as np
+
+from os.path import join
+
+
+DEFAULT_PATH = join(CACHE_DIR, 'inference.sqlite')
+
+# approximate storage size of an entry, used for eviction
+ENTRY_SIZE = 'LENGTH(beliefs) + LENGTH(evidence) + LENGTH(node) + 64'
+
+# the running size of the cache is only an estimate (entries may be replaced, and other processes write to the same file),
+# so it is recounted after this many inserts
+RECOUNT_EVERY = 1000
+
+
+class InferenceCache:
+    def __init__(self, path:str=DEFAULT_PATH, *, max_bytes:int=1 << 30):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        # several worker processes may share the same cache file
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS beliefs (
+                net_hash TEXT NOT NULL,
+                evidence TEXT NOT NULL,
+                node TEXT NOT NULL,
+                beliefs BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (net_hash, evidence, node)
+            )
+        ''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS beliefs_last_used ON beliefs (last_used)')
+
+        # running estimate of `size()`, so that inserts don't have to scan the whole table
+        self.approx_bytes = self.size()
+        self.inserts = 0
+
+    def get_node(self, net_hash:str, evidence:str, node:str) -> np.ndarray|None:
+        """get the cached beliefs of a single node, or None on a miss"""
+        found = self.get(net_hash, evidence, [node])
+        return None if found is None else found[0]
+
+    def get(self, net_hash:str, evidence:str, nodes:list[str]) -> list[np.ndarray]|None:
+        """get the cached beliefs of every node in `nodes`, or None unless all of them are cached"""
+        placeholders = ','.join('?' * len(nodes))
+        rows = self.db.execute(
+            f'SELECT node, beliefs FROM beliefs WHERE net_hash = ? AND evidence = ? AND node IN ({placeholders})',
+            (net_hash, evidence, *nodes),
+        ).fetchall()
+        found = {node: np.frombuffer(blob, dtype=np.float64) for node, blob in rows}
+        if len(found) < len(set(nodes)):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.db.execute(
+            f'UPDATE beliefs SET last_used = ? WHERE net_hash = ? AND evidence = ? AND node IN ({placeholders})',
+            (time.time(), net_hash, evidence, *nodes),
+        )
+        return [found[node] for node in nodes]
+
+    def put_node(self, net_hash:str, evidence:str, node:str, beliefs:np.ndarray):
+        self.put(net_hash, evidence, {node: beliefs})
+
+    def put(self, net_hash:str, evidence:str, beliefs:dict[str, np.ndarray]):
+        """store the beliefs of several nodes in one transaction, then evict the least recently used entries if the cache is over its size limit"""
+        now = time.time()
+        rows = [(net_hash, evidence, node, np.asarray(b, dtype=np.float64).tobytes(), now) for node, b in beliefs.items()]
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            self.db.executemany('INSERT OR REPLACE INTO beliefs VALUES (?, ?, ?, ?, ?)', rows)
+            self.db.execute('COMMIT')
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+
+        self.approx_bytes += sum(len(blob) + len(evidence.encode('utf-8')) + len(node.encode('utf-8')) + 64 for _, _, node, blob, _ in rows)
+        self.inserts += len(rows)
+        if self.approx_bytes > self.max_bytes or self.inserts >= RECOUNT_EVERY:
+            self.evict()
+
+    def size(self) -> int:
+        """approximate size in bytes of the cached entries"""
+        return self.db.execute(f'SELECT COALESCE(SUM({ENTRY_SIZE}), 0) FROM beliefs').fetchone()[0]
+
+    def evict(self):
+        """recount the size of the cache, and if it is over max_bytes, delete least recently used entries until it is within 90% of it"""
+        self.approx_bytes = self.size()
+        self.inserts = 0
+        excess = self.approx_bytes - self.max_bytes
+        if excess <= 0:
+            return
+        self.db.execute(f'''
+            DELETE FROM beliefs WHERE rowid IN (
+                SELECT id FROM (
+                    SELECT rowid AS id, SUM({ENTRY_SIZE}) OVER (ORDER BY last_used, rowid) - ({ENTRY_SIZE}) AS freed_before
+                    FROM beliefs
+                ) WHERE freed_before < ?
+            )
+        ''', (excess + self.max_bytes // 10,))
+        self.approx_bytes = self.size()
+
+    def stats(self) -> dict[str, int|float]:
+        entries = self.db.execute('SELECT COUNT(*) FROM beliefs').fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            'entries': entries,
+            'bytes': self.size(),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        self.db.close()
+
+
+_caches: dict[str, InferenceCache] = {}
+def get_cache(path:str=DEFAULT_PATH) -> InferenceCache:
+    """get the InferenceCache for `path`, opened once per process"""
+    if path not in _caches:
+        _caches[path] = InferenceCache(path)
+    return _caches[path]
+
+
+def query(get_manager:Callable[[], NeticaManager], neta_path:str, findings:dict[str, int|str|None], nodes:list[str], *, cache:InferenceCache|None=None, verbose=False) -> tuple[np.ndarray, NetMetadata, bool]:
+    """
+    get the beliefs [n_nodes, max_states] of `nodes` after entering `findings` (on top of those saved in the .neta file).
+    As in the config files, findings that are None leave the node at its default.
+
+    If the network's metadata has been seen before and every node is in `cache`, the network is not loaded at all,
+    and `get_manager` (e.g. `parallel.get_manager`) is never called, so no netica environment is created.
+    Returns (beliefs, metadata, whether it was a cache hit).
+    """
+    findings = {key: value for key, value in findings.items() if value is not None}
+    meta = NetMetadata.load_cached(neta_path)
+    if cache is not None and meta is not None:
+        evidence = meta.evidence_key(meta.resolve_findings(findings))
+        cached = cache.get(file_hash(neta_path), evidence, nodes)
+        if cached is not None:
+            return pad_beliefs(cached), meta, True
+
+    # the graph is pooled, so the cache is written here rather than attached to it as its result_cache
+    with get_manager().new_graph(neta_path) as net:
+        net.enter_findings(findings, verbose=verbose)
+        node_beliefs = [net.get_node_beliefs(node) for node in nodes]
+        if cache is not None and net.net_hash is not None:
+            cache.put(net.net_hash, net.evidence_key(), dict(zip(nodes, node_beliefs)))
+        return pad_beliefs(node_beliefs), net.meta, False
+
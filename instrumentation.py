@@ -0,0 +1,275 @@
+"""
+Opt-in profiling of the netica wrapper and the scenario scripts.
+
+When enabled, the profiler records the latency of:
+- every call into the netica C-API (kind "api", e.g. ReadNet_bn, CompileNet_bn, GetNodeBeliefs_bn which includes any propagation)
+- the main NeticaManager/NeticaGraph methods (kind "method"), along with the part of their time spent outside the C-API
+  and outside the other methods they call (kind "python", i.e. the wrapper's own overhead)
+- the phases of the scenario scripts (kind "phase": config, evidence, inference, stats, merge, write), and the whole of
+  each site's run (phase "site", which contains that site's evidence and inference phases)
+Entries are tagged with the network file and site they ran for. Latencies go into fixed log-spaced buckets (4 per doubling),
+so memory stays constant however many calls are made, percentiles are accurate to within a bucket (~19%), and the profiles
+of worker processes can be merged exactly.
+
+Profiling is off unless the PROBFLO_PROFILE environment variable is set to an output path (or `enable` is called), e.g.
+    PROBFLO_PROFILE=results/profile.json python limpopo_27_subbasin.py --workers 8
+which writes the profile when the script exits: as Prometheus text if the path ends in .prom, and otherwise as json.
+Worker processes inherit the setting, and send their profiles back with their results (see parallel.py).
+"""
+
+from __future__ import annotations
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, Generator
+import atexit
+import json
+import multiprocessing
+import os
+import threading
+import time
+import numpy as np
+
+
+# bucket i holds latencies in [BUCKET_EDGES[i-1], BUCKET_EDGES[i]), from 100ns up to ~30 minutes
+BUCKETS_PER_DOUBLING = 4
+BUCKET_EDGES = 1e-7 * 2.0 ** (np.arange(4 * 34) / BUCKETS_PER_DOUBLING)
+NUM_BUCKETS = len(BUCKET_EDGES) + 1
+
+QUANTILES = (0.5, 0.9, 0.99)
+TAG_NAMES = ('net', 'site')
+
+Key = tuple[str, str, tuple[tuple[str, str], ...]]  # (kind, name, sorted tags)
+
+_tags: ContextVar[tuple[tuple[str, str], ...]] = ContextVar('profile_tags', default=())
+# [seconds in C-API calls, seconds in other timed methods] made directly by the innermost timed method, or None outside of any method
+_inner_seconds: ContextVar[list[float]|None] = ContextVar('profile_inner_seconds', default=None)
+
+
+class Series:
+    """count, total and latency histogram of one kind of call"""
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = np.zeros(NUM_BUCKETS, dtype=np.int64)
+
+    def add(self, seconds:float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[np.searchsorted(BUCKET_EDGES, seconds, side='right')] += 1
+
+    def merge(self, count:int, total:float, max_seconds:float, buckets:list[int]):
+        self.count += count
+        self.total += total
+        self.max = max(self.max, max_seconds)
+        self.buckets += np.asarray(buckets, dtype=np.int64)
+
+    def quantile(self, q:float) -> float:
+        """estimate of a latency quantile: the geometric middle of the bucket it falls in (capped by the largest latency seen)"""
+        if self.count == 0:
+            return float('nan')
+        i = int(np.searchsorted(np.cumsum(self.buckets), q * self.count, side='left'))
+        lower = BUCKET_EDGES[i - 1] if i > 0 else 0.0
+        upper = BUCKET_EDGES[i] if i < len(BUCKET_EDGES) else self.max
+        return float(min(np.sqrt(lower * upper) if lower > 0 else upper / 2, self.max))
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.output_path: str|None = None
+        self.series: dict[Key, Series] = {}
+        # calls may be recorded from several threads at once (e.g. parallel.run_scenarios)
+        self.lock = threading.Lock()
+
+    def record(self, kind:str, name:str, seconds:float):
+        key = (kind, name, _tags.get())
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = Series()
+            series.add(seconds)
+
+    @contextmanager
+    def tags(self, **tags:str|None) -> Generator[None, None, None]:
+        """tag everything recorded inside the block, e.g. with tags(site=site). Tags of enclosing blocks are kept unless overridden"""
+        if not self.enabled:
+            yield
+            return
+        merged = dict(_tags.get())
+        merged.update({key: str(value) for key, value in tags.items() if value is not None})
+        token = _tags.set(tuple(sorted(merged.items())))
+        try:
+            yield
+        finally:
+            _tags.reset(token)
+
+    @contextmanager
+    def phase(self, name:str, **tags:str|None) -> Generator[None, None, None]:
+        """time a phase of a script"""
+        if not self.enabled:
+            yield
+            return
+        with self.tags(**tags):
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.record('phase', name, time.perf_counter() - start)
+
+    def wrap_api(self, name:str, fn:Callable) -> Callable:
+        """wrap a netica api function so that every call is timed"""
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                self.record('api', name, seconds)
+                inner = _inner_seconds.get()
+                if inner is not None:
+                    inner[0] += seconds
+        return timed
+
+    def method(self, name:str, *, tags:Callable[..., dict[str, str|None]]|None=None) -> Callable[[Callable], Callable]:
+        """
+        decorator timing each call of a method, and the part of it not spent in netica api calls or in other timed methods.
+        `tags` is called with the method's arguments, and returns tags for the call (e.g. the network file)
+        """
+        def decorator(fn:Callable) -> Callable:
+            @wraps(fn)
+            def timed(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with self.tags(**(tags(*args, **kwargs) if tags is not None else {})):
+                    inner = [0.0, 0.0]
+                    token = _inner_seconds.set(inner)
+                    start = time.perf_counter()
+                    try:
+                        return fn(*args, **kwargs)
+                    finally:
+                        seconds = time.perf_counter() - start
+                        _inner_seconds.reset(token)
+                        self.record('method', name, seconds)
+                        self.record('python', name, max(seconds - inner[0] - inner[1], 0.0))
+                        outer = _inner_seconds.get()
+                        if outer is not None:
+                            outer[1] += seconds
+            return timed
+        return decorator
+
+    def snapshot(self) -> list[dict]:
+        """the recorded series, as plain data that can be sent between processes, merged with `merge`, or saved"""
+        with self.lock:
+            return [
+                {'kind': kind, 'name': name, 'tags': dict(tags), 'count': s.count, 'total': s.total, 'max': s.max, 'buckets': s.buckets.tolist()}
+                for (kind, name, tags), s in self.series.items()
+            ]
+
+    def merge(self, snapshot:list[dict]):
+        with self.lock:
+            for entry in snapshot:
+                key = (entry['kind'], entry['name'], tuple(sorted(entry['tags'].items())))
+                series = self.series.get(key)
+                if series is None:
+                    series = self.series[key] = Series()
+                series.merge(entry['count'], entry['total'], entry['max'], entry['buckets'])
+
+    def reset(self):
+        with self.lock:
+            self.series.clear()
+
+    def summary(self) -> list[dict]:
+        """one entry per series with its count, total, mean, max and quantile latencies in seconds, largest total first"""
+        out = []
+        for (kind, name, tags), s in sorted(self.series.items(), key=lambda item: -item[1].total):
+            entry = {'kind': kind, 'name': name, 'tags': dict(tags), 'count': s.count, 'total_seconds': s.total, 'mean_seconds': s.total / s.count, 'max_seconds': s.max}
+            entry.update({f'p{round(q * 100)}_seconds': s.quantile(q) for q in QUANTILES})
+            out.append(entry)
+        return out
+
+    def totals(self, kind:str, tag:str|None=None, *, name:str|None=None) -> dict[str, float]:
+        """total seconds of one kind of series (only those called `name`, if given), by name, or by the value of `tag` if given. Largest first"""
+        totals: dict[str, float] = {}
+        for (k, series_name, tags), s in self.series.items():
+            if k == kind and name in (None, series_name):
+                label = series_name if tag is None else dict(tags).get(tag, '')
+                totals[label] = totals.get(label, 0.0) + s.total
+        return dict(sorted(totals.items(), key=lambda item: -item[1]))
+
+    def to_json(self) -> dict:
+        return {
+            'phases': self.totals('phase'),
+            'sites': self.totals('phase', 'site', name='site'),
+            'api_by_net': self.totals('api', 'net'),
+            'series': self.summary(),
+        }
+
+    def to_prometheus(self) -> str:
+        """the series in the prometheus text format, as a summary of latencies (with quantiles) per kind"""
+        lines = []
+        for kind in sorted({kind for kind, _, _ in self.series}):
+            metric = f'probflo_{kind}_seconds'
+            lines.append(f'# HELP {metric} latency of {kind} calls')
+            lines.append(f'# TYPE {metric} summary')
+            for (k, name, tags), s in sorted(self.series.items()):
+                if k != kind:
+                    continue
+                labels = [('name', name), *((tag, dict(tags).get(tag, '')) for tag in TAG_NAMES)]
+                label_text = ','.join(f'{key}="{escape_label(value)}"' for key, value in labels)
+                for q in QUANTILES:
+                    lines.append(f'{metric}{{{label_text},quantile="{q}"}} {s.quantile(q):.9g}')
+                lines.append(f'{metric}_sum{{{label_text}}} {s.total:.9g}')
+                lines.append(f'{metric}_count{{{label_text}}} {s.count}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path:str):
+        """write the profile to `path`, as prometheus text for .prom files, otherwise as json"""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            if path.endswith('.prom'):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.to_json(), f, indent=2)
+
+    def report(self, top:int=10) -> str:
+        """short text summary of where the time went"""
+        lines = ['profile:']
+        for title, totals in (('phases', self.totals('phase')), ('sites', self.totals('phase', 'site', name='site')), ('netica api', self.totals('api')), ('wrapper overhead', self.totals('python'))):
+            if totals:
+                lines.append(f'  {title}: ' + ', '.join(f'{name or "-"} {seconds:.3f}s' for name, seconds in list(totals.items())[:top]))
+        return '\n'.join(lines)
+
+
+def escape_label(value:str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+PROFILER = Profiler()
+
+
+def enable(output_path:str|None=None):
+    """
+    turn profiling on, for this process and any worker processes it starts. If `output_path` is given, the profile is written there when the process exits
+    """
+    PROFILER.enabled = True
+    if output_path:
+        PROFILER.output_path = output_path
+        os.environ['PROBFLO_PROFILE'] = output_path
+
+
+def write_profile():
+    """write the profile of the main process to its output path at exit (workers send theirs to the main process instead)"""
+    if PROFILER.enabled and PROFILER.output_path and multiprocessing.parent_process() is None:
+        PROFILER.export(PROFILER.output_path)
+        print(PROFILER.report())
+        print(f'saved profile to {PROFILER.output_path}')
+
+
+if os.environ.get('PROBFLO_PROFILE'):
+    enable(os.environ['PROBFLO_PROFILE'])
+atexit.register(write_profile)
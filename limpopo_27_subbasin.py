@@ -1,6 +1,12 @@
 from __future__ import annotations
 from netica import NeticaManager, NeticaGraph, NeticaNode
-from discharge_lookup import update_net_discharge_scenario
+from stats import get_bin_edges, histogram_stats, stack_histograms
+from parallel import run_sites, report_failures, get_manager
+from inference_cache import query, get_cache, DEFAULT_PATH as DEFAULT_CACHE_PATH
+from grid import load_grid, grid_frame, GRID_COLUMNS
+from instrumentation import PROFILER
+from limpopo_common import output_nodes, get_site_findings
+import argparse
 import json
 import pandas as pd
 import numpy as np
@@ -9,123 +15,80 @@ from os.path import join
 
 import pdb
 
-# list of nodes to record the state of at the end of the simulation
-# map from the raw name to what the node should be called in the output csv
-output_nodes = {
-    'SUB_VEG_END':  'Maintain plants for livelihoods',
-    'SUB_FISH_END': 'Maintaining fisheries for livelihoods',
-    'LIV_VEG_END':  'Maintain plants for domestic livestock',
-    'DOM_WAT_END':  'Maintain water for domestic use',
-    'FLO_ATT_END':  'Flood attenuation services',
-    'RIV_ASS_END':  'River assimilation capacity',
-    'WAT_DIS_END':  'Maintain water borne diseases',
-    'RES_RES_END':  'Resource resilience',
-    'FISH_ECO_END': 'Maintain fish communities',
-    'VEG_ECO_END':  'Maintain vegetation communities',
-    'INV_ECO_END':  'Maintain invertebrate communities',
-    'REC_SPIR_END': 'Maintain recreation and spiritual act',
-    'TOURISM_END':  'Maintain tourism',
-}
-
-
-# these input nodes need to be retracted before they can be assigned new values
-retract_nodes = {'DISCHARGE_LF', 'DISCHARGE_HF', 'DISCHARGE_YR', 'DISCHARGE_FD'}
-
-# special settings
-special_settings = {'DISCHARGE_SCENARIO': update_net_discharge_scenario}
-
-
-#functions for getting the mean and standard deviation of the output nodes
-def get_stats(node:int|str|NeticaNode, net:NeticaGraph):
-    """Given a histogram of beliefs (Zero, Low, Medium, High), compute mean and std-dev"""
-    #TODO: replace beliefs array with just getting the array of state values via the API
-    #      also need to make the centers use use the correct number of states, and have the correct bounds
-    #      currently it's hardcoded for 4 states (zero, low, medium, high) -> (0, 25, 50, 75, 100)
-    beliefs = np.array([net.get_node_belief(node, i) for i in range(net.get_num_node_states(node))])
-    centers = np.arange(4)*25 + 12.5
-    mean = np.sum(beliefs*centers)
-
-    #hacky standard deviation approximation. Deriving the standard deviation analytically was too difficult
-    samples = 10000
-    x = np.linspace(0,100,samples)
-    y = np.repeat(beliefs, samples//4)
-    std = np.sqrt(np.sum(y*(x-mean)**2)/samples)*2
-
-    return mean, std
+
+def run_site(site:str, neta_path:str, config:dict, cache_path:str|None, share_structure:bool=False) -> tuple[np.ndarray, np.ndarray, bool]:
+    """
+    run the model for a single site, and return the beliefs [nodes, states] and bin edges [nodes, states+1] of the output nodes,
+    and whether the beliefs came from the inference cache (in which case the network was never loaded)
+    """
+    with PROFILER.phase('evidence'):
+        findings = get_site_findings(site, config)
+    cache = get_cache(cache_path) if cache_path else None
+
+    output_names = list(output_nodes)
+    with PROFILER.phase('inference'):
+        beliefs, meta, hit = query(lambda: get_manager(share_structure=share_structure), neta_path, findings, output_names, cache=cache, verbose=True)
+    return beliefs, get_bin_edges(meta, output_names), hit
 
 
 def main():
-    netica = NeticaManager()
-    
+    parser = argparse.ArgumentParser(description='Run the Limpopo model for each of the 27 sites')
+    parser.add_argument('--workers', type=int, default=1, help='number of sites to run in parallel, each in its own process (default: 1)')
+    parser.add_argument('--cache', default=DEFAULT_CACHE_PATH, help=f'path to the inference result cache (default: {DEFAULT_CACHE_PATH})')
+    parser.add_argument('--no-cache', dest='cache', action='store_const', const=None, help='always run the model, without reading or writing the inference cache')
+    parser.add_argument('--share-structure', action='store_true', help='load sites with the same structure as copies of one compiled template (see structure.py)')
+    args = parser.parse_args()
+
     # paths for this scenario
     neta_dir = join('neta', 'limpopo_27_subbasin')
     file_map_path = join(neta_dir, 'risk_region_mapping.csv')
     shape_path = join('shapes', 'limpopo_27_0.1degree.csv')
     output_path = join('results', f'limpopo_27_subbasin.csv')
 
-    # load the filename map and shapefile
-    file_map_df = pd.read_csv(file_map_path)
-    shape = pd.read_csv(shape_path)
-
-    # get the model input settings from the config file
-    with open('configs/limpopo_27_subbasin.json') as f:
-        config = json.load(f)
+    # load the filename map, and get the model input settings from the config file
+    with PROFILER.phase('config'):
+        file_map_df = pd.read_csv(file_map_path)
+        with open('configs/limpopo_27_subbasin.json') as f:
+            config = json.load(f)
 
-    # create a dataframe with [Year, Country, Catchment, Level,*[*output_nodes x ['mean', 'std']]] as the columns, and one row for each site
+    # create a dataframe with [*output_nodes x ['mean', 'std']] as the columns, and one row for each site
     # constant fields for all values
     country = 'South Africa'
     catchment = 'Limpopo'
     year = 2022
 
-    columns = ['Year', 'Country', 'Catchment', 'Site Name']
+    columns = []
     for output_name in output_nodes.values():
         columns.append(f'{output_name} (Mean)')
         columns.append(f'{output_name} (Standard Deviation)')
     
-    # rows to be filled in by running the model
-    rows = []
-    
- 
     # run the model for each site
-    for i, row in file_map_df.iterrows():
-        neta_path = join(neta_dir, row['Netica File'])
-        site = row['Site']
-
-        # load the neta graph for this site
-        net = netica.new_graph(neta_path)
-
-        # set input values from the config file for this site
-        for key, value in config.items():
-
-            if key in special_settings:
-                #config settings that are more complicated than just setting a node value
-                special_settings[key](site, net, value)
-                continue
-
-            if value is not None:
-                # normal set node value in net
-                net.enter_finding(key, value, retract=(key in retract_nodes), verbose=True)
-
-        #generate the dataframe row for this site
-        row = [year, country, catchment, site]
-        for raw_name in output_nodes:
-            #add mean and std
-            row.extend(get_stats(raw_name, net))
-
-        rows.append(row)
-
-    # merge the results with the shapefile
-    results = pd.DataFrame(rows, columns=columns)
-    shape['Year'] = year
-    shape['Country'] = country
-    shape['Catchment'] = catchment
-    shape = shape[['Year','latitude','longitude', 'Country', 'Catchment','Site Name']].copy()
-    merge_on = ['Site Name', 'Country', 'Year', 'Catchment']
-    df = pd.merge(shape, results, left_on=merge_on, right_on=merge_on)
-    df = df.rename(columns={'Site Name': 'RR'})
+    sites = [(row['Site'], (row['Site'], join(neta_dir, row['Netica File']), config, args.cache, args.share_structure)) for _, row in file_map_df.iterrows()]
+    site_results = run_sites(run_site, sites, workers=args.workers)
+    failures = report_failures(site_results)
+
+    #compute the mean and std of every output node of every site at once
+    ok_results = [r for r in site_results if r.ok]
+    with PROFILER.phase('stats'):
+        stats = histogram_stats(*stack_histograms([r.result[:2] for r in ok_results]))
+    if args.cache:
+        print(f'inference cache: {sum(r.result[2] for r in ok_results)} of {len(ok_results)} sites were cache hits')
+
+    #generate the dataframe rows in the same order as the site mapping, with [mean, std] for each output node
+    with PROFILER.phase('merge'):
+        results = pd.DataFrame(np.stack([stats['mean'], stats['std']], axis=-1).reshape(len(ok_results), -1), columns=columns)
+
+        # place each site's results on the grid cells of that site
+        grid = load_grid(shape_path, {**GRID_COLUMNS, 'Site Name': str})
+        df = grid_frame(grid, 'Site Name', results, sites=[r.site for r in ok_results], year=year, country=country, catchment=catchment)
+
     #save to csv
     print(f'saving to {output_path}')
-    df.to_csv(output_path, index=False)
+    with PROFILER.phase('write'):
+        df.to_csv(output_path, index=False)
+
+    if failures:
+        raise SystemExit(f'{len(failures)} of {len(site_results)} sites failed: {", ".join(r.site for r in failures)}')
 
 
 if __name__ == '__main__':
@@ -1,5 +1,12 @@
 from __future__ import annotations
 from netica import NeticaManager, NeticaGraph, NeticaNode
+from stats import get_bin_edges, histogram_stats, stack_histograms
+from parallel import run_sites, report_failures, get_manager
+from inference_cache import query, get_cache, DEFAULT_PATH as DEFAULT_CACHE_PATH
+from grid import load_grid, grid_frame, GRID_COLUMNS
+from instrumentation import PROFILER
+from limpopo_common import output_nodes, subbasins, to_snake_case
+import argparse
 import json
 import pandas as pd
 import numpy as np
@@ -7,111 +14,74 @@ import numpy as np
 from os.path import join
 
 
-# list of nodes to record the state of at the end of the simulation
-# map from the raw name to what the node should be called in the output csv
-output_nodes = {
-    'SUB_VEG_END':  'Maintain plants for livelihoods',
-    'SUB_FISH_END': 'Maintaining fisheries for livelihoods',
-    'LIV_VEG_END':  'Maintain plants for domestic livestock',
-    'DOM_WAT_END':  'Maintain water for domestic use',
-    'FLO_ATT_END':  'Flood attenuation services',
-    'RIV_ASS_END':  'River assimilation capacity',
-    'WAT_DIS_END':  'Maintain water borne diseases',
-    'RES_RES_END':  'Resource resilience',
-    'FISH_ECO_END': 'Maintain fish communities',
-    'VEG_ECO_END':  'Maintain vegetation communities',
-    'INV_ECO_END':  'Maintain invertebrate communities',
-    'REC_SPIR_END': 'Maintain recreation and spiritual act',
-    'TOURISM_END':  'Maintain tourism',
-}
+def run_subbasin(neta_path:str, config:dict, cache_path:str|None, share_structure:bool=False) -> tuple[np.ndarray, np.ndarray, bool]:
+    """
+    run the model for a single subbasin, and return the beliefs [nodes, states] and bin edges [nodes, states+1] of the output nodes,
+    and whether the beliefs came from the inference cache (in which case the network was never loaded)
+    """
+    # input = config[to_snake_case(subbasin)]
+    cache = get_cache(cache_path) if cache_path else None
 
-
-# these input nodes need to be retracted before they can be assigned new values
-retract_nodes = {'DISCHARGE_LF', 'DISCHARGE_HF', 'DISCHARGE_YR', 'DISCHARGE_FD'}
-
-
-subbasins = ['Upper Limpopo', 'Crocodile Marico', 'Elephantes', 'Middle Limpopo', 'Lower Limpopo']
-def to_snake_case(name:str):
-    return name.lower().replace(' ', '_')
-
-
-#functions for getting the mean and standard deviation of the output nodes
-def get_stats(node:int|str|NeticaNode, net:NeticaGraph):
-    """Given a histogram of beliefs (Zero, Low, Medium, High), compute mean and std-dev"""
-    #TODO: replace beliefs array with just getting the array of state values via the API
-    #      also need to make the centers use use the correct number of states, and have the correct bounds
-    #      currently it's hardcoded for 4 states (zero, low, medium, high) -> (0, 25, 50, 75, 100)
-    beliefs = np.array([net.get_node_belief(node, i) for i in range(net.get_num_node_states(node))])
-    centers = np.arange(4)*25 + 12.5
-    mean = np.sum(beliefs*centers)
-
-    #hacky standard deviation approximation. Deriving the standard deviation analytically was too difficult
-    samples = 10000
-    x = np.linspace(0,100,samples)
-    y = np.repeat(beliefs, samples//4)
-    std = np.sqrt(np.sum(y*(x-mean)**2)/samples)*2
-
-    return mean, std
+    output_names = list(output_nodes)
+    with PROFILER.phase('inference'):
+        beliefs, meta, hit = query(lambda: get_manager(share_structure=share_structure), neta_path, config, output_names, cache=cache, verbose=True)
+    return beliefs, get_bin_edges(meta, output_names), hit
 
 
 def main():
-    netica = NeticaManager()
+    parser = argparse.ArgumentParser(description='Run the Limpopo model for each of the 5 subbasins')
+    parser.add_argument('--workers', type=int, default=1, help='number of subbasins to run in parallel, each in its own process (default: 1)')
+    parser.add_argument('--cache', default=DEFAULT_CACHE_PATH, help=f'path to the inference result cache (default: {DEFAULT_CACHE_PATH})')
+    parser.add_argument('--no-cache', dest='cache', action='store_const', const=None, help='always run the model, without reading or writing the inference cache')
+    parser.add_argument('--share-structure', action='store_true', help='load subbasins with the same structure as copies of one compiled template (see structure.py)')
+    args = parser.parse_args()
+
     neta_dir = 'neta/limpopo_5_subbasin'
     output_path = join('results', f'limpopo_5_subbasin.csv')
 
     # get the model input settings from the config file
-    with open('configs/limpopo_5_subbasin.json') as f:
-        config = json.load(f)
+    with PROFILER.phase('config'):
+        with open('configs/limpopo_5_subbasin.json') as f:
+            config = json.load(f)
 
-    # create a dataframe with [Year, Country, Catchment, Level,*[*output_nodes x ['mean', 'std']]] as the columns, and one row for each subbasin
+    # create a dataframe with [*output_nodes x ['mean', 'std']] as the columns, and one row for each subbasin
     # constant fields for all values
     country = 'South Africa'
     catchment = 'Limpopo'
     year = 2022
 
-    columns = ['Year', 'Country', 'Catchment', 'RR']
+    columns = []
     for output_name in output_nodes.values():
         columns.append(f'{output_name} (Mean)')
         columns.append(f'{output_name} (Standard Deviation)')
     
-    # rows to be filled in by running the model
-    rows = []
-    
- 
     # run the model for each subbasin
-    for subbasin in subbasins:
-        neta_path = join(neta_dir, f'{to_snake_case(subbasin)}.neta')
-
-        # load the neta graph for this subbasin
-        net = netica.new_graph(neta_path)
-
-        # set input values from the config file for this subbasin
-        # input = config[to_snake_case(subbasin)]
-        for key, value in config.items(): #input.items():
-            if value is not None:
-                net.enter_finding(key, value, retract=(key in retract_nodes), verbose=True)
-
-        #generate the dataframe row for this subbasin
-        row = [year, country, catchment, subbasin]
-        for raw_name in output_nodes:
-            #add mean and std
-            row.extend(get_stats(raw_name, net))
-
-        rows.append(row)
-
-    # merge the results with the shapefile
-    results = pd.DataFrame(rows, columns=columns)
-    shape = pd.read_csv('shapes/limpopo_0.1degree.csv')
-    shape['Year'] = year
-    shape['Country'] = country
-    shape['Catchment'] = catchment
-    shape = shape[['Year','latitude','longitude', 'Country', 'Catchment','RR']].copy()
-    merge_on = ['RR', 'Country', 'Year', 'Catchment']
-    df = pd.merge(shape, results, left_on=merge_on, right_on=merge_on)
+    sites = [(subbasin, (join(neta_dir, f'{to_snake_case(subbasin)}.neta'), config, args.cache, args.share_structure)) for subbasin in subbasins]
+    site_results = run_sites(run_subbasin, sites, workers=args.workers)
+    failures = report_failures(site_results)
+
+    #compute the mean and std of every output node of every subbasin at once
+    ok_results = [r for r in site_results if r.ok]
+    with PROFILER.phase('stats'):
+        stats = histogram_stats(*stack_histograms([r.result[:2] for r in ok_results]))
+    if args.cache:
+        print(f'inference cache: {sum(r.result[2] for r in ok_results)} of {len(ok_results)} subbasins were cache hits')
+
+    #generate the dataframe rows in the same order as the subbasin list, with [mean, std] for each output node
+    with PROFILER.phase('merge'):
+        results = pd.DataFrame(np.stack([stats['mean'], stats['std']], axis=-1).reshape(len(ok_results), -1), columns=columns)
+
+        # place each subbasin's results on the grid cells of that subbasin
+        grid = load_grid('shapes/limpopo_0.1degree.csv', {**GRID_COLUMNS, 'RR': str})
+        df = grid_frame(grid, 'RR', results, sites=[r.site for r in ok_results], year=year, country=country, catchment=catchment)
 
     #save to csv
     print(f'saving to {output_path}')
-    df.to_csv(output_path, index=False)
+    with PROFILER.phase('write'):
+        df.to_csv(output_path, index=False)
+
+    if failures:
+        raise SystemExit(f'{len(failures)} of {len(site_results)} subbasins failed: {", ".join(r.site for r in failures)}')
 
 
 if __name__ == '__main__':
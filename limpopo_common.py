@@ -0,0 +1,49 @@
+"""
+Definitions shared by the Limpopo scripts (limpopo.py, limpopo_5_subbasin.py and limpopo_27_subbasin.py) and the modules that
+run the Limpopo models (e.g. sweep.py, sensitivity.py and service.py), so that importing them doesn't import a runnable script
+"""
+
+from __future__ import annotations
+from discharge_lookup import get_discharge_findings
+
+
+# list of nodes to record the state of at the end of the simulation
+# map from the raw name to what the node should be called in the output csv
+output_nodes = {
+    'SUB_VEG_END':  'Maintain plants for livelihoods',
+    'SUB_FISH_END': 'Maintaining fisheries for livelihoods',
+    'LIV_VEG_END':  'Maintain plants for domestic livestock',
+    'DOM_WAT_END':  'Maintain water for domestic use',
+    'FLO_ATT_END':  'Flood attenuation services',
+    'RIV_ASS_END':  'River assimilation capacity',
+    'WAT_DIS_END':  'Maintain water borne diseases',
+    'RES_RES_END':  'Resource resilience',
+    'FISH_ECO_END': 'Maintain fish communities',
+    'VEG_ECO_END':  'Maintain vegetation communities',
+    'INV_ECO_END':  'Maintain invertebrate communities',
+    'REC_SPIR_END': 'Maintain recreation and spiritual act',
+    'TOURISM_END':  'Maintain tourism',
+}
+
+
+# the 5 subbasins of limpopo_5_subbasin, whose networks are neta/limpopo_5_subbasin/<snake case name>.neta
+subbasins = ['Upper Limpopo', 'Crocodile Marico', 'Elephantes', 'Middle Limpopo', 'Lower Limpopo']
+def to_snake_case(name:str):
+    return name.lower().replace(' ', '_')
+
+
+# special settings, which expand to the findings of several nodes
+special_settings = {'DISCHARGE_SCENARIO': get_discharge_findings}
+
+
+def get_site_findings(site:str, config:dict) -> dict:
+    """the node findings for a site given the config file settings"""
+    findings = {}
+    for key, value in config.items():
+        if key in special_settings:
+            #config settings that are more complicated than just setting a node value
+            if value is not None:
+                findings.update(special_settings[key](site, value))
+            continue
+        findings[key] = value
+    return findings
@@ -0,0 +1,99 @@
+"""
+Fuzzy matching of names between data sources, e.g. the subbasin titles in the discharge ranges spreadsheet against the official site names.
+
+Two names are scored by sliding the shorter one along the longer one, and counting the positions at which their characters agree,
+taking the best shift. All pairs of names are scored at once: the names are encoded as padded arrays of character codes,
+and each shift is a single vectorized comparison over every pair.
+"""
+
+from __future__ import annotations
+from dataclasses import dataclass
+import numpy as np
+
+
+# padding codes for the two sides of a comparison. They differ from each other and from every real character, so padding never matches
+PAD_A = -1
+PAD_B = -2
+
+
+def encode(names:list[str], pad:int) -> tuple[np.ndarray, np.ndarray]:
+    """encode names as an array [n_names, max_length] of unicode code points, padded with `pad`. Returns (codes, lengths)"""
+    lengths = np.array([len(name) for name in names], dtype=np.int64)
+    width = max(int(lengths.max(initial=0)), 1)
+    codes = np.array(names, dtype=f'<U{width}').view(np.uint32).reshape(len(names), width).astype(np.int32)
+    codes[np.arange(width)[None, :] >= lengths[:, None]] = pad
+    return codes, lengths
+
+
+def alignment_scores(A:list[str], B:list[str], *, max_elements:int=1 << 24) -> np.ndarray:
+    """
+    score matrix [len(A), len(B)] of the maximum overlap of each pair of names
+
+    For each pair the shorter name is slid along the longer one, without overhanging either end, and the score is
+    the largest number of positions at which the characters agree. `max_elements` bounds the size of the temporary comparison arrays.
+    """
+    codes_a, len_a = encode(A, PAD_A)
+    codes_b, len_b = encode(B, PAD_B)
+    width_a, width_b = codes_a.shape[1], codes_b.shape[1]
+
+    # for shift d, A[i] is compared with B[i + d]. Pad B so that every shift is a plain slice
+    padded_b = np.full((len(B), width_a + width_b + width_a), PAD_B, dtype=np.int32)
+    padded_b[:, width_a:width_a + width_b] = codes_b
+
+    # a shift is valid for a pair if the shorter name lies entirely within the longer one, i.e. between 0 and len(B) - len(A)
+    diff = len_b[None, :] - len_a[:, None]
+    lo, hi = np.minimum(diff, 0), np.maximum(diff, 0)
+
+    scores = np.zeros((len(A), len(B)), dtype=np.int64)
+    chunk = max(1, max_elements // max(len(B) * width_a, 1))
+    for d in range(-(width_a - 1), width_b):
+        shifted = padded_b[:, width_a + d:width_a + d + width_a]
+        valid = (lo <= d) & (d <= hi)
+        for start in range(0, len(A), chunk):
+            block = slice(start, start + chunk)
+            matches = (codes_a[block, None, :] == shifted[None, :, :]).sum(axis=-1)
+            np.maximum(scores[block], np.where(valid[block], matches, 0), out=scores[block])
+
+    return scores
+
+
+@dataclass
+class Matches:
+    queries: list[str]
+    candidates: list[str]
+    scores: np.ndarray         # [n_queries, n_candidates] alignment scores
+    best: np.ndarray           # [n_queries] index of the best matching candidate for each query (the first, on ties)
+    match_percent: np.ndarray  # [n_queries] best score as a fraction of the length of the best candidate
+    ambiguous: dict[str, list[str]]  # query -> the candidates tied for its best score, for queries without a unique best match
+    conflicts: dict[str, list[str]]  # candidate -> the queries it is the best match of, for candidates that are the best match of several queries
+
+    def assignment(self) -> dict[str, str]:
+        """map from each query to its best matching candidate"""
+        return {query: self.candidates[i] for query, i in zip(self.queries, self.best.tolist())}
+
+
+def match_names(queries:list[str], candidates:list[str], *, strip:bool=True) -> Matches:
+    """
+    match each query name to the candidate it overlaps best with (see `alignment_scores`)
+
+    A query is ambiguous if several candidates tie for its best score, and candidates that are the best match of more than one query are conflicts.
+    If `strip`, leading/trailing whitespace is ignored.
+    """
+    if strip:
+        scores = alignment_scores([q.strip() for q in queries], [c.strip() for c in candidates])
+        lengths = np.array([len(c.strip()) for c in candidates])
+    else:
+        scores = alignment_scores(queries, candidates)
+        lengths = np.array([len(c) for c in candidates])
+
+    best = np.argmax(scores, axis=1)
+    best_scores = scores[np.arange(len(queries)), best]
+    match_percent = best_scores / np.maximum(lengths[best], 1)
+
+    ties = scores == best_scores[:, None]
+    ambiguous = {queries[q]: [candidates[i] for i in np.flatnonzero(ties[q])] for q in np.flatnonzero(ties.sum(axis=1) > 1)}
+
+    claimed = np.bincount(best, minlength=len(candidates))
+    conflicts = {candidates[i]: [queries[q] for q in np.flatnonzero(best == i)] for i in np.flatnonzero(claimed > 1)}
+
+    return Matches(list(queries), list(candidates), scores, best, match_percent, ambiguous, conflicts)
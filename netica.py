@@ -1,9 +1,15 @@
 from __future__ import annotations
 from NeticaPy import Netica, NewNode as NeticaNode
-from typing import Generator
-from weakref import finalize
+from instrumentation import PROFILER
+from typing import Generator, Mapping
+from weakref import finalize, WeakSet
+from collections import OrderedDict
+import hashlib
+import json
 import os
+import time
 from enum import Enum
+import numpy as np
 
 import pdb
 
@@ -25,6 +31,8 @@ typedef enum {NATURE_NODE=1, CONSTANT_NODE, DECISION_NODE, UTILITY_NODE, DISCONN
 enum {EVERY_STATE = -5, IMPOSS_STATE, UNDEF_STATE};/* special values for state_bn */
 enum {FIRST_CASE = -15, NEXT_CASE, NO_MORE_CASES};/* special values for caseposn_bn */
 enum {ENTROPY_SENSV = 0x02, REAL_SENSV = 0x04, VARIANCE_SENSV = 0x100, VARIANCE_OF_REAL_SENSV = 0x104}; /* for NewSensvToFinding_bn */
+enum {FIRST_ENTRY = -10, LAST_ENTRY = -9, ALL_ENTRIES = -8}; /* special values for list indexes, e.g. AddNodeToList_bn */
+typedef enum {DEFAULT_SAMPLING = 0, JOIN_TREE_SAMPLING, FORWARD_SAMPLING} sampling_bn; /* for GenerateRandomCase_bn */
 """
 
 class Checking(Enum):
@@ -74,13 +82,156 @@ class Sensitivity(Enum):
     REAL_SENSV = 0x04
     VARIANCE_SENSV = 0x100
     VARIANCE_OF_REAL_SENSV = 0x104
+class ListPosition(Enum):
+    FIRST_ENTRY = -10
+    LAST_ENTRY = -9
+    ALL_ENTRIES = -8
+class SamplingMethod(Enum):
+    DEFAULT_SAMPLING = 0
+    JOIN_TREE_SAMPLING = 1
+    FORWARD_SAMPLING = 2
 
 
 #TODO: handling errors that the netica API returns. i.e. self.res
 
-N = Netica()
+
+# directory for sidecar files derived from the .neta files (metadata, caches, ...)
+CACHE_DIR = os.environ.get("PROBFLO_CACHE_DIR", ".cache")
+
+_file_hashes: dict[tuple[str, int, int], str] = {}
+def file_hash(path:str) -> str:
+    """sha256 of a file's contents. Memoized on the file's path, size and modification time"""
+    stat = os.stat(path)
+    key = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_hashes:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        _file_hashes[key] = digest.hexdigest()
+    return _file_hashes[key]
+
+
+# bounds used for nodes that don't define levels. Matches the previous assumption of 4 equal bins (0-25, 25-50, 50-75, 75-100)
+DEFAULT_RANGE = (0.0, 100.0)
+
+def levels_to_edges(levels:np.ndarray, num_states:int) -> np.ndarray:
+    """
+    convert a node's netica levels to its num_states+1 bin edges, which are both its histogram bins (see stats.py) and
+    the bins real values are discretized into (see `NetMetadata.discretize`)
+
+    - continuous (discretized) nodes have num_states+1 levels, which are already the bin edges
+    - discrete nodes may have num_states levels, which are the value of each state. These are used as the bin centers, with edges halfway between neighboring levels
+    - nodes without levels are split into equal bins over DEFAULT_RANGE
+    Infinite outer edges (open ended bins) are replaced by mirroring the width of the neighboring bin.
+    """
+    levels = np.asarray(levels, dtype=np.float64)
+    if len(levels) == num_states + 1:
+        edges = levels.copy()
+    elif len(levels) == num_states and num_states > 1:
+        mids = (levels[1:] + levels[:-1]) / 2
+        edges = np.concatenate([[2*levels[0] - mids[0]], mids, [2*levels[-1] - mids[-1]]])
+    else:
+        edges = np.linspace(*DEFAULT_RANGE, num_states + 1)
+
+    if num_states > 1:
+        if not np.isfinite(edges[0]):
+            edges[0] = edges[1] - (edges[2] - edges[1])
+        if not np.isfinite(edges[-1]):
+            edges[-1] = edges[-2] + (edges[-2] - edges[-3])
+    return edges
+
+def pad_beliefs(node_beliefs:list[np.ndarray]) -> np.ndarray:
+    """stack belief vectors into an array of shape [n_nodes, max_states], padding with zeros"""
+    out = np.zeros((len(node_beliefs), max((len(b) for b in node_beliefs), default=0)))
+    for i, beliefs in enumerate(node_beliefs):
+        out[i, :len(beliefs)] = beliefs
+    return out
+
+
+def new_node_list(net, nodes:list[NeticaNode]):
+    """create a netica node list holding `nodes`. Delete it with DeleteNodeList_bn when done"""
+    node_list = N.NewNodeList2_bn(len(nodes), net)
+    for node in nodes:
+        N.AddNodeToList_bn(node, node_list, ListPosition.LAST_ENTRY.value)
+    return node_list
+
+
+def read_node_cpt(node:NeticaNode, shape:tuple[int, ...]) -> np.ndarray:
+    """read the conditional probability table [*parent_states, n_states] of a node. Raises ValueError if it doesn't have one"""
+    cpt = np.empty(shape, dtype=np.float64)
+    for parent_states in np.ndindex(*shape[:-1]):
+        probs = N.GetNodeProbs_bn(node, list(parent_states))
+        if probs is None:
+            raise ValueError(f"node {N.GetNodeName_bn(node).decode('utf-8')} has no conditional probability table")
+        cpt[parent_states] = np.asarray(probs, dtype=np.float64)[:shape[-1]]
+    return cpt
+
+
+def write_node_cpt(node:NeticaNode, cpt:np.ndarray):
+    """replace the conditional probability table of a node with `cpt` [*parent_states, n_states]"""
+    for parent_states in np.ndindex(*cpt.shape[:-1]):
+        N.SetNodeProbs_bn(node, list(parent_states), cpt[parent_states].tolist())
+
+
+def set_elimination_order(net, nodes:list[NeticaNode]):
+    """set the order nodes are eliminated in when `net` is next compiled"""
+    node_list = new_node_list(net, nodes)
+    N.SetNetElimOrder_bn(net, node_list)
+    N.DeleteNodeList_bn(node_list)
+
+
+class LazyNetica:
+    """the netica API object, created the first time it is used rather than when this module is imported"""
+    def __init__(self):
+        self._api: Netica|None = None
+
+    def __getattr__(self, name:str):
+        if self._api is None:
+            self._api = Netica()
+        if PROFILER.enabled:
+            return PROFILER.wrap_api(name, getattr(self._api, name))
+        return getattr(self._api, name)
+
+
+def close_environment(env, mesg:bytearray, graphs:WeakSet):
+    """delete every live net of an environment, then close it"""
+    for graph in list(graphs):
+        graph.close()
+    res = N.CloseNetica_bn(env, mesg)
+    print(mesg.decode("utf-8"))
+
+
+N = LazyNetica()
+
+def path_tags(manager:"NeticaManager", path:str, *args, **kwargs) -> dict[str, str|None]:
+    """profiling tags for the calls that load the network at `path`"""
+    return {'net': os.path.basename(path)}
+
+def graph_tags(graph:"NeticaGraph", *args, **kwargs) -> dict[str, str|None]:
+    """profiling tags for the calls of a graph's methods"""
+    return {'net': os.path.basename(graph.path) if graph.path else None}
+
+def compile_report(graph:"NeticaGraph", elimination, compile_seconds:float, order_seconds:float|None=None) -> dict[str, float|int|str|None]:
+    """how a graph was compiled (see elimination.py). The time spent finding (or loading) the elimination order is reported apart from netica's compile"""
+    report = {
+        'compile_seconds': compile_seconds,
+        'order_seconds': order_seconds,
+        'compiled_bytes': graph.compiled_size,
+        'heuristic': None,
+    }
+    if elimination is not None:
+        report.update(
+            heuristic=elimination.heuristic,
+            total_size=elimination.total_size,
+            max_clique_size=elimination.max_clique_size,
+            num_cliques=elimination.num_cliques,
+            default_bytes=elimination.default_bytes,
+        )
+    return report
+
 class NeticaManager:
-    def __init__(self, password_varname="NETICA_PASSWORD"):
+    def __init__(self, password_varname="NETICA_PASSWORD", *, max_pooled_nets:int=32, max_pooled_bytes:float=2e9, optimize_elimination:bool=True, elimination_restarts:int|None=None, max_live_bytes:float|None=None, idle_seconds:float=0.0, share_structure:bool=False):
         # get the password from the environment variable
         password = os.environ.get(password_varname, default="")
         if not password:
@@ -91,42 +242,577 @@ class NeticaManager:
         self.mesg = bytearray()
         self.res = N.InitNetica2_bn(self.env, self.mesg)
 
-        self.finilizer = finalize(self, self.cleanup_env)
+        # pool of compiled graphs keyed by (path, size, mtime), ordered from least to most recently used
+        self.pool: OrderedDict[tuple[str, int, int], NeticaGraph] = OrderedDict()
+        self.max_pooled_nets = max_pooled_nets
+        self.max_pooled_bytes = max_pooled_bytes
+
+        # compile with an elimination order searched for by elimination.py, when it gives a smaller junction tree than netica's own.
+        # `elimination_restarts` is the size of the search, run once per file (None for elimination.DEFAULT_RESTARTS)
+        self.optimize_elimination = optimize_elimination
+        self.elimination_restarts = elimination_restarts
+
+        # every graph of this environment that hasn't been closed yet, pooled or not
+        self.graphs: WeakSet[NeticaGraph] = WeakSet()
+
+        # high water mark for the junction tree memory of all live graphs. When a load goes over it, graphs that haven't been used
+        # for at least `idle_seconds` and aren't checked out are closed, least recently used first. None disables it
+        self.max_live_bytes = max_live_bytes
+        self.idle_seconds = idle_seconds
+
+        # load networks as copies of one compiled template per distinct structure (see structure.py), keyed by structure hash
+        self.share_structure = share_structure
+        self.templates: dict[str, NeticaGraph] = {}
+
+        # doesn't reference self, so that the manager can still be garbage collected
+        self.finilizer = finalize(self, close_environment, self.env, self.mesg, self.graphs)
+
+    def __enter__(self) -> "NeticaManager":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """close every live graph, and then the netica environment. Safe to call more than once"""
+        self.pool.clear()
+        self.templates.clear()
+        self.finilizer()
+
+    @property
+    def closed(self) -> bool:
+        return not self.finilizer.alive
+
+    @PROFILER.method('NeticaManager.new_graph', tags=path_tags)
+    def new_graph(self, path:str, *, pooled:bool=True) -> "NeticaGraph":
+        """
+        check out a compiled graph for the network file at `path`, for the caller's exclusive use until it calls `release()`
+        (or leaves a `with` block on the graph).
+
+        If the same (unchanged) file was loaded before and its pooled graph has been released, that graph is reused, reset to
+        the findings saved in the file. If it is still checked out, a fresh copy is loaded instead, which `release()` closes.
+        Released graphs stay in the pool until they are evicted by its limits (see `evict`). Checked out graphs are never closed by the manager.
+        Set `pooled=False` to always read and compile a fresh copy, which `release()` closes.
+        """
+        key = self.pool_key(path)
+        graph = self.pool.get(key) if pooled else None
+        if graph is not None and not graph.checked_out:
+            self.pool.move_to_end(key)
+            graph.checked_out = True
+            graph.reset()
+            graph.touch()
+            return graph
+
+        if pooled and graph is None:
+            # drop stale entries for older versions of the same file (closing them, unless they are still checked out)
+            for stale_key in [k for k in self.pool if k[0] == key[0]]:
+                stale = self.pool.pop(stale_key)
+                if not stale.checked_out:
+                    stale.close()
+
+        graph = self.load_graph(path)
+        if pooled and key not in self.pool:
+            self.pool[key] = graph
+            self.evict()
+        self.enforce_high_water()
+        return graph
+
+    @PROFILER.method('NeticaManager.load_graph', tags=path_tags)
+    def load_graph(self, path:str) -> "NeticaGraph":
+        """load a compiled graph of the network at `path` (bypasses the pool), from a template of the same structure if `share_structure` is set"""
+        if self.share_structure:
+            # imported here, since structure.py imports this module
+            from structure import load_shared
+            try:
+                return load_shared(self, path)
+            except (ValueError, KeyError, OSError, RuntimeError) as e:
+                print(f"WARNING: could not load {path} from a shared structure, reading it instead: {e}")
+        return self.read_graph(path)
+
+    def read_net(self, path:str):
+        """read the (uncompiled) netica net at `path`"""
+        if self.closed:
+            raise RuntimeError("the netica environment of this manager has been closed")
 
-    def new_graph(self, path:str) -> "NeticaGraph":
         #ensure that the file exists
         with open(path, 'r'): ...
+        return N.ReadNet_bn(N.NewFileStream_ns(path.encode('utf-8'), self.env, b""), 0)
+
+    def read_graph(self, path:str, *, net=None) -> "NeticaGraph":
+        """read and compile the network at `path`, or compile `net` if it was already read from `path` (see `read_net`)"""
+        cached_meta = NetMetadata.load_cached(path)
+        if net is None:
+            net = self.read_net(path)
+
+        meta, elimination, compile_seconds, order_seconds = self.compile_net(net, path, cached_meta)
+        graph = NeticaGraph(net, self, meta=meta, net_hash=file_hash(path), path=path)
+        if cached_meta is None:
+            graph.meta.save_cached(path)
+        graph.compile_report = compile_report(graph, elimination, compile_seconds, order_seconds)
+        return graph
+
+    def read_tables(self, path:str) -> tuple["NetMetadata", list[np.ndarray]]:
+        """read the metadata and CPTs of the network at `path`, without compiling it"""
+        net = self.read_net(path)
+        try:
+            return self.net_tables(net, path)
+        finally:
+            N.DeleteNet_bn(net)
+
+    @staticmethod
+    def net_tables(net, path:str) -> tuple["NetMetadata", list[np.ndarray]]:
+        """the metadata and CPTs of an uncompiled `net` read from `path`"""
+        nodes = N.GetNetNodes_bn(net)
+        nodes = [N.NthNode_bn(nodes, i) for i in range(N.LengthNodeList_bn(nodes))]
+        meta = NetMetadata.load_cached(path)
+        if meta is None or len(meta) != len(nodes):
+            meta = NetMetadata.from_nodes(nodes)
+            meta.save_cached(path)
+        return meta, [read_node_cpt(node, meta.cpt_shape(i)) for i, node in enumerate(nodes)]
+
+    def compile_net(self, net, path:str|None, meta:"NetMetadata|None"):
+        """
+        compile a net read from `path`, with an optimized elimination order if enabled (and the net came from a file), or netica's
+        own order if that compiles smaller (see elimination.compile_with_order).
+        Returns (the net's metadata if it was needed, the elimination order result or None, seconds spent compiling,
+        seconds spent finding the elimination order or None)
+        """
+        elimination = order_seconds = None
+        if self.optimize_elimination and path is not None:
+            start = time.perf_counter()
+            # imported here, since elimination.py imports this module
+            from elimination import get_elimination_order, compile_with_order, DEFAULT_RESTARTS
+            nodes = N.GetNetNodes_bn(net)
+            nodes = [N.NthNode_bn(nodes, i) for i in range(N.LengthNodeList_bn(nodes))]
+            if meta is None or len(meta) != len(nodes):
+                meta = NetMetadata.from_nodes(nodes)
+            restarts = DEFAULT_RESTARTS if self.elimination_restarts is None else self.elimination_restarts
+            elimination = get_elimination_order(path, meta, restarts=restarts)
+            order_seconds = time.perf_counter() - start
 
-        #load the network
-        path = path.encode('utf-8')
-        net = N.ReadNet_bn(N.NewFileStream_ns(path, self.env, b""), 0)
+            start = time.perf_counter()
+            elimination = compile_with_order(net, nodes, meta, path, elimination)
+            return meta, elimination, time.perf_counter() - start, order_seconds
+
+        start = time.perf_counter()
         N.CompileNet_bn(net)
+        return meta, elimination, time.perf_counter() - start, order_seconds
+
+    @staticmethod
+    def pool_key(path:str) -> tuple[str, int, int]:
+        """key identifying a particular version of a network file"""
+        stat = os.stat(path)
+        return os.path.realpath(path), stat.st_size, stat.st_mtime_ns
+
+    def pooled_bytes(self) -> float:
+        """estimated junction tree memory of all pooled graphs"""
+        return sum(graph.compiled_size for graph in self.pool.values())
+
+    def evict(self):
+        """delete least recently used released graphs until the pool is within its count and memory limits (checked out graphs are kept)"""
+        while len(self.pool) > self.max_pooled_nets or self.pooled_bytes() > self.max_pooled_bytes:
+            key = next((k for k, g in self.pool.items() if not g.checked_out), None)
+            if key is None:
+                break
+            self.pool.pop(key).close()
+
+    def is_pooled(self, graph:"NeticaGraph") -> bool:
+        return any(g is graph for g in self.pool.values())
+
+    def clear_pool(self):
+        """delete all released pooled graphs, and forget the checked out ones (which `release()` then closes)"""
+        while self.pool:
+            _, graph = self.pool.popitem(last=False)
+            if not graph.checked_out:
+                graph.close()
+
+    def forget(self, graph:"NeticaGraph"):
+        """forget a graph that is being closed"""
+        self.graphs.discard(graph)
+        for key in [k for k, g in self.pool.items() if g is graph]:
+            del self.pool[key]
+
+    def live_bytes(self) -> float:
+        """estimated junction tree memory of all live graphs"""
+        return sum(graph.compiled_size for graph in list(self.graphs))
+
+    def close_idle(self, max_bytes:float, *, idle_seconds:float=0.0, keep:"NeticaGraph|None"=None) -> int:
+        """
+        close graphs that haven't been used for at least `idle_seconds`, least recently used first, until the live graphs fit in `max_bytes`.
+        Only graphs that nobody holds (released pooled graphs, and structure templates) are closed, and `keep` never is. Returns the number of graphs closed
+        """
+        now = time.monotonic()
+        total = self.live_bytes()
+        idle = sorted((g for g in list(self.graphs) if g is not keep and not g.checked_out and now - g.last_used >= idle_seconds), key=lambda g: g.last_used)
+        closed = 0
+        for graph in idle:
+            if total <= max_bytes:
+                break
+            total -= graph.compiled_size
+            graph.close()
+            closed += 1
+        return closed
+
+    def enforce_high_water(self, keep:"NeticaGraph|None"=None):
+        if self.max_live_bytes is not None and self.live_bytes() > self.max_live_bytes:
+            self.close_idle(self.max_live_bytes, idle_seconds=self.idle_seconds, keep=keep)
+
+    def memory_report(self) -> dict:
+        """junction tree memory, node counts and idle times of the live graphs, least recently used first"""
+        now = time.monotonic()
+        pooled = {id(g) for g in self.pool.values()}
+        nets = [
+            {'path': g.path, 'compiled_bytes': g.compiled_size, 'nodes': len(g.nodes), 'pooled': id(g) in pooled, 'checked_out': g.checked_out, 'idle_seconds': now - g.last_used}
+            for g in sorted(list(self.graphs), key=lambda g: g.last_used)
+        ]
+        return {
+            'live_nets': len(nets),
+            'pooled_nets': len(self.pool),
+            'compiled_bytes': sum(net['compiled_bytes'] for net in nets),
+            'nodes': sum(net['nodes'] for net in nets),
+            'nets': nets,
+        }
 
-        return NeticaGraph(net, self)
-    
     def cleanup_env(self):
         """cleanup the netica environment when the manager is destroyed"""
-        res = N.CloseNetica_bn(self.env, self.mesg)
-        print(self.mesg.decode("utf-8"))
+        self.close()
+
+class NetMetadata:
+    """
+    static node/state metadata of a network, built once per .neta file.
+
+    Per-node values are stored in flat arrays indexed by node index. Variable length values (state names, levels, parents)
+    are concatenated into a single array, with `*_offsets[i]:*_offsets[i+1]` selecting the values of node i.
+    """
+    FIELDS = (
+        'node_names', 'node_types', 'node_kinds', 'num_states',
+        'state_offsets', 'state_names', 'level_offsets', 'levels', 'parent_offsets', 'parents',
+        'initial_findings',
+    )
+    # everything but the findings saved in the file, i.e. what networks that differ only in their CPTs and findings have in common
+    STRUCTURE_FIELDS = tuple(name for name in FIELDS if name != 'initial_findings')
+    __slots__ = FIELDS + ('name_index', 'bin_edges')
+    VERSION = 1
+
+    def __init__(self, **arrays:np.ndarray):
+        for name in self.FIELDS:
+            setattr(self, name, arrays[name])
+        self.name_index = {name: i for i, name in enumerate(self.node_names.tolist())}
+        self.bin_edges: dict[int, np.ndarray] = {}
+
+    @classmethod
+    def from_nodes(cls, nodes:list[NeticaNode]) -> "NetMetadata":
+        """introspect the nodes of a loaded network via the netica API"""
+        names = [N.GetNodeName_bn(node).decode('utf-8') for node in nodes]
+        index = {name: i for i, name in enumerate(names)}
+
+        num_states, state_names, levels, parents = [], [], [], []
+        state_offsets, level_offsets, parent_offsets = [0], [0], [0]
+        for node in nodes:
+            n = N.GetNodeNumberStates_bn(node)
+            num_states.append(n)
+            state_names.extend(N.GetNodeStateName_bn(node, j).decode('utf-8') for j in range(n))
+            state_offsets.append(len(state_names))
+
+            node_levels = N.GetNodeLevels_bn(node)
+            levels.extend(node_levels if node_levels is not None else [])
+            level_offsets.append(len(levels))
+
+            node_parents = N.GetNodeParents_bn(node)
+            parents.extend(index[N.GetNodeName_bn(N.NthNode_bn(node_parents, k)).decode('utf-8')] for k in range(N.LengthNodeList_bn(node_parents)))
+            parent_offsets.append(len(parents))
+
+        return cls(
+            node_names=np.array(names, dtype=str),
+            node_types=np.array([N.GetNodeType_bn(node) for node in nodes], dtype=np.int8),
+            node_kinds=np.array([N.GetNodeKind_bn(node) for node in nodes], dtype=np.int8),
+            num_states=np.array(num_states, dtype=np.int32),
+            state_offsets=np.array(state_offsets, dtype=np.int64),
+            state_names=np.array(state_names, dtype=str),
+            level_offsets=np.array(level_offsets, dtype=np.int64),
+            levels=np.array(levels, dtype=np.float64),
+            parent_offsets=np.array(parent_offsets, dtype=np.int64),
+            parents=np.array(parents, dtype=np.int32),
+            initial_findings=np.array([N.GetNodeFinding_bn(node) for node in nodes], dtype=np.int32),
+        )
+
+    def __len__(self) -> int:
+        return len(self.node_names)
+
+    def get_state_names(self, node_idx:int) -> list[str]:
+        return self.state_names[self.state_offsets[node_idx]:self.state_offsets[node_idx+1]].tolist()
+
+    def get_levels(self, node_idx:int) -> np.ndarray:
+        """levels of a node. For discretized continuous nodes these are the n_states+1 bin edges. Empty if the node has no levels"""
+        return self.levels[self.level_offsets[node_idx]:self.level_offsets[node_idx+1]]
+
+    def get_parents(self, node_idx:int) -> np.ndarray:
+        return self.parents[self.parent_offsets[node_idx]:self.parent_offsets[node_idx+1]]
+
+    def leaf_nodes(self) -> list[str]:
+        """the names of the nodes that aren't a parent of any other node, e.g. the outputs of a model"""
+        parents = set(self.parents.tolist())
+        return [name for i, name in enumerate(self.node_names.tolist()) if i not in parents]
+
+    def cpt_shape(self, node_idx:int) -> tuple[int, ...]:
+        """shape [*parent_states, n_states] of a node's conditional probability table"""
+        return tuple(int(self.num_states[p]) for p in self.get_parents(node_idx)) + (int(self.num_states[node_idx]),)
+
+    def structure_hash(self) -> str:
+        """sha256 of the nodes, states, levels and links, which is the same for networks that differ only in their CPTs and saved findings"""
+        digest = hashlib.sha256()
+        for name in self.STRUCTURE_FIELDS:
+            array = np.ascontiguousarray(getattr(self, name))
+            digest.update(f'{name}:{array.dtype.str}:{array.shape}'.encode('utf-8'))
+            digest.update(array.tobytes())
+        return digest.hexdigest()
+
+    def get_bin_edges(self, node_idx:int) -> np.ndarray:
+        """
+        the n_states+1 edges that real values are binned with, the same as its histogram bins (see `levels_to_edges`):
+        the levels of a discretized continuous node, or for a discrete node with a level per state, the midpoints between
+        its levels (so values go to the nearest level). Raises ValueError if the node has no levels
+        """
+        edges = self.bin_edges.get(node_idx)
+        if edges is None:
+            levels = self.get_levels(node_idx)
+            n = int(self.num_states[node_idx])
+            if len(levels) not in (n, n + 1) or n == 0:
+                raise ValueError(f"node `{self.node_names[node_idx]}` has no levels, so real values can't be placed in its states")
+            edges = levels_to_edges(levels, n)
+            edges.flags.writeable = False
+            self.bin_edges[node_idx] = edges
+        return edges
+
+    def discretize(self, node_idx:int, values:float|np.ndarray, *, clip:bool=True) -> np.ndarray:
+        """
+        the state index of each of `values` (an array of any shape) for a node, by a binary search of its bin edges.
+        Bins include their lower edge, and the last bin also includes its upper edge. Values outside the edges (including
+        those in open ended bins, which are closed off by `levels_to_edges`) are clipped into the first/last state, or with
+        clip=False, are -1. NaN values are always -1
+        """
+        edges = self.get_bin_edges(node_idx)
+        values = np.asarray(values, dtype=np.float64)
+        flat = values.reshape(-1)
+        states = np.searchsorted(edges, flat, side='right') - 1
+        num_bins = len(edges) - 1
+        states[flat == edges[-1]] = num_bins - 1
+        if clip:
+            np.clip(states, 0, num_bins - 1, out=states)
+        else:
+            states[(states < 0) | (states >= num_bins)] = -1
+        states[np.isnan(flat)] = -1
+        return states.reshape(values.shape)
+
+    def real_value_state(self, node_idx:int, value:float) -> int:
+        """the state of a node that a single real value falls in, clipped into the node's range"""
+        if value is None or np.isnan(value):
+            raise ValueError(f"invalid real value {value} for node `{self.node_names[node_idx]}`")
+        return int(self.discretize(node_idx, value))
+
+    def resolve_findings(self, findings:dict[str, int|str|None]) -> dict[int, int]:
+        """
+        the complete set of findings after entering `findings` on top of those saved in the file, as {node index: state index}.
+        A value of None retracts the node's finding, and a value of {"value": x} is the state the real value x falls in
+        """
+        resolved = {i: f for i, f in enumerate(self.initial_findings.tolist()) if f >= 0}
+        for name, state in findings.items():
+            try:
+                node_idx = self.name_index[name]
+            except KeyError:
+                raise KeyError(f"node `{name}` does not exist in this network") from None
+            if state is None:
+                resolved.pop(node_idx, None)
+            elif isinstance(state, Mapping):
+                resolved[node_idx] = self.real_value_state(node_idx, state['value'])
+            elif isinstance(state, str):
+                state_names = self.get_state_names(node_idx)
+                if state not in state_names:
+                    raise ValueError(f"invalid state_name '{state}'. Must be one of {state_names}")
+                resolved[node_idx] = state_names.index(state)
+            else:
+                if not 0 <= state < self.num_states[node_idx]:
+                    raise ValueError(f"state_idx given ({state}) must be in the range [0, {self.num_states[node_idx]})")
+                resolved[node_idx] = int(state)
+        return resolved
+
+    def evidence_key(self, findings:dict[int, int]) -> str:
+        """canonical string for a complete set of findings {node index: state index}, independent of the order they were entered in"""
+        return json.dumps(sorted((str(self.node_names[i]), int(state)) for i, state in findings.items()), separators=(',', ':'))
+
+    @classmethod
+    def sidecar_path(cls, neta_path:str) -> str:
+        return os.path.join(CACHE_DIR, 'metadata', f'{file_hash(neta_path)}.v{cls.VERSION}.npz')
+
+    @classmethod
+    def load_cached(cls, neta_path:str) -> "NetMetadata|None":
+        """load the metadata for a .neta file from its sidecar, or None if it hasn't been cached yet"""
+        try:
+            with np.load(cls.sidecar_path(neta_path), allow_pickle=False) as data:
+                return cls(**{name: data[name] for name in cls.FIELDS})
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def save_cached(self, neta_path:str):
+        """save the metadata to the sidecar for a .neta file"""
+        path = self.sidecar_path(neta_path)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+            np.savez(tmp_path, **{name: getattr(self, name) for name in self.FIELDS})
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"WARNING: could not save network metadata to {path}: {e}")
+
 
 class NeticaGraph:
-    def __init__(self, net, manager:NeticaManager):
+    def __init__(self, net, manager:NeticaManager, *, meta:NetMetadata|None=None, net_hash:str|None=None, path:str|None=None):
         self.net = net
         self.manager = manager
+        self.path = path
+
+        # hash of the .neta file the net was read from, and an optional persistent cache of beliefs keyed by it (see inference_cache.py)
+        self.net_hash = net_hash
+        self.result_cache = None
+
+        # node handles, fetched once so that lookups don't need to walk the node list again
+        nodes = N.GetNetNodes_bn(self.net)
+        self.nodes = [N.NthNode_bn(nodes, i) for i in range(N.LengthNodeList_bn(nodes))]
+
+        # static node/state metadata, either loaded from the sidecar cache or introspected from the network
+        if meta is None or len(meta) != len(self.nodes):
+            meta = NetMetadata.from_nodes(self.nodes)
+        self.meta = meta
 
-        self.node_names = {self.get_node_name(i): i for i in range(self.get_num_nodes())}
-        self.node_state_names = {self.get_node_name(i): {self.get_node_state_name(i, j): j for j in range(self.get_num_node_states(i))} for i in range(self.get_num_nodes())}
+        # belief vectors by node index, valid until the findings change
+        self.belief_cache: dict[int, np.ndarray] = {}
+
+        self.node_names = {name: i for i, name in enumerate(meta.node_names.tolist())}
+        self.node_state_names = {name: {state_name: j for j, state_name in enumerate(meta.get_state_names(i))} for name, i in self.node_names.items()}
         
         #replace node state names that only had empty strings, with None
         for node_name, state_names in self.node_state_names.items():
             if len(state_names) == 1 and list(state_names.keys())[0] == "":
                 self.node_state_names[node_name] = None
-        
-        self.finallizer = finalize(self, self.cleanup_net)
+
+        # findings saved in the .neta file, restored by reset()
+        self.initial_findings = {i: finding for i, finding in enumerate(meta.initial_findings.tolist()) if finding >= 0}
+
+        # the findings currently entered, as {node index: state index}
+        self.findings = dict(self.initial_findings)
+        self._evidence_key: str|None = None
+
+        # estimated memory (in bytes) of the compiled junction tree
+        self.compiled_size = N.SizeCompiledNet_bn(self.net, 0)
+
+        # how the net was compiled, filled in by NeticaManager.load_graph (see elimination.py)
+        self.compile_report: dict[str, float|int|str|None] = {}
+
+        # don't propagate after every finding. Beliefs are brought up to date once, when they are next requested
+        N.SetNetAutoUpdate_bn(self.net, 0)
+
+        # deletes the net when the graph is closed or garbage collected (doesn't reference self, so that it can be collected)
+        self.finallizer = finalize(self, N.DeleteNet_bn, self.net)
+        self.last_used = time.monotonic()
+        manager.graphs.add(self)
+
+        # the CPTs of every node, kept for graphs loaded from a shared structure (see structure.py) so that other networks of
+        # the same structure can be loaded into the compiled net by writing only the CPTs that differ (see `load_tables`)
+        self.tables: list[np.ndarray]|None = None
+
+        # whether someone holds the graph. Only graphs released back to the pool (see `release`) and structure templates aren't,
+        # and only those may be closed by the manager's pool and memory limits
+        self.checked_out = True
+
+    def __enter__(self) -> "NeticaGraph":
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def release(self):
+        """
+        give the graph back to its manager: a pooled graph is kept for the next `new_graph` call for its file, and any other graph
+        (or a pooled one whose CPTs were changed, see `tables_changed`) is closed
+        """
+        if self.closed:
+            return
+        self.checked_out = False
+        if self.manager.is_pooled(self) and self.net_hash is not None:
+            self.manager.evict()
+        else:
+            self.close()
+
+    def close(self):
+        """delete the net, and remove it from its manager. Safe to call more than once"""
+        if self.finallizer.alive:
+            self.manager.forget(self)
+            self.finallizer()
+
+    @property
+    def closed(self) -> bool:
+        return not self.finallizer.alive
+
+    def touch(self):
+        """mark the graph as in use, and check that it hasn't been closed"""
+        if not self.finallizer.alive:
+            raise RuntimeError(f"graph for {self.path or 'network'} has been closed")
+        self.last_used = time.monotonic()
+
+    @PROFILER.method('NeticaGraph.clone', tags=graph_tags)
+    def clone(self, *, path:str|None=None, meta:"NetMetadata|None"=None, cpts:dict[int, np.ndarray]|None=None, findings:dict[int, int]|None=None) -> "NeticaGraph":
+        """
+        a compiled copy of the net in the same environment, made from the loaded net rather than by re-reading the file.
+        The copy starts with the same findings, but is otherwise independent, e.g. so that each thread can own one (see parallel.run_scenarios).
+        It doesn't share the persistent result cache, since that can only be used from the thread that opened it
+
+        To make the copy a different network with the same structure (see structure.py), give that network's `path` and `meta`,
+        the `cpts` {node index: cpt} where it differs, and its `findings` {node index: state index}. The CPTs are loaded before
+        the copy is compiled, with this net's elimination order
+        """
+        self.touch()
+        net = N.CopyNet_bn(self.net, N.GetNetName_bn(self.net), self.manager.env, b"no_visual")
+        if cpts:
+            nodes = N.GetNetNodes_bn(net)
+            for node_idx, cpt in cpts.items():
+                write_node_cpt(N.NthNode_bn(nodes, node_idx), cpt)
+        _, elimination, compile_seconds, order_seconds = self.manager.compile_net(net, self.path, self.meta)
+        # with changed `cpts`, the copy only matches a file if it is that file's network
+        net_hash = file_hash(path) if path is not None else None if cpts else self.net_hash
+        graph = NeticaGraph(net, self.manager, meta=meta or self.meta, net_hash=net_hash, path=path or self.path)
+        graph.compile_report = compile_report(graph, elimination, compile_seconds, order_seconds)
+
+        # bring the copy's findings in line with this graph's (or the given ones)
+        findings = dict(self.findings if findings is None else findings)
+        N.RetractNetFindings_bn(net)
+        for node_idx, state_idx in findings.items():
+            N.EnterFinding_bn(graph.nodes[node_idx], state_idx)
+        graph.findings = findings
+        graph.findings_changed()
+        return graph
+
+    @PROFILER.method('NeticaGraph.load_tables', tags=graph_tags)
+    def load_tables(self, path:str, meta:"NetMetadata", tables:list[np.ndarray]):
+        """
+        turn this graph into the network at `path`, which has the same structure (see structure.py), without compiling it again:
+        the CPTs of `tables` that differ from the graph's are written into the compiled net, and the findings are reset to the file's.
+        Only the CPTs change, so netica keeps the junction tree, and loads the new tables into it at the next propagation
+        """
+        self.touch()
+        for node_idx, cpt in enumerate(tables):
+            if self.tables is None or not np.array_equal(cpt, self.tables[node_idx]):
+                write_node_cpt(self.nodes[node_idx], cpt)
+        self.tables = tables
+        self.path = path
+        self.meta = meta
+        self.net_hash = file_hash(path)
+        self.result_cache = None
+        self.initial_findings = {i: finding for i, finding in enumerate(meta.initial_findings.tolist()) if finding >= 0}
+        self.reset()
 
     def get_num_nodes(self) -> int:
         """get the number of nodes in a network"""
-        return N.LengthNodeList_bn(N.GetNetNodes_bn(self.net))
+        return len(self.nodes)
 
     def net_itr(self) -> Generator[NeticaNode, None, None]:
         """iterator over the nodes in a network"""
@@ -137,7 +823,7 @@ class NeticaGraph:
 
     def get_node_by_index(self, node_idx:int) -> NeticaNode:
         """get a node by its index"""
-        return N.NthNode_bn(N.GetNetNodes_bn(self.net), node_idx)
+        return self.nodes[node_idx]
     
     def get_node_by_name(self, node_name:str) -> NeticaNode:
         """get a node by its name. (make sure that the self.node_names dict is populated before calling this)"""
@@ -158,33 +844,40 @@ class NeticaGraph:
         else:
             raise TypeError(f"node must be either a string, int, or NeticaNode, not {type(node)}")
     
+    def get_node_index(self, node:int|str|NeticaNode) -> int:
+        """get the index of a node given its index, name, or the node itself"""
+        if isinstance(node, int):
+            if not 0 <= node < len(self.nodes):
+                raise IndexError(f"node index {node} out of range for network with {len(self.nodes)} nodes")
+            return node
+        if isinstance(node, NeticaNode):
+            node = N.GetNodeName_bn(node).decode('utf-8')
+        try:
+            return self.node_names[node]
+        except KeyError:
+            raise KeyError(f"node `{node}` does not exist in this network") from None
+
     def get_node_name(self, node:int|str|NeticaNode) -> str:
         #TODO: -> node comes from net_itr... maybe make this just take in the index of the node?
         """get the name of a node"""
-        node = self.get_node(node)
-        return N.GetNodeName_bn(node).decode('utf-8')
+        return str(self.meta.node_names[self.get_node_index(node)])
 
     def get_node_type(self, node:int|str|NeticaNode) -> NodeType:
         """get the type of a node. node may be either the index, or the name of the node"""
-        node = self.get_node(node)
-        raw_type = N.GetNodeType_bn(node)
-        return NodeType(raw_type)
+        return NodeType(int(self.meta.node_types[self.get_node_index(node)]))
 
     def get_node_kind(self, node:int|str|NeticaNode) -> NodeKind:
         """get the kind of a node"""
-        node = self.get_node(node)
-        raw_kind = N.GetNodeKind_bn(node)
-        return NodeKind(raw_kind)
+        return NodeKind(int(self.meta.node_kinds[self.get_node_index(node)]))
 
     def get_num_node_states(self, node:int|str|NeticaNode) -> int:
         #TODO: -> node comes from net_itr... maybe make this just take in the index of the node?
         """get the number of states of a node cane take on, or 0 if it is a continuous node"""
-        node = self.get_node(node)
-        return N.GetNodeNumberStates_bn(node)
+        return int(self.meta.num_states[self.get_node_index(node)])
     
     def check_node_state_index_valid(self, node:int|str|NeticaNode, state_idx:int):
         """checks that the state index is valid"""
-        node = self.get_node(node)
+        node = self.get_node_index(node)
         num_states = self.get_num_node_states(node)
         if state_idx >= num_states:
             raise ValueError(f"state_idx given ({state_idx}) must be less than the number of states ({num_states})")
@@ -193,7 +886,7 @@ class NeticaGraph:
 
     def get_node_state_by_name(self, node:int|str|NeticaNode, state_name:str) -> int:
         """get the index of a state of a node, given its name. Mainly just checks that the state name is valid"""
-        node = self.get_node(node)
+        node = self.get_node_index(node)
         state_map = self.node_state_names[self.get_node_name(node)]
         if state_map is None:
             raise ValueError(f"node {self.get_node_name(node)} has no named states. Instead provide the state index (0-{self.get_num_node_states(node)-1})")
@@ -202,52 +895,243 @@ class NeticaGraph:
         return state_map[state_name]
     
     def get_node_state(self, node:int|str|NeticaNode, state:int|str) -> int:
-        """get the index of a state of a node, given its name or index"""
-        node = self.get_node(node)
+        """get the index of a state of a node, given its name or index, or {"value": x} for the state a real value x falls in"""
+        node = self.get_node_index(node)
         if isinstance(state, int):
             self.check_node_state_index_valid(node, state)
             return state
         elif isinstance(state, str):
             return self.get_node_state_by_name(node, state)
+        elif isinstance(state, Mapping) and 'value' in state:
+            return self.meta.real_value_state(node, state['value'])
         else:
-            raise TypeError(f"state must be either a string or int, not {type(state)}")
+            raise TypeError(f"state must be either a string, int or {{'value': real value}}, not {type(state)}")
+
+    def get_node_bin_edges(self, node:int|str|NeticaNode) -> np.ndarray:
+        """the bin edges [n_states+1] of a node, which real values are discretized with (see `NetMetadata.get_bin_edges`)"""
+        return self.meta.get_bin_edges(self.get_node_index(node))
+
+    def discretize(self, node:int|str|NeticaNode, values:float|np.ndarray, *, clip:bool=True) -> np.ndarray:
+        """the state index of each of an array of real values for a node (see `NetMetadata.discretize`)"""
+        return self.meta.discretize(self.get_node_index(node), values, clip=clip)
 
     def get_node_state_name(self, node:int|str|NeticaNode, state:int|str) -> str:
         #TODO: -> node comes from net_itr... maybe make this just take in the index of the node?
         """get the name of a state of a node"""
-        node = self.get_node(node)
-        state_index = self.get_node_state(node, state)
-        return N.GetNodeStateName_bn(node, state_index).decode('utf-8')  
+        node_idx = self.get_node_index(node)
+        state_index = self.get_node_state(node_idx, state)
+        return str(self.meta.state_names[self.meta.state_offsets[node_idx] + state_index])
 
+    @PROFILER.method('NeticaGraph.enter_finding', tags=graph_tags)
     def enter_finding(self, node:int|str|NeticaNode, state:int|str, *, retract=False, verbose=False):
-        node = self.get_node(node)
-        node_name = self.get_node_name(node)
+        """
+        enter a finding for a single node, replacing any finding it already has (see `enter_findings`)
 
-        # retract finding. Certain nodes require this before entering a new finding
-        if retract:
-            N.RetractNodeFindings_bn(node)
-            if verbose:
-                print(f"retracting {node_name}")
+        `retract` is no longer needed, since an existing finding is always retracted first. It is kept so that old callers still work
+        """
+        self.enter_findings({node: state}, verbose=verbose)
 
-        # enter finding via the state index
-        state_index = self.get_node_state(node, state)
-        N.EnterFinding_bn(node, state_index)
-        if verbose:
-            print(f"setting {node_name} to {state}")
+    @PROFILER.method('NeticaGraph.enter_findings', tags=graph_tags)
+    def enter_findings(self, findings:Mapping[int|str|NeticaNode, int|str|None], *, verbose=False):
+        """
+        enter the findings for several nodes at once, as {node: state}. A state of None retracts the node's finding
 
-    
+        Every node and state is checked before the net is touched, so an invalid finding leaves the net unchanged.
+        Nodes that already have a finding (e.g. one saved in the .neta file) have it retracted before the new one is entered,
+        and nodes already in the requested state are skipped. Auto-updating is off, so however many findings change,
+        netica propagates once, when beliefs are next requested.
+        """
+        self.touch()
+
+        # validate everything up front, against the precomputed name/state tables
+        changes = []
+        for node, state in findings.items():
+            node_idx = self.get_node_index(node)
+            state_idx = None if state is None else self.get_node_state(node_idx, state)
+            if self.findings.get(node_idx) != state_idx:
+                changes.append((node_idx, state_idx, state))
+        if not changes:
+            return
+
+        self.findings_changed()
+        for node_idx, state_idx, state in changes:
+            node = self.nodes[node_idx]
+            if node_idx in self.findings:
+                N.RetractNodeFindings_bn(node)
+                del self.findings[node_idx]
+                if verbose:
+                    print(f"retracting {self.get_node_name(node_idx)}")
+            if state_idx is not None:
+                N.EnterFinding_bn(node, state_idx)
+                self.findings[node_idx] = state_idx
+                if verbose:
+                    print(f"setting {self.get_node_name(node_idx)} to {state}")
+
+    def retract_finding(self, node:int|str|NeticaNode):
+        """retract any finding entered for a single node"""
+        self.enter_findings({node: None})
+
+    def findings_changed(self):
+        """invalidate everything derived from the current findings"""
+        self.belief_cache.clear()
+        self._evidence_key = None
+
+    def evidence_key(self) -> str:
+        """canonical string describing the findings currently entered"""
+        if self._evidence_key is None:
+            self._evidence_key = self.meta.evidence_key(self.findings)
+        return self._evidence_key
+
+    @PROFILER.method('NeticaGraph.get_node_belief', tags=graph_tags)
     def get_node_belief(self, node:int|str|NeticaNode, state:int|str) -> float:
-        node = self.get_node(node)
-        node_name = self.get_node_name(node)
-        node_state = self.get_node_state_name(node, state)
-        belief = N.GetNodeBelief(node_name.encode('utf-8'), node_state.encode('utf-8'), self.net)
-        return belief
+        node_idx = self.get_node_index(node)
+        state_index = self.get_node_state(node_idx, state)
+        return float(self.get_node_beliefs(node_idx)[state_index])
+
+    @PROFILER.method('NeticaGraph.get_node_beliefs', tags=graph_tags)
+    def get_node_beliefs(self, node:int|str|NeticaNode) -> np.ndarray:
+        """get the belief of every state of a node as an array of shape [n_states]. Cached until the findings change"""
+        self.touch()
+        node_idx = self.get_node_index(node)
+        beliefs = self.belief_cache.get(node_idx)
+        if beliefs is None:
+            use_result_cache = self.result_cache is not None and self.net_hash is not None
+            if use_result_cache:
+                beliefs = self.result_cache.get_node(self.net_hash, self.evidence_key(), self.get_node_name(node_idx))
+            if beliefs is None:
+                num_states = self.meta.num_states[node_idx]
+                beliefs = np.array(N.GetNodeBeliefs_bn(self.nodes[node_idx]), dtype=np.float64)[:num_states]
+                if use_result_cache:
+                    self.result_cache.put_node(self.net_hash, self.evidence_key(), self.get_node_name(node_idx), beliefs)
+            beliefs.flags.writeable = False
+            self.belief_cache[node_idx] = beliefs
+        return beliefs
+
+    @PROFILER.method('NeticaGraph.get_beliefs', tags=graph_tags)
+    def get_beliefs(self, nodes:list[int|str|NeticaNode]) -> np.ndarray:
+        """get the beliefs of several nodes as an array of shape [n_nodes, max_states], padded with zeros for nodes with fewer states"""
+        return pad_beliefs([self.get_node_beliefs(node) for node in nodes])
     
+    @PROFILER.method('NeticaGraph.get_node_cpt', tags=graph_tags)
+    def get_node_cpt(self, node:int|str|NeticaNode) -> np.ndarray:
+        """get the conditional probability table of a node as an array of shape [*parent_states, n_states], with parents in the order of `meta.get_parents`"""
+        self.touch()
+        node_idx = self.get_node_index(node)
+        return read_node_cpt(self.nodes[node_idx], self.meta.cpt_shape(node_idx))
+
+    def set_node_cpt(self, node:int|str|NeticaNode, cpt:np.ndarray):
+        """replace the conditional probability table of a node, with the same shape as `get_node_cpt` returns"""
+        self.touch()
+        node_idx = self.get_node_index(node)
+        cpt = np.asarray(cpt, dtype=np.float64)
+        if cpt.shape != self.meta.cpt_shape(node_idx):
+            raise ValueError(f"the CPT of node {self.get_node_name(node_idx)} has shape {self.meta.cpt_shape(node_idx)}, not {cpt.shape}")
+        write_node_cpt(self.nodes[node_idx], cpt)
+        self.tables_changed()
+        self.findings_changed()
+
+    def tables_changed(self):
+        """
+        forget that the net matches its file, after a CPT was written: beliefs are no longer read from or written to the persistent
+        result cache under the file's hash, and the graph isn't given back to the pool or loaded into for structure sharing
+        """
+        self.net_hash = None
+        self.result_cache = None
+        self.tables = None
+
+    @PROFILER.method('NeticaGraph.get_sensitivity', tags=graph_tags)
+    def get_sensitivity(self, query:int|str|NeticaNode, nodes:list[int|str|NeticaNode]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        sensitivity of `query` to a finding at each of `nodes`, given the findings currently entered.
+        Returns (mutual information [n_nodes] in bits, expected reduction in the variance of query's real value [n_nodes]).
+
+        A single netica sensitivity object is created for `query` and reused for every node. The variance reduction
+        is only defined if `query` has levels, otherwise it is NaN
+        """
+        self.touch()
+        query_idx = self.get_node_index(query)
+        node_idxs = [self.get_node_index(node) for node in nodes]
+        real_valued = len(self.meta.get_levels(query_idx)) > 0
+
+        what = Sensitivity.ENTROPY_SENSV.value
+        if real_valued:
+            what |= Sensitivity.VARIANCE_OF_REAL_SENSV.value
+
+        mutual_info = np.zeros(len(node_idxs))
+        variance = np.full(len(node_idxs), np.nan)
+        node_list = new_node_list(self.net, [self.nodes[i] for i in node_idxs])
+        sensv = N.NewSensvToFinding_bn(self.nodes[query_idx], node_list, what)
+        try:
+            for k, node_idx in enumerate(node_idxs):
+                mutual_info[k] = N.MutualInfo_bn(sensv, self.nodes[node_idx])
+                if real_valued:
+                    variance[k] = N.VarianceOfReal_bn(sensv, self.nodes[node_idx])
+        finally:
+            N.DeleteSensvToFinding_bn(sensv)
+            N.DeleteNodeList_bn(node_list)
+        return mutual_info, variance
+
+    @PROFILER.method('NeticaGraph.generate_cases', tags=graph_tags)
+    def generate_cases(self, nodes:list[int|str|NeticaNode], n:int, *, seed:int=0, method:SamplingMethod=SamplingMethod.DEFAULT_SAMPLING) -> np.ndarray:
+        """
+        draw n random cases of `nodes` under the current findings with netica's own sampler, as an array [n, n_nodes] of state indices.
+        This costs a few netica calls per case, see `sample` for drawing many cases in bulk
+        """
+        self.touch()
+        node_idxs = [self.get_node_index(node) for node in nodes]
+        out = np.empty((n, len(node_idxs)), dtype=np.int32)
+        free = [(k, self.nodes[i]) for k, i in enumerate(node_idxs) if i not in self.findings]
+        for k, i in enumerate(node_idxs):
+            if i in self.findings:
+                out[:, k] = self.findings[i]
+
+        node_list = new_node_list(self.net, [node for _, node in free])
+        rand = N.NewRandomGenerator_ns(str(seed).encode('utf-8'), self.manager.env, b"")
+        try:
+            for r in range(n):
+                if N.GenerateRandomCase_bn(node_list, method.value, 0, rand) < 0:
+                    raise RuntimeError(f"netica could not generate a random case (the findings may be inconsistent)")
+                # the case is entered as findings, read it back and retract it
+                for k, node in free:
+                    out[r, k] = N.GetNodeFinding_bn(node)
+                    N.RetractNodeFindings_bn(node)
+        finally:
+            N.DeleteRandomGen_ns(rand)
+            N.DeleteNodeList_bn(node_list)
+        return out
+
+    def sample(self, nodes:list[int|str|NeticaNode], n:int, *, seed:int|None=None, chunk_size:int=1 << 20) -> np.ndarray:
+        """draw n random cases of `nodes` under the current findings, as an array [n, n_nodes] of state indices (see sampling.py)"""
+        # imported here, since sampling.py imports this module
+        from sampling import Sampler
+        return Sampler(self, nodes, seed=seed).sample(n, chunk_size=chunk_size)
+
+    def iter_samples(self, nodes:list[int|str|NeticaNode], n:int, *, seed:int|None=None, chunk_size:int=1 << 20) -> Generator[np.ndarray, None, None]:
+        """like `sample`, but yields the cases in chunks of at most chunk_size rows, so that memory stays bounded"""
+        from sampling import Sampler
+        yield from Sampler(self, nodes, seed=seed).iter_samples(n, chunk_size=chunk_size)
+
     def get_node_finding(self, node:int|str|NeticaNode) -> int: #TODO: figure out what this maps to...
         node = self.get_node(node)
         finding = N.GetNodeFinding_bn(node)
         return finding
     
+    @PROFILER.method('NeticaGraph.retract_all', tags=graph_tags)
+    def retract_all(self):
+        """retract all findings in the network, including those saved in the .neta file"""
+        self.touch()
+        N.RetractNetFindings_bn(self.net)
+        self.findings.clear()
+        self.findings_changed()
+
+    def reset(self):
+        """retract all findings, and re-enter the findings that were saved in the .neta file"""
+        self.retract_all()
+        for node_idx, state_idx in self.initial_findings.items():
+            N.EnterFinding_bn(self.get_node_by_index(node_idx), state_idx)
+        self.findings.update(self.initial_findings)
+        self.findings_changed()
+
     def cleanup_net(self):
-        """run when the object is garbage collected"""
-        N.DeleteNet_bn(self.net)
\ No newline at end of file
+        """delete the net (see `close`)"""
+        self.close()
\ No newline at end of file
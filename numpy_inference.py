@@ -0,0 +1,330 @@
+"""
+Pure NumPy exact inference for networks exported from Netica.
+
+`export_net` reads a network's structure, states, levels and CPTs through a loaded NeticaGraph and saves them to an .npz archive.
+`NumpyGraph` loads an archive and answers queries by variable elimination over NumPy tensors, with a leading batch axis so that
+thousands of evidence rows are answered in one call. It mirrors the NeticaGraph finding/belief methods, so it can stand in for
+a loaded net in code that only enters findings and reads beliefs.
+
+Usage:
+    python numpy_inference.py export neta/limpopo.neta [more.neta ...]
+    python numpy_inference.py check neta/limpopo.neta --rows 100
+"""
+
+from __future__ import annotations
+from netica import NeticaGraph, NetMetadata, CACHE_DIR, file_hash, pad_beliefs
+from string import ascii_letters
+from typing import Mapping
+import argparse
+import os
+import numpy as np
+
+from os.path import join
+
+
+def archive_path(neta_path:str) -> str:
+    """default location of the exported archive for a .neta file"""
+    return join(CACHE_DIR, 'cpts', f'{file_hash(neta_path)}.npz')
+
+
+def export_net(net:NeticaGraph, path:str):
+    """save the metadata and CPTs of a loaded network to an .npz archive"""
+    save_archive(path, net.meta, [net.get_node_cpt(i) for i in range(net.get_num_nodes())])
+
+
+def save_archive(path:str, meta:NetMetadata, cpts:list[np.ndarray]):
+    arrays = {name: getattr(meta, name) for name in NetMetadata.FIELDS}
+    for i, cpt in enumerate(cpts):
+        arrays[f'cpt_{i}'] = cpt
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+    np.savez_compressed(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_archive(path:str) -> tuple[NetMetadata, list[np.ndarray]]:
+    """the metadata and CPTs saved by `save_archive`"""
+    with np.load(path, allow_pickle=False) as data:
+        meta = NetMetadata(**{name: data[name] for name in NetMetadata.FIELDS})
+        cpts = [data[f'cpt_{i}'] for i in range(len(meta))]
+    return meta, cpts
+
+
+class NumpyGraph:
+    def __init__(self, meta:NetMetadata, cpts:list[np.ndarray], *, chunk_elements:int=1 << 24):
+        self.meta = meta
+        self.cpts = cpts
+        self.node_names = meta.name_index
+        self.cards = meta.num_states.astype(np.int64)
+        self.parents = [meta.get_parents(i).tolist() for i in range(len(meta))]
+
+        # limit on the number of elements of the largest intermediate table, across the whole batch
+        self.chunk_elements = chunk_elements
+
+        self.initial_findings = {i: f for i, f in enumerate(meta.initial_findings.tolist()) if f >= 0}
+        self.findings = dict(self.initial_findings)
+        self.belief_cache: dict[int, np.ndarray] = {}
+
+        # elimination orders, keyed by (query node, evidence nodes)
+        self.plans: dict[tuple[int, frozenset[int]], tuple[list[int], list[int], int]] = {}
+
+    @classmethod
+    def load(cls, path:str, **kwargs) -> "NumpyGraph":
+        meta, cpts = load_archive(path)
+        return cls(meta, cpts, **kwargs)
+
+    @classmethod
+    def from_neta(cls, neta_path:str, **kwargs) -> "NumpyGraph":
+        """load the archive exported for a .neta file (see `python numpy_inference.py export`)"""
+        path = archive_path(neta_path)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"no exported archive for {neta_path}. Run `python numpy_inference.py export {neta_path}` first")
+        return cls.load(path, **kwargs)
+
+    # --- same surface as NeticaGraph ---
+
+    def get_num_nodes(self) -> int:
+        return len(self.meta)
+
+    def get_node_index(self, node:int|str) -> int:
+        if isinstance(node, str):
+            try:
+                return self.node_names[node]
+            except KeyError:
+                raise KeyError(f"node `{node}` does not exist in this network") from None
+        if not 0 <= node < len(self.meta):
+            raise IndexError(f"node index {node} out of range for network with {len(self.meta)} nodes")
+        return int(node)
+
+    def get_node_name(self, node:int|str) -> str:
+        return str(self.meta.node_names[self.get_node_index(node)])
+
+    def get_num_node_states(self, node:int|str) -> int:
+        return int(self.cards[self.get_node_index(node)])
+
+    def get_node_state(self, node:int|str, state:int|str) -> int:
+        node_idx = self.get_node_index(node)
+        return self.meta.resolve_findings({self.get_node_name(node_idx): state})[node_idx]
+
+    def discretize(self, node:int|str, values:float|np.ndarray, *, clip:bool=True) -> np.ndarray:
+        return self.meta.discretize(self.get_node_index(node), values, clip=clip)
+
+    def enter_finding(self, node:int|str, state:int|str, *, retract=False, verbose=False):
+        self.enter_findings({node: state}, verbose=verbose)
+
+    def enter_findings(self, findings:Mapping[int|str, int|str|None], *, verbose=False):
+        """enter several findings at once, with the same semantics as `NeticaGraph.enter_findings`"""
+        changes = [(self.get_node_index(node), state) for node, state in findings.items()]
+        changes = [(node_idx, None if state is None else self.get_node_state(node_idx, state), state) for node_idx, state in changes]
+        for node_idx, state_idx, state in changes:
+            if state_idx is None:
+                self.findings.pop(node_idx, None)
+            else:
+                self.findings[node_idx] = state_idx
+            if verbose:
+                print(f"setting {self.get_node_name(node_idx)} to {state}")
+        self.belief_cache.clear()
+
+    def retract_finding(self, node:int|str):
+        self.enter_findings({node: None})
+
+    def retract_all(self):
+        self.findings.clear()
+        self.belief_cache.clear()
+
+    def reset(self):
+        self.findings = dict(self.initial_findings)
+        self.belief_cache.clear()
+
+    def get_node_beliefs(self, node:int|str) -> np.ndarray:
+        node_idx = self.get_node_index(node)
+        if node_idx not in self.belief_cache:
+            evidence_nodes = list(self.findings)
+            evidence = np.array([[self.findings[i] for i in evidence_nodes]], dtype=np.int64).reshape(1, len(evidence_nodes))
+            self.belief_cache[node_idx] = self.infer(evidence, evidence_nodes, [node_idx])[0, 0, :self.cards[node_idx]]
+        return self.belief_cache[node_idx]
+
+    def get_node_belief(self, node:int|str, state:int|str) -> float:
+        return float(self.get_node_beliefs(node)[self.get_node_state(node, state)])
+
+    def get_beliefs(self, nodes:list[int|str]) -> np.ndarray:
+        return pad_beliefs([self.get_node_beliefs(node) for node in nodes])
+
+    # --- batched inference ---
+
+    def query(self, rows:list[dict[str, int|str|None]], nodes:list[int|str]) -> np.ndarray:
+        """
+        beliefs of `nodes` for each row of findings, as an array of shape [n_rows, n_nodes, max_states]
+
+        As in the config files, each row's findings are entered on top of those saved in the file, and None leaves a node at its default
+        """
+        resolved = [self.meta.resolve_findings({k: v for k, v in row.items() if v is not None}) for row in rows]
+        evidence_nodes = sorted(set().union(*resolved)) if resolved else []
+        evidence = np.array([[r.get(i, -1) for i in evidence_nodes] for r in resolved], dtype=np.int64).reshape(len(rows), len(evidence_nodes))
+        return self.infer(evidence, evidence_nodes, [self.get_node_index(n) for n in nodes])
+
+    def infer(self, evidence:np.ndarray, evidence_nodes:list[int], query_nodes:list[int]) -> np.ndarray:
+        """
+        exact posterior beliefs of `query_nodes` given a batch of evidence.
+
+        evidence: int array [batch, n_evidence_nodes] of state indices, with -1 for no finding on that node in that row
+        returns: array [batch, n_query_nodes, max_states]. Rows with impossible evidence are NaN
+        """
+        batch = len(evidence)
+        max_states = int(max((self.cards[q] for q in query_nodes), default=0))
+        out = np.zeros((batch, len(query_nodes), max_states))
+
+        # indicator (likelihood) vector of each evidence node for every row
+        likelihoods = []
+        for j, node_idx in enumerate(evidence_nodes):
+            states = evidence[:, j]
+            lam = np.ones((batch, self.cards[node_idx]))
+            observed = states >= 0
+            lam[observed] = 0
+            lam[np.flatnonzero(observed), states[observed]] = 1
+            likelihoods.append(lam)
+
+        for k, q in enumerate(query_nodes):
+            order, relevant, max_size = self.plan(q, evidence_nodes)
+            chunk = max(1, self.chunk_elements // max_size)
+            for start in range(0, batch, chunk):
+                stop = min(start + chunk, batch)
+                factors = [((*self.parents[i], i), self.cpts[i][None]) for i in relevant]
+                factors += [((e,), lam[start:stop]) for e, lam in zip(evidence_nodes, likelihoods)]
+                marginal = self.eliminate(factors, order, q)
+                total = marginal.sum(axis=-1, keepdims=True)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    out[start:stop, k, :self.cards[q]] = np.where(total > 0, marginal / total, np.nan)
+        return out
+
+    def plan(self, query:int, evidence_nodes:list[int]) -> tuple[list[int], list[int], int]:
+        """
+        (elimination order, relevant nodes, size of the largest intermediate table) for a query.
+
+        Only the query, the evidence nodes and their ancestors are relevant, every other node sums out to 1.
+        The order is chosen greedily by minimum fill-in, breaking ties by the size of the resulting table.
+        """
+        key = (query, frozenset(evidence_nodes))
+        if key in self.plans:
+            return self.plans[key]
+
+        relevant, stack = set(), [query, *evidence_nodes]
+        while stack:
+            i = stack.pop()
+            if i not in relevant:
+                relevant.add(i)
+                stack.extend(self.parents[i])
+
+        # moral graph of the relevant nodes
+        neighbors = {i: set() for i in relevant}
+        for i in relevant:
+            family = [*self.parents[i], i]
+            for a in family:
+                neighbors[a].update(f for f in family if f != a)
+
+        order, max_size = [], int(self.cards[query])
+        remaining = set(relevant) - {query}
+        while remaining:
+            def cost(v):
+                nbrs = list(neighbors[v])
+                fill = sum(1 for a in range(len(nbrs)) for b in range(a + 1, len(nbrs)) if nbrs[b] not in neighbors[nbrs[a]])
+                return fill, int(np.prod([self.cards[n] for n in nbrs + [v]], dtype=np.float64))
+            v = min(remaining, key=cost)
+            max_size = max(max_size, cost(v)[1])
+            for a in neighbors[v]:
+                neighbors[a].update(n for n in neighbors[v] if n != a)
+                neighbors[a].discard(v)
+            del neighbors[v]
+            remaining.discard(v)
+            order.append(v)
+
+        self.plans[key] = (order, sorted(relevant), max_size)
+        return self.plans[key]
+
+    @staticmethod
+    def eliminate(factors:list[tuple[tuple[int, ...], np.ndarray]], order:list[int], keep:int) -> np.ndarray:
+        """sum out each variable in `order` from the product of `factors`. Factor tables have a leading batch axis (of size 1 or batch)"""
+        for v in order:
+            touching = [f for f in factors if v in f[0]]
+            factors = [f for f in factors if v not in f[0]]
+            out_vars = tuple(sorted({u for vars, _ in touching for u in vars} - {v}))
+            factors.append((out_vars, _einsum(touching, out_vars)))
+        return _einsum(factors, (keep,))
+
+
+def _einsum(factors:list[tuple[tuple[int, ...], np.ndarray]], out_vars:tuple[int, ...]) -> np.ndarray:
+    """multiply factors and sum out every variable not in out_vars, keeping the leading batch axis"""
+    letters: dict[int, str] = {}
+    for vars, _ in factors:
+        for v in vars:
+            letters.setdefault(v, ascii_letters[len(letters)])
+    subscripts = ','.join('...' + ''.join(letters[v] for v in vars) for vars, _ in factors)
+    return np.einsum(f"{subscripts}->...{''.join(letters[v] for v in out_vars)}", *(table for _, table in factors), optimize=True)
+
+
+def prior_samples(graph:NumpyGraph, n:int, rng:np.random.Generator) -> np.ndarray:
+    """states [n, nodes] drawn from the network's joint distribution without any findings, sampling each node after its parents"""
+    samples = np.zeros((n, graph.get_num_nodes()), dtype=np.int64)
+    done: set[int] = set()
+    while len(done) < graph.get_num_nodes():
+        for i in range(graph.get_num_nodes()):
+            if i in done or not done.issuperset(graph.parents[i]):
+                continue
+            probs = np.broadcast_to(graph.cpts[i][tuple(samples[:, p] for p in graph.parents[i])], (n, graph.cards[i]))
+            cumulative = probs.cumsum(axis=-1)
+            samples[:, i] = np.minimum((rng.random((n, 1)) * cumulative[:, -1:] >= cumulative).sum(axis=-1), graph.cards[i] - 1)
+            done.add(i)
+    return samples
+
+
+def random_evidence(graph:NumpyGraph, n:int, rng:np.random.Generator, *, max_fraction:float=0.5) -> list[dict[str, int|None]]:
+    """
+    `n` rows of findings on any nodes, root or not: each row is a sample of the joint distribution with a random fraction (up to
+    `max_fraction`) of its nodes revealed, so that its evidence is always possible. Every other node is None, which also retracts
+    the findings saved in the file
+    """
+    samples = prior_samples(graph, n, rng)
+    revealed = rng.random(samples.shape) < rng.random((n, 1)) * max_fraction
+    names = [graph.get_node_name(i) for i in range(graph.get_num_nodes())]
+    return [{name: int(state) if shown else None for name, state, shown in zip(names, sample, mask)} for sample, mask in zip(samples, revealed)]
+
+
+def cross_check(net:NeticaGraph, graph:NumpyGraph, rows:list[dict[str, int|str|None]], nodes:list[str]) -> float:
+    """
+    run each row of findings through both netica and the numpy backend, and return the largest absolute difference in beliefs.
+    As in `NumpyGraph.query`, each row is entered on top of the findings saved in the file, and None retracts a node's finding
+    """
+    expected = np.zeros((len(rows), len(nodes), int(max(graph.cards[graph.get_node_index(n)] for n in nodes))))
+    for r, row in enumerate(rows):
+        net.reset()
+        net.enter_findings(row)
+        expected[r] = pad_beliefs([net.get_node_beliefs(n) for n in nodes]).reshape(len(nodes), -1)
+    return float(np.nanmax(np.abs(graph.query(rows, nodes) - expected), initial=0.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export netica networks to numpy CPT archives, and cross check the numpy backend against netica')
+    parser.add_argument('command', choices=['export', 'check'])
+    parser.add_argument('neta', nargs='+', help='paths to .neta files')
+    parser.add_argument('--rows', type=int, default=100, help='number of random evidence rows to cross check (default: 100)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    from parallel import get_manager
+    for neta_path in args.neta:
+        with get_manager().new_graph(neta_path) as net:
+            if args.command == 'export':
+                export_net(net, archive_path(neta_path))
+                print(f'exported {neta_path} -> {archive_path(neta_path)}')
+                continue
+
+            # findings on any nodes (not only the roots, which are the easy case for variable elimination), checking every node's beliefs
+            graph = NumpyGraph.from_neta(neta_path)
+            rows = random_evidence(graph, args.rows, np.random.default_rng(args.seed))
+            nodes = [graph.get_node_name(i) for i in range(graph.get_num_nodes())]
+            print(f'{neta_path}: max abs belief difference over {args.rows} rows = {cross_check(net, graph, rows, nodes):.3g}')
+
+
+if __name__ == '__main__':
+    main()
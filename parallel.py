@@ -0,0 +1,225 @@
+from __future__ import annotations
+from netica import NeticaManager, NeticaGraph, NeticaNode
+from instrumentation import PROFILER
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Mapping
+import multiprocessing
+import threading
+import time
+import traceback
+import numpy as np
+
+
+# each process owns a single netica environment, created the first time it is needed in that process
+_manager: NeticaManager | None = None
+
+
+def init_worker():
+    """
+    initializer of worker processes. A forked worker inherits a copy of this process's `_manager` and profile: the manager is dropped
+    without closing anything (its netica environment and nets belong to the parent), so the worker creates its own, and the profile is
+    cleared, so the worker only sends back what it recorded itself
+    """
+    global _manager
+    if _manager is not None:
+        for graph in list(_manager.graphs):
+            graph.finallizer.detach()
+        _manager.finilizer.detach()
+        _manager = None
+    # the lock may have been held by another thread of the parent when it forked
+    PROFILER.lock = threading.Lock()
+    PROFILER.reset()
+
+def get_manager(**options) -> NeticaManager:
+    """get the NeticaManager for the current process. `options` (see NeticaManager) only apply when it is first created"""
+    global _manager
+    if _manager is None:
+        _manager = NeticaManager(**options)
+    return _manager
+
+
+@dataclass
+class SiteResult:
+    site: str
+    result: Any = None
+    error: str | None = None
+    profile: list[dict] | None = None  # what a worker process profiled while running the site (see instrumentation.py)
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def run_site(fn:Callable[..., Any], site:str, args:tuple) -> SiteResult:
+    """run `fn(*args)` for a single site, capturing any exception as the site's error"""
+    with PROFILER.tags(site=site), PROFILER.phase('site'):
+        try:
+            result = SiteResult(site, result=fn(*args))
+        except Exception:
+            result = SiteResult(site, error=traceback.format_exc())
+
+    # a worker's profile goes back to the main process with the result
+    if PROFILER.enabled and multiprocessing.parent_process() is not None:
+        result.profile = PROFILER.snapshot()
+        PROFILER.reset()
+    return result
+
+
+def run_sites(fn:Callable[..., Any], sites:list[tuple[str, tuple]], workers:int=1) -> list[SiteResult]:
+    """
+    run `fn(*args)` for each `(site, args)` in `sites`, optionally across a pool of worker processes
+
+    `fn` must be a module level function so that it can be sent to the workers. It should use `get_manager()` to load networks,
+    so that each process creates its netica environment once, and only if it is actually needed.
+    Results are returned in the same order as `sites`. A site that fails does not stop the others, instead its result has `error` set.
+    """
+    if workers <= 1 or len(sites) <= 1:
+        return [run_site(fn, site, args) for site, args in sites]
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(sites)), initializer=init_worker) as pool:
+        futures = [pool.submit(run_site, fn, site, args) for site, args in sites]
+
+        results = []
+        for (site, _), future in zip(sites, futures):
+            try:
+                results.append(future.result())
+                if results[-1].profile is not None:
+                    PROFILER.merge(results[-1].profile)
+            except Exception:
+                # e.g. the worker process crashed inside netica
+                results.append(SiteResult(site, error=traceback.format_exc()))
+
+    return results
+
+
+def report_failures(results:list[SiteResult]) -> list[SiteResult]:
+    """print the error for each failed site, and return the failed results"""
+    failures = [r for r in results if not r.ok]
+    for r in failures:
+        print(f"ERROR: site '{r.site}' failed:\n{r.error}")
+    return failures
+
+
+Scenario = Mapping[int|str|NeticaNode, int|str|None]
+
+# whether netica calls from different threads run at the same time (see `netica_releases_gil`), once measured
+_releases_gil: bool|None = None
+
+def netica_releases_gil(net:NeticaGraph, *, seconds:float=0.05) -> bool:
+    """
+    whether the NeticaPy build releases the GIL during netica calls, so that threads can propagate different nets at the same time.
+    Measured once per process, by timing propagations of two copies of `net`, first one after the other, then from two threads at once
+    """
+    global _releases_gil
+    if _releases_gil is not None:
+        return _releases_gil
+
+    # toggle the finding of a node with several states, so that every round has to propagate
+    node_idx = next(i for i, n in enumerate(net.meta.num_states.tolist()) if n > 1)
+    query_idx = len(net.nodes) - 1
+    copies = [net.clone(), net.clone()]
+    def propagate(graph:NeticaGraph, rounds:int):
+        for i in range(rounds):
+            graph.enter_findings({node_idx: i % 2})
+            graph.get_node_beliefs(query_idx)
+
+    try:
+        # enough rounds to take about `seconds`
+        rounds, start = 0, time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            propagate(copies[0], 10)
+            rounds += 10
+
+        start = time.perf_counter()
+        for graph in copies:
+            propagate(graph, rounds)
+        serial = time.perf_counter() - start
+
+        threads = [threading.Thread(target=propagate, args=(graph, rounds)) for graph in copies]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        concurrent = time.perf_counter() - start
+    finally:
+        for graph in copies:
+            graph.close()
+
+    _releases_gil = concurrent < 0.7 * serial
+    return _releases_gil
+
+
+def evaluate_scenarios(net:NeticaGraph, scenarios:list[dict[int, int|None]], nodes:list[int]) -> np.ndarray:
+    """beliefs [n_scenarios, n_nodes, max_states] of `nodes` under each scenario, entered in turn (only changed findings are re-entered)"""
+    beliefs = []
+    for scenario in scenarios:
+        net.enter_findings(scenario)
+        beliefs.append(net.get_beliefs(nodes))
+    return np.stack(beliefs) if beliefs else np.zeros((0, len(nodes), 0))
+
+
+def evaluate_scenarios_in_process(path:str, findings:dict[int, int], scenarios:list[dict[int, int|None]], nodes:list[int]) -> np.ndarray:
+    """`evaluate_scenarios` in a worker process, on its own copy of the net at `path` with `findings` entered first"""
+    with get_manager().new_graph(path) as net:
+        net.enter_findings({node_idx: findings.get(node_idx) for node_idx in set(net.findings) | set(findings)})
+        return evaluate_scenarios(net, scenarios, nodes)
+
+
+def run_scenarios(net:NeticaGraph, scenarios:list[Scenario], nodes:list[int|str|NeticaNode], *, workers:int=4, mode:str='auto') -> np.ndarray:
+    """
+    get the beliefs [n_scenarios, n_nodes, max_states] of `nodes` under each scenario {node: state}, spread over `workers` threads or processes.
+
+    Scenarios are entered on top of the net's current findings, and a node a scenario leaves out keeps the finding it had before
+    the run, so the results don't depend on which worker runs which scenario. Each worker runs a contiguous slice of the scenarios,
+    so scenarios ordered to change few findings at a time (e.g. by sweep.min_change_order) keep that benefit.
+
+    mode is one of
+    - 'threads': each thread owns a copy of the net (see `NeticaGraph.clone`), which costs one compile per thread and no file reads
+    - 'processes': each process reads and compiles the net's file itself (as in `run_sites`)
+    - 'auto': threads if netica calls release the GIL (see `netica_releases_gil`), otherwise processes
+    The net is left with the findings it had before the run.
+    """
+    if mode not in ('auto', 'threads', 'processes'):
+        raise ValueError(f"mode must be 'auto', 'threads' or 'processes', not `{mode}`")
+
+    # validate everything up front, and use indices, which can be sent to other processes
+    node_indices = [net.get_node_index(node) for node in nodes]
+    resolved = [
+        {net.get_node_index(node): None if state is None else net.get_node_state(node, state) for node, state in scenario.items()}
+        for scenario in scenarios
+    ]
+    base = {node_idx: net.findings.get(node_idx) for scenario in resolved for node_idx in scenario}
+    resolved = [{**base, **scenario} for scenario in resolved]
+
+    workers = max(1, min(workers, len(resolved)))
+    if workers == 1:
+        try:
+            return evaluate_scenarios(net, resolved, node_indices)
+        finally:
+            net.enter_findings(base)
+
+    chunks = [chunk.tolist() for chunk in np.array_split(np.arange(len(resolved)), workers)]
+    chunks = [[resolved[i] for i in chunk] for chunk in chunks]
+
+    if mode == 'auto':
+        mode = 'threads' if netica_releases_gil(net) else 'processes'
+
+    if mode == 'processes':
+        if net.path is None:
+            raise ValueError("running scenarios in processes needs a net that was loaded from a file")
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+            parts = list(pool.map(evaluate_scenarios_in_process, [net.path] * workers, [dict(net.findings)] * workers, chunks, [node_indices] * workers))
+    else:
+        # the net itself is the first thread's copy
+        copies = [net] + [net.clone() for _ in range(workers - 1)]
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                parts = list(pool.map(evaluate_scenarios, copies, chunks, [node_indices] * workers))
+        finally:
+            for graph in copies[1:]:
+                graph.close()
+            net.enter_findings(base)
+
+    return np.concatenate(parts)
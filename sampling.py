@@ -0,0 +1,300 @@
+"""
+Monte Carlo samples of the joint distribution of selected nodes, under the findings entered in a net.
+
+Samples are drawn exactly, by the chain rule over the selected nodes: the sample count is split over the states of the first node
+with a multinomial draw from its beliefs, then each state's share is split over the states of the second node using the beliefs
+with the first node's finding entered, and so on. Beliefs are needed once per distinct prefix of states, never once per sample.
+With Netica each prefix is a propagation (cached across chunks). Deep in the chain most prefixes hold only a few samples,
+so a prefix with fewer than `min_split_count` samples is instead finished case by case with netica's own random case generator,
+which costs a handful of calls per sample rather than a propagation per prefix.
+With the NumPy backend all the prefixes of a level are answered in one batched call, but each prefix is still a full inference,
+so it suits few or strongly dependent nodes (or moderate sample counts) better than netica does.
+Samples are produced in chunks of bounded size, as a compact integer array [chunk, selected_nodes] of state indices.
+
+Usage:
+    python sampling.py neta/limpopo.neta --config configs/limpopo.json -n 10000000 --event "FISH_ECO_END=Low,VEG_ECO_END=Low" [--backend numpy]
+"""
+
+from __future__ import annotations
+from netica import NeticaManager, NeticaGraph, NeticaNode
+from numpy_inference import NumpyGraph
+from stats import get_bin_edges
+from limpopo_common import output_nodes as limpopo_output_nodes
+from collections import OrderedDict
+from contextlib import nullcontext
+from typing import Generator
+import argparse
+import json
+import os
+import numpy as np
+
+
+def prefix_bytes(prefix:tuple[int, ...], probs:np.ndarray) -> int:
+    """approximate memory held by a cached conditional: its beliefs, its key tuple, and the dict entry"""
+    return probs.nbytes + 8 * len(prefix) + 200
+
+
+class Sampler:
+    """
+    draws samples of `nodes` under the findings entered in `net`
+
+    `net` is either a NeticaGraph, which costs one propagation per distinct prefix of states (cached across chunks) until the prefixes
+    hold fewer than `min_split_count` samples, which are then generated case by case, or a NumpyGraph (see numpy_inference.py),
+    which answers every prefix of a level in one batched call
+    """
+    def __init__(self, net:NeticaGraph|NumpyGraph, nodes:list[int|str|NeticaNode], *, seed:int|np.random.Generator|None=None, max_cached_bytes:int=256 << 20, min_split_count:int=64):
+        self.net = net
+        self.nodes = [net.get_node_index(node) for node in nodes]
+        self.num_states = np.array([net.get_num_node_states(node) for node in self.nodes], dtype=np.int64)
+        self.dtype = np.int8 if self.num_states.max(initial=0) <= np.iinfo(np.int8).max else np.int32
+        self.rng = np.random.default_rng(seed)
+
+        # findings of the selected nodes before sampling, which the nodes not yet fixed by a prefix are kept at
+        self.saved = {node: net.findings.get(node) for node in self.nodes}
+
+        # beliefs of nodes[len(prefix)] given the saved findings and the states in prefix, by prefix, from least to most recently used.
+        # Limited to about `max_cached_bytes`
+        self.conditionals: OrderedDict[tuple[int, ...], np.ndarray] = OrderedDict()
+        self.cached_bytes = 0
+        self.max_cached_bytes = max_cached_bytes
+        self.min_split_count = min_split_count if isinstance(net, NeticaGraph) else 0
+
+    def conditional(self, prefix:tuple[int, ...]) -> np.ndarray:
+        """distribution of the next node given the states of the nodes before it"""
+        probs = self.conditionals.get(prefix)
+        if probs is not None:
+            self.conditionals.move_to_end(prefix)
+            return probs
+
+        depth = len(prefix)
+        self.net.enter_findings({**self.saved, **dict(zip(self.nodes[:depth], prefix))})
+        probs = np.array(self.net.get_node_beliefs(self.nodes[depth]), dtype=np.float64)
+        probs /= probs.sum()
+
+        self.conditionals[prefix] = probs
+        self.cached_bytes += prefix_bytes(prefix, probs)
+        while self.cached_bytes > self.max_cached_bytes and self.conditionals:
+            self.cached_bytes -= prefix_bytes(*self.conditionals.popitem(last=False))
+        return probs
+
+    def batch_conditional(self, prefixes:np.ndarray) -> np.ndarray:
+        """distributions [n_prefixes, n_states] of the next node given each prefix [n_prefixes, depth] of states"""
+        depth = prefixes.shape[1]
+        if not isinstance(self.net, NumpyGraph):
+            return np.stack([self.conditional(tuple(prefix)) for prefix in prefixes.tolist()]).reshape(len(prefixes), -1)
+
+        # every finding except those of the nodes fixed by the prefix, followed by the prefix
+        fixed = [(node, state) for node, state in self.net.findings.items() if node not in self.nodes[:depth]]
+        evidence = np.empty((len(prefixes), len(fixed) + depth), dtype=np.int64)
+        evidence[:, :len(fixed)] = [state for _, state in fixed]
+        evidence[:, len(fixed):] = prefixes
+        evidence_nodes = [node for node, _ in fixed] + self.nodes[:depth]
+        probs = self.net.infer(evidence, evidence_nodes, [self.nodes[depth]])[:, 0, :self.num_states[depth]]
+        return probs / probs.sum(axis=1, keepdims=True)
+
+    def sample_counts(self, n:int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        draw n samples, as the distinct cases [n_cases, n_nodes] and the number of samples of each
+
+        Works one node at a time: every distinct prefix splits its count over the next node's states with a multinomial draw.
+        Prefixes with fewer than `min_split_count` samples are finished by `generate`, and their cases have a count of 1
+        """
+        prefixes = np.zeros((1, 0), dtype=np.int64)
+        counts = np.array([n], dtype=np.int64)
+        generated = []
+        for depth in range(len(self.nodes)):
+            sparse = counts < self.min_split_count
+            if sparse.any():
+                generated.append(self.generate(prefixes[sparse], counts[sparse]))
+                prefixes, counts = prefixes[~sparse], counts[~sparse]
+            if not len(prefixes):
+                return np.concatenate(generated).astype(self.dtype), np.ones(n, dtype=np.int64)
+            split = self.rng.multinomial(counts, self.batch_conditional(prefixes))
+            rows, states = np.nonzero(split)
+            prefixes = np.concatenate([prefixes[rows], states[:, None]], axis=1)
+            counts = split[rows, states]
+
+        if generated:
+            prefixes = np.concatenate([prefixes, *generated])
+            counts = np.concatenate([counts, np.ones(sum(len(g) for g in generated), dtype=np.int64)])
+        return prefixes.astype(self.dtype), counts
+
+    def generate(self, prefixes:np.ndarray, counts:np.ndarray) -> np.ndarray:
+        """complete each prefix [n_prefixes, depth] into counts[i] full cases, drawn one at a time by netica. Returns [counts.sum(), n_nodes]"""
+        depth = prefixes.shape[1]
+        out = np.empty((int(counts.sum()), len(self.nodes)), dtype=np.int64)
+        start = 0
+        for prefix, count in zip(prefixes.tolist(), counts.tolist()):
+            self.net.enter_findings({**self.saved, **dict(zip(self.nodes[:depth], prefix))})
+            out[start:start + count, :depth] = prefix
+            seed = int(self.rng.integers(1, 1 << 31))
+            out[start:start + count, depth:] = self.net.generate_cases(self.nodes[depth:], count, seed=seed)
+            start += count
+        return out
+
+    def iter_samples(self, n:int, *, chunk_size:int=1 << 20) -> Generator[np.ndarray, None, None]:
+        """
+        yield n samples in shuffled chunks of at most chunk_size rows, each an array [rows, n_nodes] of state indices
+
+        The findings of the selected nodes are restored once all the samples have been drawn
+        """
+        result_cache, self.net.result_cache = getattr(self.net, 'result_cache', None), None
+        try:
+            for start in range(0, n, chunk_size):
+                cases, counts = self.sample_counts(min(chunk_size, n - start))
+                chunk = np.repeat(cases, counts, axis=0)
+                yield chunk[self.rng.permutation(len(chunk))]
+        finally:
+            self.net.enter_findings(self.saved)
+            self.net.result_cache = result_cache
+
+    def sample(self, n:int, *, chunk_size:int=1 << 20) -> np.ndarray:
+        """n samples as a single array [n, n_nodes] of state indices"""
+        out = np.empty((n, len(self.nodes)), dtype=self.dtype)
+        start = 0
+        for chunk in self.iter_samples(n, chunk_size=chunk_size):
+            out[start:start + len(chunk)] = chunk
+            start += len(chunk)
+        return out
+
+
+class SampleSummary:
+    """
+    streaming summary of samples [n, n_nodes], accumulated chunk by chunk
+
+    Counts every pair of states of every pair of nodes (the marginals are the diagonal), from which the pairwise joint
+    probabilities and the correlations between nodes follow. Joint probabilities of more than two nodes are tracked as named `events`.
+    """
+    def __init__(self, num_states:np.ndarray, *, values:np.ndarray|None=None, events:dict[str, dict[int, list[int]]]|None=None):
+        """
+        num_states: [n_nodes] number of states of each node
+        values: [n_nodes, max_states] value of each state used for correlations, e.g. bin midpoints. Defaults to the state index
+        events: {name: {node column: allowed states}}, each the conjunction of its nodes being in one of their allowed states
+        """
+        self.num_states = np.asarray(num_states, dtype=np.int64)
+        self.max_states = int(self.num_states.max(initial=1))
+        self.values = np.asarray(values, dtype=np.float64) if values is not None else np.tile(np.arange(self.max_states, dtype=np.float64), (len(self.num_states), 1))
+        self.events = events or {}
+
+        self.n = 0
+        size = len(self.num_states) * self.max_states
+        self.cooccurrence = np.zeros((size, size), dtype=np.int64)
+        self.event_counts = {name: 0 for name in self.events}
+
+    def update(self, samples:np.ndarray, *, block:int=1 << 16):
+        """add a chunk of samples [rows, n_nodes]"""
+        num_nodes = len(self.num_states)
+        offsets = np.arange(num_nodes) * self.max_states
+        for start in range(0, len(samples), block):
+            rows = samples[start:start + block].astype(np.int64)
+            one_hot = np.zeros((len(rows), num_nodes * self.max_states), dtype=np.float32)
+            np.put_along_axis(one_hot, rows + offsets, 1.0, axis=1)
+            self.cooccurrence += np.rint(one_hot.T @ one_hot).astype(np.int64)
+
+        for name, conditions in self.events.items():
+            self.event_counts[name] += int(event_mask(samples, conditions).sum())
+        self.n += len(samples)
+
+    def pairwise(self) -> np.ndarray:
+        """joint probabilities [n_nodes, n_nodes, max_states, max_states] of every pair of nodes"""
+        num_nodes = len(self.num_states)
+        counts = self.cooccurrence.reshape(num_nodes, self.max_states, num_nodes, self.max_states).transpose(0, 2, 1, 3)
+        return counts / max(self.n, 1)
+
+    def marginals(self) -> np.ndarray:
+        """probabilities [n_nodes, max_states] of each node's states"""
+        pairwise = self.pairwise()
+        return np.einsum('iiab->iab', pairwise).diagonal(axis1=1, axis2=2)
+
+    def correlation(self) -> np.ndarray:
+        """correlation matrix [n_nodes, n_nodes] of the nodes' values"""
+        pairwise, marginals = self.pairwise(), self.marginals()
+        mean = np.sum(marginals * self.values, axis=1)
+        cov = np.einsum('ijab,ia,jb->ij', pairwise, self.values, self.values) - np.outer(mean, mean)
+        std = np.sqrt(np.clip(np.diag(cov), 0, None))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return cov / np.outer(std, std)
+
+    def event_probabilities(self) -> dict[str, float]:
+        return {name: count / max(self.n, 1) for name, count in self.event_counts.items()}
+
+
+def event_mask(samples:np.ndarray, conditions:dict[int, list[int]]) -> np.ndarray:
+    """which samples [n, n_nodes] have every node column of `conditions` in one of its allowed states"""
+    hit = np.ones(len(samples), dtype=bool)
+    for column, states in conditions.items():
+        hit &= np.isin(samples[:, column], states)
+    return hit
+
+
+def joint_probability(samples:np.ndarray, conditions:dict[int, list[int]]) -> float:
+    """fraction of samples [n, n_nodes] in which every node column is in one of its allowed states"""
+    return float(event_mask(samples, conditions).mean()) if len(samples) else float('nan')
+
+
+def parse_event(net:NeticaGraph, nodes:list[str], event:str) -> dict[int, list[int]]:
+    """parse e.g. "FISH_ECO_END=Low|Zero,VEG_ECO_END=Low" into {node column: [state indices]}"""
+    conditions = {}
+    for term in event.split(','):
+        name, states = term.split('=')
+        name = name.strip()
+        if name not in nodes:
+            raise ValueError(f"event node `{name}` is not one of the sampled nodes {nodes}")
+        conditions[nodes.index(name)] = [net.get_node_state(name, state.strip()) for state in states.split('|')]
+    return conditions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Draw Monte Carlo samples of the joint distribution of the output nodes, and summarize them')
+    parser.add_argument('neta', help='path to the .neta file')
+    parser.add_argument('--config', help='json file of findings to enter first, in the same format as the scenario configs')
+    parser.add_argument('-n', '--samples', type=int, default=1_000_000, help='number of samples (default: 1000000)')
+    parser.add_argument('--nodes', nargs='+', default=list(limpopo_output_nodes), help='nodes to sample (default: the Limpopo output nodes)')
+    parser.add_argument('--event', action='append', default=[], help='joint event to estimate the probability of, e.g. "FISH_ECO_END=Low,VEG_ECO_END=Low" (repeatable)')
+    parser.add_argument('--seed', type=int, help='random seed')
+    parser.add_argument('--chunk-size', type=int, default=1 << 20, help='samples per chunk, which bounds the memory used (default: 1048576)')
+    parser.add_argument('--backend', choices=['netica', 'numpy'], default='netica', help='compute the conditionals with netica, or the exported numpy archive (see numpy_inference.py)')
+    parser.add_argument('--output', help='optional .npy file to stream the samples [n, nodes] to')
+    args = parser.parse_args()
+
+    # the numpy backend doesn't need netica (or a license) at all
+    with NeticaManager() if args.backend == 'netica' else nullcontext() as netica:
+        net = netica.new_graph(args.neta) if netica is not None else NumpyGraph.from_neta(args.neta)
+        if args.config:
+            with open(args.config) as f:
+                net.enter_findings({key: value for key, value in json.load(f).items() if value is not None})
+
+        sampler = Sampler(net, args.nodes, seed=args.seed)
+        edges = get_bin_edges(net.meta, args.nodes)
+        events = {event: parse_event(net, args.nodes, event) for event in args.event}
+        summary = SampleSummary(sampler.num_states, values=(edges[:, 1:] + edges[:, :-1]) / 2, events=events)
+
+        out = None
+        if args.output:
+            os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+            out = np.lib.format.open_memmap(args.output, mode='w+', dtype=sampler.dtype, shape=(args.samples, len(args.nodes)))
+
+        start = 0
+        for chunk in sampler.iter_samples(args.samples, chunk_size=args.chunk_size):
+            summary.update(chunk)
+            if out is not None:
+                out[start:start + len(chunk)] = chunk
+            start += len(chunk)
+        if out is not None:
+            out.flush()
+            print(f'saved {args.samples} samples to {args.output}')
+
+    print(f'{summary.n} samples')
+    marginals = summary.marginals()
+    for i, node in enumerate(args.nodes):
+        states = net.meta.get_state_names(sampler.nodes[i])
+        print(f'{node}: ' + ', '.join(f'{state or j}={p:.4f}' for j, (state, p) in enumerate(zip(states, marginals[i]))))
+    for event, p in summary.event_probabilities().items():
+        print(f'P({event}) = {p:.6f}')
+    print('correlation:')
+    with np.printoptions(precision=3, suppress=True, linewidth=200):
+        print(summary.correlation())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Sensitivity of the Limpopo output nodes to each of the model inputs, for every site.
+
+For each site, and each output node, netica's sensitivity-to-findings is evaluated against every input node (the nodes without parents),
+giving the mutual information between the input and the output, and the expected reduction in the variance of the output's value
+from learning the input. Sites run in parallel, and the results are saved as [site, input, output] tensors:
+    mutual_info, variance_reduction, plus the sites, inputs and outputs labelling each axis
+along with a long format csv of the same values, with inputs ranked per site and output.
+
+By default every finding (including those saved in the .neta files) is retracted first, so that each input is ranked over its prior.
+Pass --config to instead hold the settings of a scenario config fixed (inputs set by the config then have zero sensitivity).
+
+Usage:
+    python sensitivity.py [--config configs/limpopo_27_subbasin.json] [--workers 8]
+"""
+
+from __future__ import annotations
+from netica import NetMetadata
+from limpopo_common import output_nodes, get_site_findings
+from parallel import run_sites, report_failures, get_manager
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+
+from os.path import join
+
+
+def input_nodes(meta:NetMetadata, exclude:set[str]=frozenset()) -> list[str]:
+    """names of the nodes without parents, in network order"""
+    num_parents = np.diff(meta.parent_offsets)
+    return [name for name, n in zip(meta.node_names.tolist(), num_parents.tolist()) if n == 0 and name not in exclude]
+
+
+def site_sensitivity(site:str, neta_path:str, config:dict|None, outputs:list[str]) -> tuple[list[str], np.ndarray, np.ndarray]:
+    """
+    sensitivity of each output to each input of a single site's network.
+    Returns (input names, mutual information [inputs, outputs], variance reduction [inputs, outputs])
+    """
+    with get_manager().new_graph(neta_path, pooled=False) as net:
+        net.retract_all()
+        if config is not None:
+            net.enter_findings({key: value for key, value in get_site_findings(site, config).items() if value is not None})
+
+        inputs = input_nodes(net.meta, exclude=set(outputs))
+        mutual_info = np.zeros((len(inputs), len(outputs)))
+        variance = np.zeros((len(inputs), len(outputs)))
+        for j, output in enumerate(outputs):
+            mutual_info[:, j], variance[:, j] = net.get_sensitivity(output, inputs)
+    return inputs, mutual_info, variance
+
+
+def stack_sites(results:list[tuple[list[str], np.ndarray, np.ndarray]]) -> tuple[list[str], np.ndarray, np.ndarray]:
+    """combine per-site results into [site, input, output] tensors over the union of every site's inputs (NaN where a site lacks an input)"""
+    inputs = list(dict.fromkeys(name for site_inputs, _, _ in results for name in site_inputs))
+    index = {name: i for i, name in enumerate(inputs)}
+    num_outputs = results[0][1].shape[1] if results else 0
+
+    mutual_info = np.full((len(results), len(inputs), num_outputs), np.nan)
+    variance = np.full((len(results), len(inputs), num_outputs), np.nan)
+    for s, (site_inputs, site_mi, site_var) in enumerate(results):
+        rows = [index[name] for name in site_inputs]
+        mutual_info[s, rows] = site_mi
+        variance[s, rows] = site_var
+    return inputs, mutual_info, variance
+
+
+def rankings(sites:list[str], inputs:list[str], outputs:list[str], mutual_info:np.ndarray, variance:np.ndarray) -> pd.DataFrame:
+    """long format table of the tensors, with the rank (1 = most influential) of each input by mutual information, per site and output"""
+    site_idx, input_idx, output_idx = np.meshgrid(np.arange(len(sites)), np.arange(len(inputs)), np.arange(len(outputs)), indexing='ij')
+    df = pd.DataFrame({
+        'Site': np.asarray(sites, dtype=object)[site_idx.ravel()],
+        'Output': np.asarray(outputs, dtype=object)[output_idx.ravel()],
+        'Input': np.asarray(inputs, dtype=object)[input_idx.ravel()],
+        'Mutual Information': mutual_info.ravel(),
+        'Variance Reduction': variance.ravel(),
+    }).dropna(subset=['Mutual Information'])
+    df['Rank'] = df.groupby(['Site', 'Output'])['Mutual Information'].rank(ascending=False, method='min').astype(int)
+    return df.sort_values(['Site', 'Output', 'Rank'], kind='stable').reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rank the inputs of every site by their influence on each of the output nodes')
+    parser.add_argument('--site-map', default=join('neta', 'limpopo_27_subbasin', 'risk_region_mapping.csv'), help='csv mapping each site to its .neta file')
+    parser.add_argument('--config', help='scenario config whose settings are held fixed (default: retract every finding)')
+    parser.add_argument('--workers', type=int, default=1, help='number of sites to run in parallel (default: 1)')
+    parser.add_argument('--output', default=join('results', 'sensitivity_limpopo_27_subbasin.npz'), help='path of the output tensors (.npz). A .csv of rankings is written next to it')
+    args = parser.parse_args()
+
+    config = None
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+
+    file_map_df = pd.read_csv(args.site_map)
+    neta_dir = os.path.dirname(args.site_map)
+    outputs = list(output_nodes)
+    tasks = [(row['Site'], (row['Site'], join(neta_dir, row['Netica File']), config, outputs)) for _, row in file_map_df.iterrows()]
+
+    results = run_sites(site_sensitivity, tasks, workers=args.workers)
+    failures = report_failures(results)
+    ok_results = [r for r in results if r.ok]
+
+    sites = [r.site for r in ok_results]
+    inputs, mutual_info, variance = stack_sites([r.result for r in ok_results])
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    np.savez(
+        args.output,
+        sites=np.array(sites, dtype=str), inputs=np.array(inputs, dtype=str), outputs=np.array(outputs, dtype=str),
+        mutual_info=mutual_info, variance_reduction=variance,
+    )
+    csv_path = os.path.splitext(args.output)[0] + '.csv'
+    rankings(sites, inputs, outputs, mutual_info, variance).to_csv(csv_path, index=False)
+    print(f'saved [{len(sites)} sites x {len(inputs)} inputs x {len(outputs)} outputs] to {args.output} and {csv_path}')
+
+    if failures:
+        raise SystemExit(f'{len(failures)} of {len(results)} sites failed: {", ".join(r.site for r in failures)}')
+
+
+if __name__ == '__main__':
+    main()
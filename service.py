@@ -0,0 +1,458 @@
+"""
+Long running inference service, which keeps the compiled networks of every model warm and answers queries over HTTP.
+
+Each query's findings take the same form as the scenario configs (configs/<model>.json), so a dashboard can post a config
+and get back the output statistics in milliseconds, instead of launching a script that re-reads and re-compiles the network.
+
+Inference runs on a fixed pool of worker processes. Like parallel.py, each worker has its own netica environment, and every
+worker loads every model's networks at startup. So any worker can answer any query, and the workers never share netica
+state or the GIL. Queries wait in a bounded queue. Whenever a worker is free, it takes every query waiting (up to --max-batch)
+as one batch. Batches are small when the service is idle, which keeps latency low. Under load they grow, so the cost of
+handing work to a worker is spread over many queries. Within a batch, repeated queries run once, and queries on the same net
+run back to back, re-entering only the findings that differ (see `set_evidence`). When the queue is full, new queries are
+turned away at once with 503 and Retry-After, rather than piling up behind the workers.
+
+Usage:
+    python service.py [--port 8750] [--host 127.0.0.1] [--socket /tmp/probflo.sock] [--workers 2] [--models limpopo mara]
+
+Endpoints:
+    GET  /health                  status of the workers and the queue
+    GET  /models                  the models, their sites, and their default output nodes
+    POST /query/<model>[/<site>]  body: findings in the form of configs/<model>.json. Without a site, every site of the model runs.
+                                  Optional query parameters: nodes=A,B,C (output nodes), beliefs=1 (also return each state's belief)
+e.g.
+    curl -X POST localhost:8750/query/limpopo_27_subbasin/Ngotwane -d @configs/limpopo_27_subbasin.json
+    curl --unix-socket /tmp/probflo.sock -X POST 'http://localhost/query/limpopo?beliefs=1' -d '{"WQ_ECOSYSTEM": "High"}'
+"""
+
+from __future__ import annotations
+from netica import NeticaGraph
+from stats import get_bin_edges, histogram_stats
+from parallel import get_manager, init_worker
+from limpopo_common import output_nodes as limpopo_output_nodes, subbasins, to_snake_case, get_site_findings
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import Callable
+from urllib.parse import urlsplit, parse_qs, unquote
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import time
+import traceback
+import numpy as np
+import pandas as pd
+
+from os.path import join
+
+
+# output nodes of the mara model (the `Out` nodes of mara.py)
+mara_output_nodes = ['BASIC_HUMAN_NEEDS', 'ECOLOGICAL_INTEGRITY', 'ECOTOURISM_INDUSTRY', 'IRRIGATED_CROP_PRODUCTION', 'LIVESTOCK_HERDING_CAPACITY', 'WETLAND_CONSERVATION']
+
+# largest request body accepted, in bytes
+MAX_BODY_BYTES = 1 << 20
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+@dataclass
+class Model:
+    name: str
+    sites: dict[str, str]  # site -> path of its .neta file
+    output_nodes: list[str]|None = None  # None for the nodes without children
+    site_findings: Callable[[str, dict], dict]|None = None  # expands special config settings for a site, e.g. DISCHARGE_SCENARIO
+
+    def find_site(self, name:str) -> str|None:
+        """the site called `name`, ignoring surrounding whitespace (some site names in the mapping files end in a space)"""
+        if name in self.sites:
+            return name
+        return next((site for site in self.sites if site.strip() == name.strip()), None)
+
+
+def available_models() -> dict[str, Model]:
+    """every model the service can serve, by name"""
+    neta_dir = join('neta', 'limpopo_27_subbasin')
+    file_map = pd.read_csv(join(neta_dir, 'risk_region_mapping.csv'))
+    models = [
+        Model('mara', {'mara': join('neta', 'mara.neta')}, mara_output_nodes),
+        Model('limpopo', {'limpopo': join('neta', 'limpopo.neta')}, list(limpopo_output_nodes)),
+        Model('limpopo_5_subbasin', {subbasin: join('neta', 'limpopo_5_subbasin', f'{to_snake_case(subbasin)}.neta') for subbasin in subbasins}, list(limpopo_output_nodes)),
+        Model('limpopo_27_subbasin', {row['Site']: join(neta_dir, row['Netica File']) for _, row in file_map.iterrows()}, list(limpopo_output_nodes), get_site_findings),
+        Model('seqnu', {'seqnu': join('neta', 'seqnu.neta')}),
+    ]
+    return {model.name: model for model in models}
+
+
+@dataclass
+class Query:
+    model: str
+    site: str
+    findings: dict
+    nodes: list[str]|None = None  # None for the model's default output nodes
+    beliefs: bool = False
+
+    def key(self) -> str:
+        """identifies queries with the same answer"""
+        return json.dumps([self.model, self.site, self.findings, self.nodes, self.beliefs], sort_keys=True, separators=(',', ':'))
+
+
+class QueueFull(Exception):
+    pass
+
+
+# worker process state: the models, their warm graphs by (model, site), and the bin edges of each set of output nodes
+_models: dict[str, Model] = {}
+_graphs: dict[tuple[str, str], NeticaGraph] = {}
+_edges: dict[tuple[str, str, tuple[str, ...]], np.ndarray] = {}
+_warm_seconds = 0.0
+_ready = None  # barrier that every worker reaches at startup, so that each answers one of the startup `worker_info` calls
+
+
+def leaf_nodes(graph:NeticaGraph) -> list[str]:
+    """the nodes that aren't a parent of any other node"""
+    return graph.meta.leaf_nodes()
+
+
+def warm_worker(models:dict[str, Model], ready=None):
+    """load and compile every network of every model (runs once in each worker process, when it starts)"""
+    global _warm_seconds, _ready
+    init_worker()
+    _ready = ready
+    start = time.perf_counter()
+    _models.update(models)
+    for model in models.values():
+        for site, path in model.sites.items():
+            graph = get_manager().new_graph(path, pooled=False)
+            output_nodes = model.output_nodes or leaf_nodes(graph)
+            missing = [node for node in output_nodes if node not in graph.node_names]
+            if missing:
+                raise KeyError(f"{path} has no output node(s) {', '.join(missing)}")
+            _graphs[model.name, site] = graph
+    _warm_seconds = time.perf_counter() - start
+
+
+def worker_info(wait:bool=False) -> dict:
+    """what a worker has loaded: the output nodes of each model, and the size of its nets. With `wait`, first wait for the other workers to warm"""
+    if wait and _ready is not None:
+        _ready.wait()
+    return {
+        'pid': os.getpid(),
+        'warm_seconds': _warm_seconds,
+        'nets': len(_graphs),
+        'compiled_bytes': sum(graph.compiled_size for graph in _graphs.values()),
+        'output_nodes': {name: model.output_nodes or leaf_nodes(_graphs[name, next(iter(model.sites))]) for name, model in _models.items()},
+    }
+
+
+def set_evidence(graph:NeticaGraph, findings:dict[str, int|str|dict|None]):
+    """
+    make the graph's findings exactly those saved in its file plus `findings` (None leaves a node at its default, as in the configs).
+    Whatever an earlier query entered is undone, but only the nodes whose finding differs are retracted and re-entered
+    """
+    target = graph.meta.resolve_findings({node: state for node, state in findings.items() if state is not None})
+    graph.enter_findings({node_idx: target.get(node_idx) for node_idx in set(graph.findings) | set(target)})
+
+
+def run_query(query:Query) -> dict:
+    """the mean and std (and optionally the beliefs) of each output node for a single query"""
+    model = _models[query.model]
+    graph = _graphs[query.model, query.site]
+    nodes = query.nodes or model.output_nodes or leaf_nodes(graph)
+    findings = model.site_findings(query.site, query.findings) if model.site_findings is not None else query.findings
+    set_evidence(graph, findings)
+
+    edges_key = (query.model, query.site, tuple(nodes))
+    if edges_key not in _edges:
+        _edges[edges_key] = get_bin_edges(graph, nodes)
+    beliefs = graph.get_beliefs(nodes)
+    stats = histogram_stats(beliefs, _edges[edges_key])
+
+    result = {}
+    for i, node in enumerate(nodes):
+        result[node] = {'mean': float(stats['mean'][i]), 'std': float(stats['std'][i])}
+        if query.beliefs:
+            state_names = graph.meta.get_state_names(graph.get_node_index(node))
+            result[node]['beliefs'] = {name or str(j): float(beliefs[i, j]) for j, name in enumerate(state_names)}
+    return result
+
+
+def run_queries(queries:list[Query]) -> list[dict]:
+    """
+    answer a batch of queries in a worker, as {"result": ...} or {"error": ...} for each.
+    Each distinct query runs once, and queries on the same net run one after another
+    """
+    answers: dict[str, dict] = {}
+    for query in sorted(queries, key=lambda q: (q.model, q.site)):
+        key = query.key()
+        if key in answers:
+            continue
+        try:
+            answers[key] = {'result': run_query(query)}
+        except (KeyError, ValueError, AssertionError) as e:
+            # a bad node or state in the findings
+            answers[key] = {'error': str(e.args[0] if e.args else e), 'status': 400}
+        except Exception:
+            answers[key] = {'error': traceback.format_exc(), 'status': 500}
+    return [answers[query.key()] for query in queries]
+
+
+class InferenceService:
+    def __init__(self, models:dict[str, Model], *, workers:int=2, max_pending:int=256, max_batch:int=64):
+        self.models = models
+        self.workers = workers
+        self.max_batch = max_batch
+        self.queue: asyncio.Queue[tuple[Query, asyncio.Future]] = asyncio.Queue(maxsize=max_pending)
+        self.pool: ProcessPoolExecutor|None = None
+        self.info: list[dict] = []
+        self.dispatchers: list[asyncio.Task] = []
+        self.restart_lock = asyncio.Lock()
+        self.started = time.monotonic()
+
+        # counters for /health
+        self.batches = 0
+        self.queries = 0
+        self.rejected = 0
+
+    async def start(self):
+        """start the worker processes and wait until each has warmed every model"""
+        await self.start_pool()
+        self.dispatchers = [asyncio.create_task(self.dispatch()) for _ in range(self.workers)]
+
+    async def start_pool(self):
+        loop = asyncio.get_running_loop()
+        context = multiprocessing.get_context()
+        ready = context.Barrier(self.workers)
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=warm_worker, initargs=(self.models, ready))
+        # processes are started as work arrives. Each of these calls holds its worker at the barrier until every worker has warmed,
+        # so they all run on different workers, and no query ever waits for a worker to load its nets
+        self.info = await asyncio.gather(*(loop.run_in_executor(self.pool, worker_info, True) for _ in range(self.workers)))
+
+    async def stop(self):
+        for task in self.dispatchers:
+            task.cancel()
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+
+    def submit(self, queries:list[Query]) -> list[asyncio.Future]:
+        """queue queries for the workers, or raise QueueFull if there isn't room for all of them"""
+        if self.queue.maxsize - self.queue.qsize() < len(queries):
+            self.rejected += len(queries)
+            raise QueueFull()
+        loop = asyncio.get_running_loop()
+        futures = []
+        for query in queries:
+            future = loop.create_future()
+            self.queue.put_nowait((query, future))
+            futures.append(future)
+        return futures
+
+    async def dispatch(self):
+        """
+        repeatedly send a batch of waiting queries to the workers. There is one dispatcher per worker, so there are never more
+        batches in flight than workers, and everything else waits in the (bounded) queue
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            # skip queries whose client has gone away
+            batch = [(query, future) for query, future in batch if not future.done()]
+            if not batch:
+                continue
+
+            pool = self.pool
+            try:
+                answers = await loop.run_in_executor(pool, run_queries, [query for query, _ in batch])
+            except BrokenProcessPool:
+                # a worker died (e.g. inside netica). Fail this batch, and replace the pool
+                answers = [{'error': 'inference worker crashed', 'status': 500}] * len(batch)
+                await self.restart_pool(pool)
+            except Exception:
+                answers = [{'error': traceback.format_exc(), 'status': 500}] * len(batch)
+
+            self.batches += 1
+            self.queries += len(batch)
+            for (_, future), answer in zip(batch, answers):
+                if not future.done():
+                    future.set_result(answer)
+
+    async def restart_pool(self, broken:ProcessPoolExecutor):
+        async with self.restart_lock:
+            if self.pool is not broken:
+                # another dispatcher already replaced it
+                return
+            broken.shutdown(wait=False, cancel_futures=True)
+            print('WARNING: an inference worker crashed, restarting the workers')
+            await self.start_pool()
+
+    def health(self) -> dict:
+        return {
+            'uptime_seconds': time.monotonic() - self.started,
+            'workers': [{key: value for key, value in info.items() if key != 'output_nodes'} for info in self.info],
+            'pending': self.queue.qsize(),
+            'max_pending': self.queue.maxsize,
+            'batches': self.batches,
+            'queries': self.queries,
+            'mean_batch_size': self.queries / self.batches if self.batches else 0.0,
+            'rejected': self.rejected,
+        }
+
+    def describe_models(self) -> dict:
+        output_nodes = self.info[0]['output_nodes'] if self.info else {}
+        return {name: {'sites': list(model.sites), 'output_nodes': output_nodes.get(name)} for name, model in self.models.items()}
+
+    async def query(self, path:list[str], params:dict[str, list[str]], body:bytes) -> tuple[int, dict]:
+        """answer POST /query/<model>[/<site>]"""
+        model = self.models.get(path[0]) if path else None
+        if model is None or len(path) > 2:
+            return 404, {'error': f"unknown model. Expected one of {', '.join(self.models)}"}
+        if len(path) == 2:
+            site = model.find_site(path[1])
+            if site is None:
+                return 404, {'error': f"model {model.name} has no site `{path[1]}`"}
+            sites = [site]
+        else:
+            sites = list(model.sites)
+
+        try:
+            findings = json.loads(body or b'{}')
+        except ValueError as e:
+            return 400, {'error': f'invalid json: {e}'}
+        if not isinstance(findings, dict):
+            return 400, {'error': 'expected a json object of {node: state}, as in the config files'}
+        nodes = [node for value in params.get('nodes', []) for node in value.split(',') if node] or None
+        beliefs = params.get('beliefs', ['0'])[-1].lower() in ('1', 'true', 'yes')
+
+        start = time.perf_counter()
+        try:
+            futures = self.submit([Query(model.name, site, findings, nodes, beliefs) for site in sites])
+        except QueueFull:
+            return 503, {'error': 'too many queries waiting, retry shortly'}
+        try:
+            answers = await asyncio.gather(*futures)
+        except asyncio.CancelledError:
+            for future in futures:
+                future.cancel()
+            raise
+
+        errors = {site: answer['error'] for site, answer in zip(sites, answers) if 'error' in answer}
+        if len(errors) == len(sites):
+            return max(answer['status'] for answer in answers), {'error': answers[0]['error'] if len(sites) == 1 else errors}
+        response = {
+            'model': model.name,
+            'results': {site: answer['result'] for site, answer in zip(sites, answers) if 'result' in answer},
+            'seconds': time.perf_counter() - start,
+        }
+        if errors:
+            response['errors'] = errors
+        return 200, response
+
+    async def route(self, method:str, target:str, body:bytes) -> tuple[int, dict]:
+        url = urlsplit(target)
+        path = [unquote(part) for part in url.path.split('/') if part]
+        if path == ['health']:
+            return (200, self.health()) if method == 'GET' else (405, {'error': 'use GET'})
+        if path == ['models']:
+            return (200, self.describe_models()) if method == 'GET' else (405, {'error': 'use GET'})
+        if path[:1] == ['query']:
+            if method != 'POST':
+                return 405, {'error': 'use POST'}
+            return await self.query(path[1:], parse_qs(url.query), body)
+        return 404, {'error': 'not found. Endpoints are GET /health, GET /models and POST /query/<model>[/<site>]'}
+
+    async def handle_connection(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        """serve HTTP/1.1 requests on a connection until the client closes it (connections are kept alive between requests)"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode('latin-1').strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY_BYTES:
+                    status, payload = 413, {'error': f'request body is over {MAX_BODY_BYTES} bytes'}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length)
+                    status, payload = await self.route(method.upper(), target, body)
+                    keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+                data = json.dumps(payload).encode('utf-8')
+                head = [
+                    f'HTTP/1.1 {status} {STATUS_TEXT.get(status, "")}',
+                    'Content-Type: application/json',
+                    f'Content-Length: {len(data)}',
+                    f'Connection: {"keep-alive" if keep_alive else "close"}',
+                ]
+                if status == 503:
+                    head.append('Retry-After: 1')
+                writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            # the client went away, or sent something that isn't HTTP
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(args:argparse.Namespace):
+    models = available_models()
+    if args.models:
+        unknown = [name for name in args.models if name not in models]
+        if unknown:
+            raise SystemExit(f"unknown model(s) {', '.join(unknown)}. Expected some of {', '.join(models)}")
+        models = {name: models[name] for name in args.models}
+
+    service = InferenceService(models, workers=args.workers, max_pending=args.max_pending, max_batch=args.max_batch)
+    start = time.perf_counter()
+    await service.start()
+    nets = sum(len(model.sites) for model in models.values())
+    print(f'{args.workers} worker(s) warmed {nets} nets of {len(models)} model(s) in {time.perf_counter() - start:.1f}s')
+
+    if args.socket:
+        server = await asyncio.start_unix_server(service.handle_connection, path=args.socket)
+        print(f'serving on {args.socket}')
+    else:
+        server = await asyncio.start_server(service.handle_connection, args.host, args.port)
+        print(f'serving on http://{args.host}:{args.port}')
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+    async with server:
+        await stopping.wait()
+    await service.stop()
+    if args.socket and os.path.exists(args.socket):
+        os.remove(args.socket)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve queries against warm, compiled networks over HTTP')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8750, help='port to listen on (default: 8750)')
+    parser.add_argument('--socket', help='listen on this unix socket instead of a port')
+    parser.add_argument('--models', nargs='+', help='models to serve (default: all of them)')
+    parser.add_argument('--workers', type=int, default=2, help='number of inference worker processes, each with every model loaded (default: 2)')
+    parser.add_argument('--max-pending', type=int, default=256, help='queries that may wait for a worker before new ones are turned away with 503 (default: 256)')
+    parser.add_argument('--max-batch', type=int, default=64, help='most queries a worker takes at once (default: 64)')
+    args = parser.parse_args()
+    asyncio.run(serve(args))
+
+
+if __name__ == '__main__':
+    main()
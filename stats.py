@@ -0,0 +1,91 @@
+from __future__ import annotations
+from netica import NeticaGraph, NeticaNode, NetMetadata, levels_to_edges
+import numpy as np
+
+
+def get_bin_edges(net:NeticaGraph|NetMetadata, nodes:list[int|str|NeticaNode]) -> np.ndarray:
+    """
+    get the histogram bin edges of several nodes as an array of shape [n_nodes, max_states+1]
+
+    `net` may be a loaded graph, or just the network's metadata (in which case nodes must be given by index or name)
+
+    Nodes with fewer states are padded by repeating their last edge, i.e. with zero width bins, which matches the zero padding of `NeticaGraph.get_beliefs`
+    """
+    meta = net.meta if isinstance(net, NeticaGraph) else net
+    node_edges = []
+    for node in nodes:
+        node_idx = net.get_node_index(node) if isinstance(net, NeticaGraph) else meta.name_index.get(node, node)
+        node_edges.append(levels_to_edges(meta.get_levels(node_idx), int(meta.num_states[node_idx])))
+
+    out = np.empty((len(node_edges), max((len(e) for e in node_edges), default=1)))
+    for i, edges in enumerate(node_edges):
+        out[i, :len(edges)] = edges
+        out[i, len(edges):] = edges[-1]
+    return out
+
+
+def stack_histograms(histograms:list[tuple[np.ndarray, np.ndarray]]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    stack per-site (beliefs [nodes, states], edges [nodes, states+1]) pairs into [sites, nodes, max_states] and [sites, nodes, max_states+1] tensors
+
+    Sites with fewer states are padded the same way as `get_bin_edges`, with zero beliefs in zero width bins
+    """
+    num_nodes = max((b.shape[0] for b, _ in histograms), default=0)
+    max_states = max((b.shape[1] for b, _ in histograms), default=0)
+    beliefs = np.zeros((len(histograms), num_nodes, max_states))
+    edges = np.zeros((len(histograms), num_nodes, max_states + 1))
+    for i, (site_beliefs, site_edges) in enumerate(histograms):
+        beliefs[i, :, :site_beliefs.shape[1]] = site_beliefs
+        edges[i, :, :site_edges.shape[1]] = site_edges
+        edges[i, :, site_edges.shape[1]:] = site_edges[:, -1:]
+    return beliefs, edges
+
+
+def histogram_stats(beliefs:np.ndarray, edges:np.ndarray, quantiles:tuple[float, ...]=()) -> dict[str, np.ndarray]:
+    """
+    exact statistics of piecewise-uniform histograms, i.e. each state's belief spread evenly over its bin
+
+    beliefs: array of shape [..., n_states], e.g. [sites, nodes, states]. Beliefs are normalized to sum to 1 along the last axis
+    edges: array of shape [..., n_states+1] that broadcasts against beliefs, e.g. [nodes, states+1]
+    quantiles: optional quantile levels in [0, 1] to compute
+
+    returns a dict with arrays of shape [...] for 'mean', 'var', 'std' and 'entropy' (of the states, in bits),
+    and if requested, 'quantiles' with shape [..., len(quantiles)]
+    """
+    beliefs = np.asarray(beliefs, dtype=np.float64)
+    edges = np.asarray(edges, dtype=np.float64)
+    total = beliefs.sum(axis=-1, keepdims=True)
+    p = np.divide(beliefs, total, out=np.zeros_like(beliefs), where=total > 0)
+
+    lower, upper = edges[..., :-1], edges[..., 1:]
+    widths = upper - lower
+    centers = (upper + lower) / 2
+
+    # each bin is uniform, so contributes its own variance (w^2/12) plus the spread of its center around the mean
+    mean = np.sum(p * centers, axis=-1)
+    var = np.sum(p * ((centers - mean[..., None])**2 + widths**2/12), axis=-1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        entropy = -np.sum(np.where(p > 0, p * np.log2(p), 0.0), axis=-1)
+
+    stats = {'mean': mean, 'var': var, 'std': np.sqrt(var), 'entropy': entropy}
+
+    if quantiles:
+        # the cdf is piecewise linear, so find the bin each quantile falls in and interpolate within it
+        q = np.asarray(quantiles, dtype=np.float64)
+        cdf = np.cumsum(p, axis=-1)
+        n_states = p.shape[-1]
+        k = np.minimum(np.sum(cdf[..., None, :] < q[:, None], axis=-1), n_states - 1) # [..., n_quantiles]
+        shape = np.broadcast_shapes(k.shape, lower.shape[:-1] + (1,))
+        take = lambda a: np.take_along_axis(np.broadcast_to(a, shape[:-1] + a.shape[-1:]), np.broadcast_to(k, shape), axis=-1)
+        p_k, cdf_k = take(p), take(cdf)
+        frac = np.divide(q - (cdf_k - p_k), p_k, out=np.zeros(shape), where=p_k > 0)
+        stats['quantiles'] = take(lower) + np.clip(frac, 0, 1) * take(widths)
+
+    return stats
+
+
+def get_node_stats(net:NeticaGraph, nodes:list[int|str|NeticaNode]) -> tuple[np.ndarray, np.ndarray]:
+    """get the mean and standard deviation of several nodes under the current findings, as two arrays of shape [n_nodes]"""
+    stats = histogram_stats(net.get_beliefs(nodes), get_bin_edges(net, nodes))
+    return stats['mean'], stats['std']
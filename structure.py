@@ -0,0 +1,143 @@
+"""
+Structure sharing between networks that differ only in their CPTs, e.g. the per-site networks of limpopo_27_subbasin.
+
+A network's structure is its nodes, states, levels and links (see `NetMetadata.structure_hash`), and not its CPTs or the
+findings saved in the file. The first network of each structure is read and compiled as a template (kept by the manager).
+A network of a structure that has been seen is loaded into a released pooled graph of that structure, if there is one, by
+writing only the CPTs that differ into its compiled net, which netica doesn't need to compile again. Otherwise it is a copy of
+the template with the CPTs that differ loaded in, compiled with the template's elimination order. So netica compiles once per
+structure, plus once per graph of that structure held at the same time, rather than once per file, and the elimination order
+search (see elimination.py) runs once per structure. The metadata and CPTs of each file are saved to the same archive as numpy_inference.py
+exports (CACHE_DIR/cpts/<sha256 of the .neta file>.npz), so after the first run the files themselves aren't read again.
+
+Enabled with NeticaManager(share_structure=True), or `--share-structure` in limpopo_5_subbasin.py and limpopo_27_subbasin.py.
+
+Usage:
+    python structure.py neta/limpopo_5_subbasin/*.neta neta/limpopo_27_subbasin/*.neta [--time]
+which reports the groups of files that share a structure, and how many CPTs each file differs from its group's template in
+"""
+
+from __future__ import annotations
+from netica import NeticaManager, NeticaGraph, NetMetadata, N
+from numpy_inference import archive_path, save_archive, load_archive
+from instrumentation import PROFILER
+import argparse
+import os
+import time
+import numpy as np
+
+
+def site_tables(manager:NeticaManager, path:str, *, keep_net:bool=False) -> tuple[NetMetadata, list[np.ndarray], object]:
+    """
+    the metadata and CPTs of the network at `path`, from its archive, or read from the file (and archived) if there isn't one.
+    With `keep_net`, the uncompiled net is also returned when the file had to be read (and None otherwise), for the caller to compile or delete
+    """
+    archive = archive_path(path)
+    try:
+        return (*load_archive(archive), None)
+    except (OSError, KeyError, ValueError):
+        pass
+
+    net = manager.read_net(path)
+    try:
+        meta, cpts = manager.net_tables(net, path)
+    except BaseException:
+        N.DeleteNet_bn(net)
+        raise
+    if not keep_net:
+        N.DeleteNet_bn(net)
+        net = None
+    try:
+        save_archive(archive, meta, cpts)
+    except OSError as e:
+        print(f"WARNING: could not save the CPTs of {path} to {archive}: {e}")
+    return meta, cpts, net
+
+
+def changed_cpts(cpts:list[np.ndarray], template_cpts:list[np.ndarray]) -> dict[int, np.ndarray]:
+    """the CPTs {node index: cpt} that differ from the template's"""
+    return {i: cpt for i, (cpt, template_cpt) in enumerate(zip(cpts, template_cpts)) if not np.array_equal(cpt, template_cpt)}
+
+
+@PROFILER.method('structure.load_shared', tags=lambda manager, path: {'net': os.path.basename(path)})
+def load_shared(manager:NeticaManager, path:str) -> NeticaGraph:
+    """
+    load a compiled graph of the network at `path`: a released pooled graph of the same structure with the CPTs that differ
+    written into it, or if there is none, a copy of the manager's template for its structure
+    """
+    meta, cpts, net = site_tables(manager, path, keep_net=True)
+    if NetMetadata.load_cached(path) is None:
+        # so that inference_cache.query can find cached results without loading the net
+        meta.save_cached(path)
+
+    key = meta.structure_hash()
+    template = manager.templates.get(key)
+    if template is None or template.closed:
+        # the first network of a structure (or one whose template was closed, e.g. by NeticaManager.close_idle) becomes the template,
+        # compiled from the net its tables were just read from, if they were
+        template = manager.templates[key] = manager.read_graph(path, net=net)
+        template.tables = cpts
+        # held by the manager rather than a caller, so it may be closed by the manager's memory limits
+        template.checked_out = False
+    elif net is not None:
+        N.DeleteNet_bn(net)
+
+    # netica only needs to compile a new net when every graph of this structure is in use
+    for pool_key, graph in list(manager.pool.items()):
+        if not graph.checked_out and graph.tables is not None and graph.meta.structure_hash() == key:
+            del manager.pool[pool_key]
+            graph.checked_out = True
+            graph.load_tables(path, meta, cpts)
+            return graph
+
+    findings = {i: finding for i, finding in enumerate(meta.initial_findings.tolist()) if finding >= 0}
+    graph = template.clone(path=path, meta=meta, cpts=changed_cpts(cpts, template.tables), findings=findings)
+    graph.tables = cpts
+    return graph
+
+
+def group_by_structure(manager:NeticaManager, paths:list[str]) -> dict[str, list[str]]:
+    """the files of `paths` grouped by structure hash, in order of first appearance"""
+    groups: dict[str, list[str]] = {}
+    for path in paths:
+        meta, _, _ = site_tables(manager, path)
+        groups.setdefault(meta.structure_hash(), []).append(path)
+    return groups
+
+
+def time_loads(paths:list[str]) -> tuple[float, float]:
+    """seconds to load (and release) every file of `paths` in turn, read one by one, and then from shared structures (each in a fresh manager)"""
+    seconds = []
+    for share_structure in (False, True):
+        with NeticaManager(share_structure=share_structure) as manager:
+            start = time.perf_counter()
+            for path in paths:
+                manager.new_graph(path).release()
+            seconds.append(time.perf_counter() - start)
+    return seconds[0], seconds[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report which network files share a structure (nodes, states, levels and links), differing only in their CPTs')
+    parser.add_argument('paths', nargs='+', help='.neta files to compare')
+    parser.add_argument('--time', action='store_true', help='also time loading every file with and without structure sharing')
+    args = parser.parse_args()
+
+    with NeticaManager() as manager:
+        groups = group_by_structure(manager, args.paths)
+        for i, (key, paths) in enumerate(groups.items()):
+            template_cpts = site_tables(manager, paths[0])[1]
+            print(f'structure {i+1} ({key[:12]}): {len(paths)} file{"s" if len(paths) > 1 else ""}, {len(template_cpts)} nodes')
+            for path in paths:
+                changed = changed_cpts(site_tables(manager, path)[1], template_cpts)
+                note = 'template' if path == paths[0] else 'identical CPTs' if not changed else f'{len(changed)} CPTs differ'
+                print(f'  {path} ({note})')
+    print(f'{len(args.paths)} files, {len(groups)} distinct structures')
+
+    if args.time:
+        read_seconds, shared_seconds = time_loads(args.paths)
+        print(f'loading every file: {read_seconds:.3f}s read one by one, {shared_seconds:.3f}s from shared structures')
+
+
+if __name__ == '__main__':
+    main()
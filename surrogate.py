@@ -0,0 +1,367 @@
+"""
+Lookup table surrogates: the beliefs of each output node, tabulated ahead of time over every combination of the inputs it depends on.
+
+Building the tables takes a network, a set of variable inputs (by default the nodes of the config file with few states), and
+a base setting of every other node (the rest of the config). Every unobserved node keeps its own distribution. For each output
+node, the parent structure gives the variable inputs it can depend on (see `relevant_inputs`). These are usually a
+small part of all the inputs, and outputs with the same relevant inputs share one enumeration of their combinations. Each
+input can be in any of its states or unset. The tables are stored as .npy files, which queries memory map and index directly,
+so a query never touches netica.
+
+Tables live under CACHE_DIR/surrogate/<sha256 of the .neta file>/, so editing the file invalidates them (tables of older
+versions of a file are deleted when it is rebuilt). A query is answered by any build whose base setting matches the query's
+findings on every non-variable node, and otherwise misses (returns None), so callers can fall back to running the network.
+
+Usage:
+    python surrogate.py build limpopo_27_subbasin --config configs/limpopo_27_subbasin.json [--inputs WQ_ECOSYSTEM DOM_WAT_GRO ...] [--workers 4]
+    python surrogate.py query limpopo_27_subbasin --config configs/limpopo_27_subbasin.json [--site Ngotwane]
+where the model names are those of service.py (mara, limpopo, limpopo_5_subbasin, limpopo_27_subbasin, seqnu)
+"""
+
+from __future__ import annotations
+from netica import NeticaManager, NeticaGraph, NetMetadata, CACHE_DIR, file_hash, pad_beliefs
+from stats import get_bin_edges, histogram_stats
+from parallel import run_scenarios
+from service import Model, available_models
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+import numpy as np
+
+from os.path import join
+
+
+SURROGATE_DIR = join(CACHE_DIR, 'surrogate')
+VERSION = 1
+
+# by default, config nodes with more states than this (e.g. the 29 state discharge nodes) are part of the base setting, rather than tabulated
+DEFAULT_MAX_INPUT_STATES = 8
+
+
+def relevant_inputs(meta:NetMetadata, output_idx:int, variable:set[int], fixed:set[int]) -> list[int]:
+    """
+    the variable inputs whose findings can change the beliefs of an output node, when the `fixed` nodes have findings, the `variable`
+    nodes may or may not, and nothing else does.
+
+    This is a d-separation search from the output (as in Koller & Friedman's Reachable). A variable input is treated as unobserved
+    when a path passes through it, and as possibly observed when it would open a v-structure, so the result includes every
+    input that matters for some setting of the others
+    """
+    num_nodes = len(meta)
+    children: list[list[int]] = [[] for _ in range(num_nodes)]
+    for child in range(num_nodes):
+        for parent in meta.get_parents(child).tolist():
+            children[parent].append(child)
+
+    # nodes that are, or have a descendant that is, (possibly) observed open the v-structures they are the middle of
+    opens_v = set()
+    frontier = list(variable | fixed)
+    while frontier:
+        node = frontier.pop()
+        if node not in opens_v:
+            opens_v.add(node)
+            frontier.extend(meta.get_parents(node).tolist())
+
+    # (node, arrived from a child) pairs still to visit. Starting "from a child" lets the search go both up and down from the output
+    visited = set()
+    reached = set()
+    frontier = [(output_idx, True)]
+    while frontier:
+        node, from_child = frontier.pop()
+        if (node, from_child) in visited:
+            continue
+        visited.add((node, from_child))
+        if node in variable and node != output_idx:
+            reached.add(node)
+
+        blocked = node in fixed and node != output_idx
+        if from_child:
+            if not blocked:
+                frontier.extend((parent, True) for parent in meta.get_parents(node).tolist())
+                frontier.extend((child, False) for child in children[node])
+        else:
+            if not blocked:
+                frontier.extend((child, False) for child in children[node])
+            if node in opens_v:
+                frontier.extend((parent, True) for parent in meta.get_parents(node).tolist())
+    return sorted(reached)
+
+
+def gray_codes(radices:list[int]) -> np.ndarray:
+    """
+    every combination [prod(radices), len(radices)] of digits with the given radices, in reflected (mixed radix) gray code order,
+    so that consecutive rows differ in a single digit (i.e. a single finding changes between consecutive scenarios)
+    """
+    count = int(np.prod(radices, dtype=np.int64))
+    i = np.arange(count, dtype=np.int64)
+    codes = np.empty((count, len(radices)), dtype=np.int64)
+    block = count
+    for j, radix in enumerate(radices):
+        block //= radix
+        q = i // block
+        digit = q % radix
+        codes[:, j] = np.where((q // radix) % 2 == 0, digit, radix - 1 - digit)
+    return codes
+
+
+def table_index(codes:np.ndarray, radices:list[int]) -> np.ndarray:
+    """the row of each combination of digits [..., len(radices)] in a table (row major, first digit most significant)"""
+    if not radices:
+        return np.zeros(codes.shape[:-1], dtype=np.int64)
+    return np.ravel_multi_index(tuple(np.moveaxis(codes, -1, 0)), radices)
+
+
+def build_key(variable:list[str], base:dict[int, int], meta:NetMetadata) -> str:
+    """identifies a build by its variable inputs and base findings"""
+    text = json.dumps([sorted(variable), meta.evidence_key(base)], separators=(',', ':'))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+
+def build_tables(net:NeticaGraph, inputs:list[str], outputs:list[str], *, base:dict[str, int|str|dict|None]|None=None,
+                 max_combinations:int=100_000, workers:int=1, verbose:bool=False) -> dict:
+    """
+    tabulate the beliefs of `outputs` over every combination of the relevant `inputs` (each in one of its states, or unset), with every
+    other node at `base` (on top of the findings saved in the file). Outputs whose tables would have more than `max_combinations`
+    rows are skipped. Saves the tables next to the other builds for the file, and returns the build's manifest
+    """
+    if net.path is None:
+        raise ValueError("tables can only be built for a net loaded from a file")
+    meta = net.meta
+    variable = [meta.name_index[name] if name in meta.name_index else net.get_node_index(name) for name in inputs]
+    base_findings = meta.resolve_findings({node: state for node, state in (base or {}).items() if state is not None and node not in inputs})
+    fixed = {node_idx: state for node_idx, state in base_findings.items() if node_idx not in variable}
+
+    # group the outputs by the inputs they depend on
+    groups: dict[tuple[int, ...], list[str]] = {}
+    for name in outputs:
+        relevant = relevant_inputs(meta, net.get_node_index(name), set(variable), set(fixed))
+        groups.setdefault(tuple(relevant), []).append(name)
+
+    net_hash = file_hash(net.path)
+    key = build_key([meta.node_names[i] for i in variable], fixed, meta)
+    final_dir = join(SURROGATE_DIR, net_hash, key)
+    tmp_dir = f'{final_dir}.{os.getpid()}.tmp'
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    manifest = {
+        'version': VERSION,
+        'path': os.path.realpath(net.path),
+        'inputs': [str(meta.node_names[i]) for i in variable],
+        'base': {str(meta.node_names[i]): int(state) for i, state in fixed.items()},
+        'outputs': {},
+        'skipped': {},
+    }
+    start = time.perf_counter()
+    # enter the base, and retract the variable inputs, so that every enumeration starts from the same findings
+    net.enter_findings({node_idx: fixed.get(node_idx) for node_idx in set(net.findings) | set(fixed) | set(variable)})
+    for relevant, group_outputs in groups.items():
+        # each input is in one of its states, or (the last digit) unset
+        radices = [int(meta.num_states[i]) + 1 for i in relevant]
+        count = int(np.prod(radices, dtype=np.int64))
+        if count > max_combinations:
+            for name in group_outputs:
+                manifest['skipped'][name] = f'{count} combinations of {len(relevant)} inputs is over the limit of {max_combinations}'
+            continue
+
+        codes = gray_codes(radices)
+        scenarios = [
+            {node_idx: (None if digit == radix - 1 else digit) for node_idx, digit, radix in zip(relevant, row, radices)}
+            for row in codes.tolist()
+        ]
+        beliefs = run_scenarios(net, scenarios, group_outputs, workers=workers)
+        rows = table_index(codes, radices)
+        for j, name in enumerate(group_outputs):
+            num_states = int(meta.num_states[net.get_node_index(name)])
+            table = np.empty((count, num_states), dtype=np.float64)
+            table[rows] = beliefs[:, j, :num_states]
+            np.save(join(tmp_dir, f'{name}.npy'), table)
+            manifest['outputs'][name] = {'inputs': [str(meta.node_names[i]) for i in relevant], 'radices': radices}
+        if verbose:
+            print(f"tabulated {', '.join(group_outputs)} over {count} combinations of {len(relevant)} inputs")
+
+    manifest['build_seconds'] = time.perf_counter() - start
+    with open(join(tmp_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    # replace any earlier build with the same key, and remove the builds of older versions of the file
+    shutil.rmtree(final_dir, ignore_errors=True)
+    os.replace(tmp_dir, final_dir)
+    prune_stale(manifest['path'], net_hash)
+    return manifest
+
+
+def prune_stale(path:str, net_hash:str):
+    """delete the tables built from earlier versions of the file at `path`"""
+    if not os.path.isdir(SURROGATE_DIR):
+        return
+    for other_hash in os.listdir(SURROGATE_DIR):
+        if other_hash == net_hash:
+            continue
+        hash_dir = join(SURROGATE_DIR, other_hash)
+        manifests = [join(hash_dir, key, 'manifest.json') for key in os.listdir(hash_dir)]
+        paths = set()
+        for manifest_path in manifests:
+            try:
+                with open(manifest_path) as f:
+                    paths.add(json.load(f)['path'])
+            except (OSError, ValueError, KeyError):
+                pass
+        if paths == {path}:
+            shutil.rmtree(hash_dir, ignore_errors=True)
+
+
+class LookupTables:
+    """one build of the tables of a network file, memory mapped"""
+    def __init__(self, directory:str, manifest:dict, meta:NetMetadata):
+        self.directory = directory
+        self.manifest = manifest
+        self.meta = meta
+        self.variable = {meta.name_index[name] for name in manifest['inputs']}
+        self.base = {meta.name_index[name]: state for name, state in manifest['base'].items()}
+        self.outputs: dict[str, tuple[list[int], list[int]]] = {
+            name: ([meta.name_index[node] for node in output['inputs']], output['radices']) for name, output in manifest['outputs'].items()
+        }
+        self.tables: dict[str, np.ndarray] = {}
+
+    def table(self, name:str) -> np.ndarray:
+        if name not in self.tables:
+            self.tables[name] = np.load(join(self.directory, f'{name}.npy'), mmap_mode='r')
+        return self.tables[name]
+
+    def matches(self, findings:dict[int, int]) -> bool:
+        """whether every node other than the variable inputs has the finding the tables were built with"""
+        fixed = {node_idx: state for node_idx, state in findings.items() if node_idx not in self.variable}
+        return fixed == self.base
+
+    def lookup(self, findings:dict[int, int], nodes:list[str]) -> np.ndarray|None:
+        """beliefs [n_nodes, max_states] for a complete set of findings (see `NetMetadata.resolve_findings`), or None if any node isn't tabulated"""
+        if any(name not in self.outputs for name in nodes):
+            return None
+        out = []
+        for name in nodes:
+            inputs, radices = self.outputs[name]
+            codes = np.array([findings.get(node_idx, radix - 1) for node_idx, radix in zip(inputs, radices)], dtype=np.int64)
+            out.append(np.asarray(self.table(name)[int(table_index(codes, radices))]))
+        return pad_beliefs(out)
+
+
+class Surrogate:
+    """every build of the tables of the current version of a network file"""
+    def __init__(self, neta_path:str, meta:NetMetadata, builds:list[LookupTables]):
+        self.neta_path = neta_path
+        self.meta = meta
+        self.builds = builds
+
+    @classmethod
+    def load(cls, neta_path:str) -> "Surrogate|None":
+        """the tables built for the file as it is now, or None if there aren't any (or its metadata hasn't been cached yet)"""
+        meta = NetMetadata.load_cached(neta_path)
+        hash_dir = join(SURROGATE_DIR, file_hash(neta_path))
+        if meta is None or not os.path.isdir(hash_dir):
+            return None
+        builds = []
+        for key in sorted(os.listdir(hash_dir)):
+            if key.endswith('.tmp'):
+                continue
+            try:
+                with open(join(hash_dir, key, 'manifest.json')) as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                # e.g. a build still in progress
+                continue
+            if manifest.get('version') == VERSION:
+                builds.append(LookupTables(join(hash_dir, key), manifest, meta))
+        return cls(neta_path, meta, builds) if builds else None
+
+    def query(self, findings:dict[str, int|str|dict|None], nodes:list[str]) -> np.ndarray|None:
+        """
+        the beliefs [n_nodes, max_states] of `nodes` with `findings` entered on top of those saved in the file (findings that are None
+        leave the node at its default, as in the configs), or None if no build covers them
+        """
+        resolved = self.meta.resolve_findings({node: state for node, state in findings.items() if state is not None})
+        for build in self.builds:
+            if build.matches(resolved):
+                beliefs = build.lookup(resolved, nodes)
+                if beliefs is not None:
+                    return beliefs
+        return None
+
+
+_surrogates: dict[tuple[str, str], Surrogate|None] = {}
+def get_surrogate(neta_path:str) -> Surrogate|None:
+    """`Surrogate.load`, once per process for each version of a file"""
+    key = (os.path.realpath(neta_path), file_hash(neta_path))
+    if key not in _surrogates:
+        _surrogates[key] = Surrogate.load(neta_path)
+    return _surrogates[key]
+
+
+def model_outputs(model:Model, meta:NetMetadata) -> list[str]:
+    """the output nodes of a model: those it names, or else the nodes without children"""
+    parents = set(meta.parents.tolist())
+    return model.output_nodes or [name for i, name in enumerate(meta.node_names.tolist()) if i not in parents]
+
+
+def split_config(model:Model, site:str, config:dict, meta:NetMetadata, inputs:list[str]|None, max_input_states:int) -> tuple[list[str], dict]:
+    """the variable inputs, and the base findings of every other node, for a site of a model under a config"""
+    if inputs is None:
+        inputs = [key for key in config if key in meta.name_index and meta.num_states[meta.name_index[key]] <= max_input_states]
+    findings = model.site_findings(site, config) if model.site_findings is not None else config
+    return inputs, {node: state for node, state in findings.items() if node not in inputs}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build, or query, lookup tables of the output node beliefs of a model over its config inputs')
+    parser.add_argument('command', choices=['build', 'query'])
+    parser.add_argument('model', help='name of the model, as in service.py')
+    parser.add_argument('--config', required=True, help='config file: the findings to query, or when building, the inputs and base findings')
+    parser.add_argument('--site', help='only this site of the model (default: every site)')
+    parser.add_argument('--inputs', nargs='+', help=f'nodes to tabulate (default: the config nodes with at most {DEFAULT_MAX_INPUT_STATES} states)')
+    parser.add_argument('--max-input-states', type=int, default=DEFAULT_MAX_INPUT_STATES, help=f'see --inputs (default: {DEFAULT_MAX_INPUT_STATES})')
+    parser.add_argument('--max-combinations', type=int, default=100_000, help='skip outputs whose tables would have more rows than this (default: 100000)')
+    parser.add_argument('--workers', type=int, default=1, help='threads or processes to build each site with (see parallel.run_scenarios, default: 1)')
+    args = parser.parse_args()
+
+    models = available_models()
+    if args.model not in models:
+        raise SystemExit(f"unknown model `{args.model}`. Expected one of {', '.join(models)}")
+    model = models[args.model]
+    sites = list(model.sites)
+    if args.site:
+        site = model.find_site(args.site)
+        if site is None:
+            raise SystemExit(f"model {model.name} has no site `{args.site}`")
+        sites = [site]
+    with open(args.config) as f:
+        config = json.load(f)
+
+    if args.command == 'build':
+        with NeticaManager() as netica:
+            for site in sites:
+                net = netica.new_graph(model.sites[site], pooled=False)
+                outputs = model_outputs(model, net.meta)
+                inputs, base = split_config(model, site, config, net.meta, args.inputs, args.max_input_states)
+                manifest = build_tables(net, inputs, outputs, base=base, max_combinations=args.max_combinations, workers=args.workers)
+                net.close()
+                skipped = f", skipped {len(manifest['skipped'])}" if manifest['skipped'] else ''
+                print(f"{site}: tabulated {len(manifest['outputs'])} outputs over {len(inputs)} inputs in {manifest['build_seconds']:.1f}s{skipped}")
+        return
+
+    for site in sites:
+        path = model.sites[site]
+        surrogate = get_surrogate(path)
+        findings = model.site_findings(site, config) if model.site_findings is not None else config
+        outputs = model_outputs(model, surrogate.meta) if surrogate is not None else []
+        beliefs = surrogate.query(findings, outputs) if surrogate is not None else None
+        if beliefs is None:
+            print(f'{site}: no tables cover these findings (build them with `python surrogate.py build {model.name} --config ...`)')
+            continue
+        stats = histogram_stats(beliefs, get_bin_edges(surrogate.meta, outputs))
+        print(f'{site}: ' + ', '.join(f'{name} {mean:.2f} ± {std:.2f}' for name, mean, std in zip(outputs, stats['mean'], stats['std'])))
+
+
+if __name__ == '__main__':
+    main()
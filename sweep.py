@@ -0,0 +1,223 @@
+"""
+Scenario sweeps over the input nodes of a network.
+
+All scenarios of a sweep run against a single loaded net. Scenarios are ordered so that consecutive scenarios differ in as few
+nodes as possible, and only the findings that changed since the previous scenario are retracted and re-entered.
+
+A sweep is described by a json file, e.g.:
+{
+    "base": {"DISCHARGE_SCENARIO": "NATURAL", "DOM_WAT_GRO": "Zero"},
+    "factorial": {"WQ_ECOSYSTEM": "*", "WQ_TREATMENT": ["Low", "High"], "LANDUSE_SSUP": ["Zero", null]}
+}
+or, instead of "factorial", "latin_hypercube": {"samples": 100, "seed": 0, "nodes": {...}}.
+Node values are lists of states (`null` leaves the node unset), or "*" for every state of the node.
+The outputs are the net's leaf nodes, unless given with --outputs.
+"""
+
+from __future__ import annotations
+from netica import NeticaManager, NeticaGraph, NeticaNode
+from stats import get_bin_edges, histogram_stats
+from limpopo_common import output_nodes as limpopo_output_nodes, get_site_findings
+from parallel import run_sites, report_failures, get_manager
+from typing import Generator, Iterable
+import argparse
+import csv
+import json
+import os
+import numpy as np
+import pandas as pd
+
+from os.path import join
+
+
+Scenario = dict[str, 'int|str|None']
+
+
+def gray_code_factorial(space:dict[str, list]) -> Generator[Scenario, None, None]:
+    """
+    every combination of the values in `space`, in (mixed radix, reflected) gray code order
+
+    consecutive scenarios differ in exactly one node
+    """
+    names = list(space)
+    radices = [len(space[name]) for name in names]
+    if not names or 0 in radices:
+        return
+
+    digits = [0] * len(names)
+    directions = [1] * len(names)
+    yield {name: space[name][d] for name, d in zip(names, digits)}
+
+    for _ in range(int(np.prod(radices)) - 1):
+        # advance the lowest digit that can move in its current direction, reversing the direction of the digits below it
+        for i in range(len(names)):
+            d = digits[i] + directions[i]
+            if 0 <= d < radices[i]:
+                digits[i] = d
+                break
+            directions[i] = -directions[i]
+        yield {name: space[name][d] for name, d in zip(names, digits)}
+
+
+def latin_hypercube(space:dict[str, list], samples:int, seed:int|None=None) -> list[Scenario]:
+    """
+    latin hypercube sample of `samples` scenarios. Each node's values are covered in equal proportion (as far as `samples` allows),
+    independently shuffled per node. Scenarios are ordered to minimize the number of changed nodes between consecutive scenarios
+    """
+    rng = np.random.default_rng(seed)
+    names = list(space)
+    # [samples, nodes] index of the value chosen for each node
+    strata = (np.arange(samples)[:, None] + rng.random((samples, len(names)))) / samples
+    codes = np.empty((samples, len(names)), dtype=np.int64)
+    for j, name in enumerate(names):
+        codes[:, j] = np.floor(rng.permutation(strata[:, j]) * len(space[name])).astype(np.int64)
+
+    order = min_change_order(codes)
+    return [{name: space[name][codes[i, j]] for j, name in enumerate(names)} for i in order]
+
+
+def min_change_order(codes:np.ndarray) -> np.ndarray:
+    """greedy nearest neighbor ordering of the rows of `codes` [scenarios, nodes] by hamming distance, starting from row 0"""
+    n = len(codes)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    remaining = np.ones(n, dtype=bool)
+    order = np.empty(n, dtype=np.int64)
+    current = 0
+    for i in range(n):
+        order[i] = current
+        remaining[current] = False
+        if i == n - 1:
+            break
+        distance = np.sum(codes != codes[current], axis=1)
+        distance[~remaining] = codes.shape[1] + 1
+        current = int(np.argmin(distance))
+    return order
+
+
+def expand_space(net:NeticaGraph, space:dict[str, list|str]) -> dict[str, list]:
+    """replace "*" values with every state of the node, and check that every listed state is valid for the node"""
+    expanded = {}
+    for node, values in space.items():
+        if values == '*':
+            state_names = net.node_state_names[net.get_node_name(node)]
+            values = list(state_names) if state_names is not None else list(range(net.get_num_node_states(node)))
+        for value in values:
+            if value is not None:
+                net.get_node_state(node, value)
+        expanded[node] = list(values)
+    return expanded
+
+
+def run_sweep(net:NeticaGraph, scenarios:Iterable[Scenario], output_nodes:list[int|str|NeticaNode]) -> Generator[tuple[Scenario, np.ndarray], None, None]:
+    """
+    run each scenario against `net`, yielding (scenario, beliefs) with beliefs of shape [n_outputs, max_states]
+
+    Findings already entered in `net` (e.g. the sweep base settings) stay in place except where a scenario overrides them.
+    Only the nodes whose value changed since the previous scenario are retracted and re-entered.
+    The findings of the last scenario are left in the net.
+    """
+    current: Scenario = {}
+    for scenario in scenarios:
+        changed = {node: value for node, value in scenario.items() if node not in current or current[node] != value}
+        net.enter_findings(changed)
+        current.update(changed)
+
+        yield scenario, net.get_beliefs(output_nodes)
+
+
+def write_sweep_csv(path:str, results:Iterable[tuple[Scenario, np.ndarray]], edges:np.ndarray, output_names:list[str], *, flush_every:int=100) -> int:
+    """
+    stream sweep results to a csv with the scenario's node values followed by the mean and std of each output node. Returns the number of rows written
+    """
+    count = 0
+    with open(path, 'w', newline='') as f:
+        writer = None
+        for scenario, beliefs in results:
+            if writer is None:
+                writer = csv.writer(f)
+                header = list(scenario)
+                for name in output_names:
+                    header.extend((f'{name} (Mean)', f'{name} (Standard Deviation)'))
+                writer.writerow(header)
+
+            stats = histogram_stats(beliefs, edges)
+            row = ['' if v is None else v for v in scenario.values()]
+            for mean, std in zip(stats['mean'], stats['std']):
+                row.extend((mean, std))
+            writer.writerow(row)
+
+            count += 1
+            if count % flush_every == 0:
+                f.flush()
+    return count
+
+
+def apply_base(net:NeticaGraph, site:str, base:dict):
+    """enter the sweep's base settings, in the same format as the scenario config files"""
+    net.enter_findings({key: value for key, value in get_site_findings(site, base).items() if value is not None})
+
+
+def sweep_site(site:str, neta_path:str, sweep:dict, output_path:str, outputs:list[str]|None=None) -> int:
+    """
+    run a sweep for a single site, streaming the results to `output_path`. Returns the number of scenarios run.
+    The mean and std of `outputs` (by default, the net's leaf nodes) are recorded, under their names in the Limpopo output csvs where they have one
+    """
+    # each site is only swept once, so don't keep its net around in the worker afterwards
+    with get_manager().new_graph(neta_path, pooled=False) as net:
+        apply_base(net, site, sweep.get('base', {}))
+
+        if 'factorial' in sweep:
+            scenarios = gray_code_factorial(expand_space(net, sweep['factorial']))
+        elif 'latin_hypercube' in sweep:
+            lhs = sweep['latin_hypercube']
+            scenarios = latin_hypercube(expand_space(net, lhs['nodes']), lhs['samples'], lhs.get('seed'))
+        else:
+            raise ValueError("sweep must contain either a 'factorial' or 'latin_hypercube' section")
+
+        output_names = outputs or net.meta.leaf_nodes()
+        edges = get_bin_edges(net, output_names)
+        results = run_sweep(net, scenarios, output_names)
+        return write_sweep_csv(output_path, results, edges, [limpopo_output_nodes.get(name, name) for name in output_names])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a scenario sweep over the inputs of a network, or of every site in a site mapping')
+    parser.add_argument('sweep', help='path to the sweep json file')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--net', help='path to a single .neta file')
+    target.add_argument('--site-map', help='path to a risk_region_mapping.csv, to sweep every site it lists')
+    parser.add_argument('--site', help='site name of the --net file, for base settings that depend on the site, e.g. DISCHARGE_SCENARIO (default: the file name)')
+    parser.add_argument('--outputs', nargs='+', help='output nodes to record (default: the leaf nodes of each net)')
+    parser.add_argument('--workers', type=int, default=1, help='number of sites to run in parallel (default: 1)')
+    parser.add_argument('--output-dir', default=join('results', 'sweep'), help='directory for the per-site result csvs')
+    args = parser.parse_args()
+
+    with open(args.sweep) as f:
+        sweep = json.load(f)
+
+    if args.net:
+        if args.site is None and sweep.get('base', {}).get('DISCHARGE_SCENARIO') is not None:
+            parser.error('the sweep base sets DISCHARGE_SCENARIO, which is looked up by site, so --net needs --site')
+        name = args.site or os.path.splitext(os.path.basename(args.net))[0]
+        sites = [(name, args.net)]
+    else:
+        if args.site is not None:
+            parser.error('--site only applies to --net')
+        file_map_df = pd.read_csv(args.site_map)
+        neta_dir = os.path.dirname(args.site_map)
+        sites = [(row['Site'], join(neta_dir, row['Netica File'])) for _, row in file_map_df.iterrows()]
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    tasks = [(site, (site, neta_path, sweep, join(args.output_dir, f'{site.strip()}.csv'), args.outputs)) for site, neta_path in sites]
+    results = run_sites(sweep_site, tasks, workers=args.workers)
+    for r in results:
+        if r.ok:
+            print(f'{r.site}: {r.result} scenarios')
+    failures = report_failures(results)
+    if failures:
+        raise SystemExit(f'{len(failures)} of {len(results)} sites failed')
+
+
+if __name__ == '__main__':
+    main()